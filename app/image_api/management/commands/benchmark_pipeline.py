@@ -0,0 +1,582 @@
+import io
+import json
+import logging
+import platform
+import random
+import subprocess
+import threading
+import time
+import tracemalloc
+import uuid
+import zipfile
+from contextlib import ExitStack
+from datetime import datetime, timezone as dt_timezone
+from unittest import mock
+
+import redis
+from botocore.exceptions import ClientError
+from django.contrib.auth import get_user_model
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import CaptureQueriesContext, setup_test_environment, teardown_test_environment
+from django.urls import reverse
+from rest_framework.test import APIClient
+
+from image_api.models import DetectedImageLocation, ImageLocation, UploadedImage
+from image_api.services.admission_controller import AdmissionController
+from image_api.services.geocoding_queue import GeocodingQueue
+from image_api.services.prediction_client import PredictionServiceClient
+
+logger = logging.getLogger(__name__)
+
+# Метрики, по которым сравниваются прогоны: имя -> True, если больше — лучше
+COMPARED_METRICS = {
+    "throughput_ops": True,
+    "p50_ms": False,
+    "p95_ms": False,
+    "p99_ms": False,
+    "queries_avg": False,
+    "peak_memory_mb": False,
+}
+
+
+class InMemoryS3Client:
+    """
+    Подмена клиента boto3 S3: объекты хранятся в памяти процесса.
+    Реализует только методы, которые вызывает S3Service.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.objects = {}
+        self.uploads = {}
+        self.calls = 0
+
+    def _count(self):
+        with self._lock:
+            self.calls += 1
+
+    @staticmethod
+    def _read(body) -> bytes:
+        return body.read() if hasattr(body, "read") else bytes(body)
+
+    def put_object(self, Bucket, Key, Body, ContentType=None, **kwargs):
+        self._count()
+        data = self._read(Body)
+        with self._lock:
+            self.objects[(Bucket, Key)] = data
+        return {"ETag": f'"{uuid.uuid4().hex}"'}
+
+    def get_object(self, Bucket, Key, Range=None, **kwargs):
+        self._count()
+        data = self.objects[(Bucket, Key)]
+        if Range:
+            start, end = Range.replace("bytes=", "").split("-")
+            data = data[int(start):int(end) + 1]
+        return {"Body": io.BytesIO(data), "ContentLength": len(data)}
+
+    def head_object(self, Bucket, Key, **kwargs):
+        self._count()
+        if (Bucket, Key) not in self.objects:
+            raise ClientError({"Error": {"Code": "404", "Message": "Not Found"}}, "HeadObject")
+        return {"ContentLength": len(self.objects[(Bucket, Key)])}
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        self._count()
+        with self._lock:
+            self.objects.pop((Bucket, Key), None)
+        return {}
+
+    def delete_objects(self, Bucket, Delete, **kwargs):
+        self._count()
+        with self._lock:
+            for obj in Delete.get("Objects", []):
+                self.objects.pop((Bucket, obj["Key"]), None)
+        return {"Deleted": Delete.get("Objects", [])}
+
+    def head_bucket(self, Bucket, **kwargs):
+        self._count()
+        return {}
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        self._count()
+        upload_id = uuid.uuid4().hex
+        with self._lock:
+            self.uploads[upload_id] = {}
+        return {"UploadId": upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body, **kwargs):
+        self._count()
+        data = self._read(Body)
+        with self._lock:
+            self.uploads[UploadId][PartNumber] = data
+        return {"ETag": f'"{PartNumber}"'}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload, **kwargs):
+        self._count()
+        with self._lock:
+            parts = self.uploads.pop(UploadId)
+            self.objects[(Bucket, Key)] = b"".join(parts[p["PartNumber"]] for p in MultipartUpload["Parts"])
+        return {}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId, **kwargs):
+        self._count()
+        with self._lock:
+            self.uploads.pop(UploadId, None)
+        return {}
+
+
+class FakePredictionClient(PredictionServiceClient):
+    """
+    Сервис распознавания в процессе: запрос сериализуется как настоящий,
+    но вместо HTTP все задачи сразу считаются принятыми.
+    """
+
+    def __init__(self):
+        super().__init__(
+            base_url="http://prediction.invalid", callback_base_url="http://backend.invalid",
+            connect_timeout=1, read_timeout=1, retries=0, backoff=0, backoff_max=0, pool_size=1,
+        )
+        self.requests = 0
+        self.task_ids = []
+        self._lock = threading.Lock()
+
+    def send_tasks(self, images):
+        body = json.dumps(self.build_payload(images)).encode("utf-8")
+        with self._lock:
+            self.requests += 1
+            self.task_ids.extend(img["task_id"] for img in images)
+        return {
+            "success": [str(img["task_id"]) for img in images],
+            "errors": [],
+            "raw_response": {"bytes": len(body)},
+            "request_error": None,
+            "retryable": False,
+            "delivery_unknown": False,
+        }
+
+
+def percentile(sorted_values, pct):
+    """
+    Перцентиль методом ближайшего ранга
+    """
+    if not sorted_values:
+        return None
+    rank = max(1, int(round(pct / 100 * len(sorted_values))))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def measure(fn, iterations, ops_per_iteration=1, warmup=1, memory=True):
+    """
+    Выполняет fn(i) iterations раз и собирает задержки и число SQL-запросов.
+    Пиковая память измеряется отдельным проходом под tracemalloc, чтобы его
+    накладные расходы не искажали задержки.
+    """
+    for i in range(warmup):
+        fn(-1 - i)
+
+    latencies = []
+    queries = []
+    started = time.perf_counter()
+    for i in range(iterations):
+        with CaptureQueriesContext(connection) as ctx:
+            t0 = time.perf_counter()
+            fn(i)
+            latencies.append(time.perf_counter() - t0)
+        queries.append(len(ctx.captured_queries))
+    total = time.perf_counter() - started
+
+    peak_memory_mb = None
+    if memory:
+        tracemalloc.start()
+        try:
+            fn(iterations)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        peak_memory_mb = round(peak / (1024 * 1024), 2)
+
+    latencies_ms = sorted(latency * 1000 for latency in latencies)
+    return {
+        "iterations": iterations,
+        "ops": iterations * ops_per_iteration,
+        "total_s": round(total, 4),
+        "throughput_ops": round(iterations * ops_per_iteration / total, 2) if total else None,
+        "p50_ms": round(percentile(latencies_ms, 50), 3),
+        "p95_ms": round(percentile(latencies_ms, 95), 3),
+        "p99_ms": round(percentile(latencies_ms, 99), 3),
+        "max_ms": round(latencies_ms[-1], 3),
+        "queries_avg": round(sum(queries) / len(queries), 2),
+        "queries_max": max(queries),
+        "peak_memory_mb": peak_memory_mb,
+    }
+
+
+class Command(BaseCommand):
+    help = (
+        "Сквозной бенчмарк горячих путей: загрузка изображений и архивов, callback'и "
+        "и списки локаций. Работает без сети: S3 и сервис распознавания подменяются "
+        "заглушками в памяти, Celery выполняется синхронно, данные пишутся в тестовую БД."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--scenarios", default="upload,archive,callbacks,lists",
+                            help="Через запятую: upload, archive, callbacks, lists")
+        parser.add_argument("--upload-sizes", default="1,10,50", help="Число изображений в одном запросе загрузки")
+        parser.add_argument("--upload-iterations", type=int, default=10)
+        parser.add_argument("--archive-sizes", default="10,100", help="Число изображений в архиве")
+        parser.add_argument("--archive-iterations", type=int, default=3)
+        parser.add_argument("--image-kb", type=int, default=200, help="Размер одного изображения, КБ")
+        parser.add_argument("--callbacks", type=int, default=200, help="Число callback'ов в каждом всплеске")
+        parser.add_argument("--callback-batch-size", type=int, default=100)
+        parser.add_argument("--trash-per-callback", type=int, default=3)
+        parser.add_argument("--locations", type=int, default=2000, help="Локаций у пользователя для списков")
+        parser.add_argument("--detected-per-location", type=int, default=3)
+        parser.add_argument("--list-iterations", type=int, default=50)
+        parser.add_argument("--page-size", type=int, default=50)
+        parser.add_argument("--no-memory", action="store_true", help="Не измерять пиковую память")
+        parser.add_argument("--seed", type=int, default=42)
+        parser.add_argument("--keepdb", action="store_true", help="Не пересоздавать тестовую БД")
+        parser.add_argument("--output", default=None, help="Файл для результатов в JSON")
+        parser.add_argument("--compare", default=None, help="JSON предыдущего прогона для сравнения")
+        parser.add_argument("--threshold", type=float, default=10.0,
+                            help="Допустимое ухудшение метрики при сравнении, %%")
+        parser.add_argument("--fail-on-regression", action="store_true")
+
+    def handle(self, *args, **options):
+        from recognition_backend.celery import app as celery_app
+
+        self.options = options
+        self.random = random.Random(options["seed"])
+        self.memory = not options["no_memory"]
+        scenarios = {name.strip() for name in options["scenarios"].split(",") if name.strip()}
+
+        self.s3 = InMemoryS3Client()
+        self.prediction = FakePredictionClient()
+
+        setup_test_environment()
+        old_db_name = connection.settings_dict["NAME"]
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, keepdb=options["keepdb"])
+        # Настройки приложения загружены с namespace='CELERY': значения из Django
+        # переопределяют task_always_eager, поэтому меняем именно ключи CELERY_*
+        eager = (celery_app.conf.CELERY_TASK_ALWAYS_EAGER, celery_app.conf.CELERY_TASK_EAGER_PROPAGATES)
+        celery_app.conf.CELERY_TASK_ALWAYS_EAGER = True
+        celery_app.conf.CELERY_TASK_EAGER_PROPAGATES = True
+        if not celery_app.conf.task_always_eager:
+            raise CommandError("Failed to switch Celery to eager mode")
+        self.redis_connections = 0
+        results = {}
+        try:
+            with ExitStack() as stack:
+                self._install_stand_ins(stack)
+                user_model = get_user_model()
+                self.user = user_model.objects.create_user(
+                    username=f"bench_{uuid.uuid4().hex[:8]}", password=uuid.uuid4().hex
+                )
+                self.client = APIClient()
+                self.client.force_authenticate(self.user)
+
+                if "upload" in scenarios:
+                    results.update(self._bench_upload())
+                if "archive" in scenarios:
+                    results.update(self._bench_archive())
+                if "callbacks" in scenarios:
+                    results.update(self._bench_callbacks())
+                if "lists" in scenarios:
+                    results.update(self._bench_lists())
+        finally:
+            celery_app.conf.CELERY_TASK_ALWAYS_EAGER, celery_app.conf.CELERY_TASK_EAGER_PROPAGATES = eager
+            connection.creation.destroy_test_db(old_db_name, verbosity=0, keepdb=options["keepdb"])
+            teardown_test_environment()
+
+        # Ошибку соединения код приложения мог перехватить — проверяем отдельно
+        if self.redis_connections:
+            raise CommandError(
+                f"{self.redis_connections} Redis connection attempt(s) during the benchmark; "
+                f"some path is not covered by the in-memory stand-ins"
+            )
+
+        report = {"meta": self._meta(), "scenarios": results}
+        self._print_results(results)
+
+        if options["output"]:
+            with open(options["output"], "w", encoding="utf-8") as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+            self.stdout.write(self.style.SUCCESS(f"Results written to {options['output']}"))
+
+        if options["compare"]:
+            regressions = self._compare(options["compare"], results, options["threshold"])
+            if regressions and options["fail_on_regression"]:
+                raise CommandError(f"{len(regressions)} metric(s) regressed beyond {options['threshold']}%")
+
+    # --- окружение ---
+
+    def _install_stand_ins(self, stack):
+        """
+        Подменяет внешние зависимости: S3, сервис распознавания, Redis-очереди.
+        Любая попытка соединиться с Redis (в том числе брокером Celery) считается ошибкой
+        """
+        from image_api import tasks
+        from image_api.services import image_upload_service
+
+        def dispatch_now(images):
+            if images:
+                tasks.process_geo_tasks(images)
+
+        stack.enter_context(mock.patch("image_api.services.s3_service.get_s3_client", return_value=self.s3))
+        stack.enter_context(mock.patch.object(tasks, "get_prediction_client", return_value=self.prediction))
+        # Накопитель и окно задач живут в Redis — задачи уходят в заглушку сразу
+        stack.enter_context(mock.patch.object(tasks, "dispatch_geo_tasks", dispatch_now))
+        stack.enter_context(mock.patch.object(image_upload_service, "dispatch_geo_tasks", dispatch_now))
+        stack.enter_context(mock.patch.object(AdmissionController, "release", lambda self, task_ids: 0))
+        # Геокодирование в бенчмарк не входит: запросы в очередь не ставятся
+        stack.enter_context(mock.patch.object(GeocodingQueue, "submit_many", lambda self, lookups: None))
+        stack.enter_context(mock.patch.object(tasks.enrich_locations_task, "delay", lambda *a, **kw: None))
+
+        def refuse_redis(connection_self):
+            self.redis_connections += 1
+            raise redis.ConnectionError("Redis is not available in the offline benchmark")
+
+        stack.enter_context(mock.patch.object(redis.connection.AbstractConnection, "connect", refuse_redis))
+
+    def _meta(self):
+        try:
+            revision = subprocess.run(
+                ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, timeout=5
+            ).stdout.strip() or None
+        except (OSError, subprocess.SubprocessError):
+            revision = None
+        options = {
+            key: value for key, value in self.options.items()
+            if key not in ("verbosity", "settings", "pythonpath", "traceback", "no_color", "force_color",
+                           "skip_checks", "output", "compare")
+        }
+        return {
+            "timestamp": datetime.now(dt_timezone.utc).isoformat(),
+            "git_revision": revision,
+            "python": platform.python_version(),
+            "database": connection.vendor,
+            "options": options,
+        }
+
+    def _image(self, name):
+        size = self.options["image_kb"] * 1024
+        content = b"\xff\xd8\xff\xe0" + self.random.randbytes(size - 4)
+        return SimpleUploadedFile(name, content, content_type="image/jpeg")
+
+    def _coords(self):
+        return 55.75 + self.random.uniform(-0.1, 0.1), 37.61 + self.random.uniform(-0.1, 0.1)
+
+    # --- сценарии ---
+
+    def _bench_upload(self):
+        results = {}
+        url = reverse("upload_images")
+        for size in [int(s) for s in self.options["upload_sizes"].split(",")]:
+            def run(i, size=size):
+                data = {}
+                for n in range(size):
+                    lat, lon = self._coords()
+                    data[f"images_data[{n}][image]"] = self._image(f"img_{n}.jpg")
+                    data[f"images_data[{n}][lat]"] = lat
+                    data[f"images_data[{n}][lon]"] = lon
+                    data[f"images_data[{n}][address]"] = "Москва"
+                response = self.client.post(url, data, format="multipart")
+                assert response.status_code == 200, response.content
+
+            name = f"upload_images[n={size}]"
+            self.stdout.write(f"Running {name}...")
+            results[name] = measure(run, self.options["upload_iterations"], size, memory=self.memory)
+        return results
+
+    def _build_archive(self, count):
+        buffer = io.BytesIO()
+        metadata = []
+        with zipfile.ZipFile(buffer, "w", zipfile.ZIP_STORED) as zf:
+            for n in range(count):
+                name = f"photos/img_{n}.jpg"
+                zf.writestr(name, self._image(name).read())
+                lat, lon = self._coords()
+                metadata.append({"image": name, "lat": lat, "lon": lon, "address": "Москва"})
+        return buffer.getvalue(), json.dumps(metadata).encode("utf-8")
+
+    def _bench_archive(self):
+        results = {}
+        url = reverse("upload_archive")
+        for count in [int(s) for s in self.options["archive_sizes"].split(",")]:
+            archive_bytes, metadata_bytes = self._build_archive(count)
+
+            def run(i, archive_bytes=archive_bytes, metadata_bytes=metadata_bytes):
+                data = {
+                    "archive": SimpleUploadedFile("bench.zip", archive_bytes, content_type="application/zip"),
+                    "json": SimpleUploadedFile("meta.json", metadata_bytes, content_type="application/json"),
+                }
+                response = self.client.post(url, data, format="multipart")
+                assert response.status_code == 202, response.content
+
+            name = f"upload_archive+process[n={count}]"
+            self.stdout.write(f"Running {name}...")
+            results[name] = measure(run, self.options["archive_iterations"], count, memory=self.memory)
+        return results
+
+    def _seed_locations(self, count, status="processing", detected_per_location=0):
+        images = UploadedImage.objects.bulk_create([
+            UploadedImage(
+                filename=f"{uuid.uuid4()}_seed.jpg", original_filename="seed.jpg",
+                file_path="uploads/seed.jpg", s3_url="http://s3.invalid/seed.jpg", user=self.user
+            )
+            for _ in range(count)
+        ])
+        locations = ImageLocation.objects.bulk_create([
+            ImageLocation(user=self.user, image=image, status=status, address="Москва", lat=lat, lon=lon)
+            for image, (lat, lon) in ((image, self._coords()) for image in images)
+        ])
+        if detected_per_location:
+            detected_images = UploadedImage.objects.bulk_create([
+                UploadedImage(
+                    filename=f"{uuid.uuid4()}_det.jpg", original_filename="det.jpg",
+                    file_path="detected/det.jpg", s3_url="http://s3.invalid/det.jpg", user=self.user
+                )
+                for _ in range(count * detected_per_location)
+            ])
+            DetectedImageLocation.objects.bulk_create([
+                DetectedImageLocation(
+                    file=detected_images[n * detected_per_location + k], image_location=location,
+                    lat=location.lat + self.random.uniform(-0.001, 0.001),
+                    lon=location.lon + self.random.uniform(-0.001, 0.001), address="Москва"
+                )
+                for n, location in enumerate(locations)
+                for k in range(detected_per_location)
+            ])
+        return locations
+
+    def _trash_payload(self, location_id):
+        return {
+            "TaskId": str(location_id),
+            "Status": "Succeeded",
+            "Result": [
+                {"ImagePath": f"detected/{uuid.uuid4().hex}.jpg", "Latitude": lat, "Longitude": lon}
+                for lat, lon in (self._coords() for _ in range(self.options["trash_per_callback"]))
+            ],
+        }
+
+    def _bench_callbacks(self):
+        results = {}
+        burst = self.options["callbacks"]
+        batch_size = self.options["callback_batch_size"]
+
+        # На каждую итерацию (включая прогрев и проход памяти) — своя запись
+        locations = self._seed_locations(burst + 2)
+
+        def post(name, payload):
+            response = self.client.post(reverse(name), payload, format="json")
+            assert response.status_code in (200, 202), response.content
+
+        def main(i):
+            lat, lon = self._coords()
+            post("image-location-callback", {
+                "TaskId": str(locations[i % len(locations)].id), "Status": "Succeeded",
+                "Result": {"Latitude": lat, "Longitude": lon},
+            })
+
+        def trash(i):
+            post("image-trash-location-callback", self._trash_payload(locations[i % len(locations)].id))
+
+        self.stdout.write("Running callback_main_burst...")
+        results["callback_main_burst"] = measure(main, burst, memory=self.memory)
+        self.stdout.write("Running callback_trash_burst...")
+        results["callback_trash_burst"] = measure(trash, burst, memory=self.memory)
+
+        batch_iterations = max(1, burst // batch_size)
+        batch_locations = self._seed_locations((batch_iterations + 2) * batch_size)
+
+        def batch(i):
+            offset = (i % (batch_iterations + 2)) * batch_size
+            chunk = batch_locations[offset:offset + batch_size]
+            payload = {"Main": [], "Trash": []}
+            for location in chunk:
+                lat, lon = self._coords()
+                payload["Main"].append({
+                    "TaskId": str(location.id), "Status": "Succeeded",
+                    "Result": {"Latitude": lat, "Longitude": lon},
+                })
+                payload["Trash"].append(self._trash_payload(location.id))
+            post("image-results-batch-callback", payload)
+
+        name = f"callback_batch[n={batch_size}]"
+        self.stdout.write(f"Running {name}...")
+        results[name] = measure(batch, batch_iterations, batch_size * 2, memory=self.memory)
+        return results
+
+    def _bench_lists(self):
+        results = {}
+        count = self.options["locations"]
+        page_size = self.options["page_size"]
+        self._seed_locations(count, status="done", detected_per_location=self.options["detected_per_location"])
+        pages = max(1, count // page_size)
+
+        def image_locations(i):
+            response = self.client.get(
+                reverse("user-image-locations"), {"page": i % pages + 1, "page_size": page_size}
+            )
+            assert response.status_code == 200, response.content
+
+        def detected_locations(i):
+            lat, lon = self._coords()
+            response = self.client.get(
+                reverse("user-trash-image-locations"), {"lat": lat, "lon": lon, "radius_km": 2}
+            )
+            assert response.status_code == 200, response.content
+
+        name = f"list_image_locations[rows={count},page={page_size}]"
+        self.stdout.write(f"Running {name}...")
+        results[name] = measure(image_locations, self.options["list_iterations"], memory=self.memory)
+
+        name = f"list_detected_locations[rows={count * self.options['detected_per_location']}]"
+        self.stdout.write(f"Running {name}...")
+        results[name] = measure(detected_locations, self.options["list_iterations"], memory=self.memory)
+        return results
+
+    # --- отчёт ---
+
+    def _print_results(self, results):
+        header = f"{'scenario':<48} {'ops/s':>10} {'p50 ms':>10} {'p95 ms':>10} {'p99 ms':>10} {'queries':>8} {'mem MB':>8}"
+        self.stdout.write(header)
+        self.stdout.write("-" * len(header))
+        for name, m in results.items():
+            memory = "-" if m["peak_memory_mb"] is None else f"{m['peak_memory_mb']:.1f}"
+            self.stdout.write(
+                f"{name:<48} {m['throughput_ops']:>10} {m['p50_ms']:>10} {m['p95_ms']:>10} "
+                f"{m['p99_ms']:>10} {m['queries_avg']:>8} {memory:>8}"
+            )
+
+    def _compare(self, baseline_path, results, threshold):
+        """
+        Сравнивает с предыдущим прогоном и печатает метрики, ухудшившиеся больше чем на threshold %
+        """
+        with open(baseline_path, encoding="utf-8") as f:
+            baseline = json.load(f).get("scenarios", {})
+
+        regressions = []
+        self.stdout.write(f"\nComparison with {baseline_path} (threshold {threshold}%):")
+        for name, current in results.items():
+            previous = baseline.get(name)
+            if previous is None:
+                self.stdout.write(f"  {name}: no baseline")
+                continue
+            for metric, higher_is_better in COMPARED_METRICS.items():
+                old, new = previous.get(metric), current.get(metric)
+                if not old or new is None:
+                    continue
+                change = (new - old) / old * 100
+                worse = -change if higher_is_better else change
+                line = f"  {name} {metric}: {old} -> {new} ({change:+.1f}%)"
+                if worse > threshold:
+                    regressions.append((name, metric, change))
+                    self.stdout.write(self.style.ERROR(line + " REGRESSION"))
+                elif worse < -threshold:
+                    self.stdout.write(self.style.SUCCESS(line))
+                else:
+                    self.stdout.write(line)
+        return regressions
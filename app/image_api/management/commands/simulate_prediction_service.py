@@ -0,0 +1,266 @@
+import heapq
+import json
+import logging
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+from django.core.management.base import BaseCommand
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+PREDICTION_PATH = "/api/Prediction"
+
+# Центр Москвы — координаты по умолчанию, если задача пришла без них
+DEFAULT_LAT = 55.7558
+DEFAULT_LON = 37.6173
+
+
+class CallbackScheduler:
+    """
+    Отправляет callback'и в назначенное время: очередь по времени отправки
+    разбирает один поток, сами HTTP-запросы выполняет пул потоков.
+    """
+
+    def __init__(self, workers: int):
+        self._heap = []
+        self._counter = 0
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self.stats_lock = threading.Lock()
+        self.stats = {"sent": 0, "errors": 0, "pending": 0}
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def schedule(self, delay: float, url: str, payload: dict) -> None:
+        with self._condition:
+            self._counter += 1
+            heapq.heappush(self._heap, (time.monotonic() + delay, self._counter, url, payload))
+            self._condition.notify()
+        with self.stats_lock:
+            self.stats["pending"] += 1
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                while not self._stopped and (not self._heap or self._heap[0][0] > time.monotonic()):
+                    timeout = self._heap[0][0] - time.monotonic() if self._heap else None
+                    self._condition.wait(timeout)
+                if self._stopped:
+                    return
+                _, _, url, payload = heapq.heappop(self._heap)
+            self._executor.submit(self._send, url, payload)
+
+    def _send(self, url: str, payload: dict) -> None:
+        try:
+            response = self.session.post(url, json=payload, timeout=30)
+            ok = response.status_code < 400
+            if not ok:
+                logger.warning(f"Callback {url} returned {response.status_code}: {response.text[:200]}")
+        except requests.RequestException as e:
+            ok = False
+            logger.warning(f"Callback {url} failed: {e}")
+        with self.stats_lock:
+            self.stats["pending"] -= 1
+            self.stats["sent" if ok else "errors"] += 1
+
+    def stop(self) -> None:
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+class PredictionSimulator:
+    """
+    Поведение имитатора: проверка задач, задержка и содержимое callback'ов
+    """
+
+    def __init__(self, scheduler: CallbackScheduler, options: dict):
+        self.scheduler = scheduler
+        self.latency_min = options["latency_min"]
+        self.latency_max = max(options["latency_max"], self.latency_min)
+        self.failure_rate = options["failure_rate"]
+        self.reject_rate = options["reject_rate"]
+        self.duplicate_rate = options["duplicate_rate"]
+        self.trash_min = options["trash_min"]
+        self.trash_max = max(options["trash_max"], self.trash_min)
+        self.callback_base = options["callback_base"]
+        self.batch_callbacks = options["batch_callbacks"]
+        self.random = random.Random(options["seed"])
+        self.random_lock = threading.Lock()
+
+        self.stats_lock = threading.Lock()
+        self.stats = {"requests": 0, "accepted": 0, "rejected": 0}
+
+    def _callback_urls(self, body: dict):
+        main_url = body.get("mainCallback") or body.get("callbackUrl")
+        trash_url = body.get("trashCallback")
+        if self.callback_base:
+            base = self.callback_base.rstrip("/")
+            main_url = f"{base}/api/update-image-result/"
+            trash_url = f"{base}/api/update-image-trash-result/"
+        batch_url = main_url.replace("update-image-result/", "update-image-results/batch/") if main_url else None
+        return main_url, trash_url, batch_url
+
+    def handle(self, body: dict) -> dict:
+        """
+        Принимает запрос в формате _send_geo_request_internal и возвращает ответ 202
+        """
+        main_url, trash_url, batch_url = self._callback_urls(body)
+        jobs, validation_errors = [], []
+
+        with self.random_lock:
+            decisions = [
+                (task, self.random.random(), self.random.random(), self.random.random(),
+                 self.random.uniform(self.latency_min, self.latency_max),
+                 self.random.randint(self.trash_min, self.trash_max))
+                for task in body.get("tasks", [])
+            ]
+
+        for task, reject_roll, failure_roll, duplicate_roll, latency, trash_count in decisions:
+            task_id = task.get("taskId")
+            if not task_id or not task.get("fileName"):
+                validation_errors.append({"taskId": task_id, "error": "fileName and taskId are required"})
+                continue
+            if reject_roll < self.reject_rate:
+                validation_errors.append({"taskId": task_id, "error": "Simulated validation error"})
+                continue
+            jobs.append(task_id)
+
+            main_payload, trash_payload = self._build_results(task, failure_roll < self.failure_rate, trash_count)
+            deliveries = 2 if duplicate_roll < self.duplicate_rate else 1
+            for attempt in range(deliveries):
+                delay = latency + attempt * 0.5
+                if self.batch_callbacks:
+                    self.scheduler.schedule(delay, batch_url, {"Main": [main_payload], "Trash": [trash_payload]})
+                else:
+                    self.scheduler.schedule(delay, main_url, main_payload)
+                    self.scheduler.schedule(delay, trash_url, trash_payload)
+
+        with self.stats_lock:
+            self.stats["requests"] += 1
+            self.stats["accepted"] += len(jobs)
+            self.stats["rejected"] += len(validation_errors)
+        return {"jobs": jobs, "validationErrors": validation_errors}
+
+    def _build_results(self, task: dict, failed: bool, trash_count: int):
+        task_id = str(task["taskId"])
+        if failed:
+            error = {"TaskId": task_id, "Status": "Failed", "ErrorCode": "SIMULATED", "ErrorMessage": "Simulated failure"}
+            return dict(error), dict(error)
+
+        lat = task.get("lat") if task.get("lat") is not None else DEFAULT_LAT
+        lon = task.get("lon") if task.get("lon") is not None else DEFAULT_LON
+        with self.random_lock:
+            main_lat = lat + self.random.uniform(-0.001, 0.001)
+            main_lon = lon + self.random.uniform(-0.001, 0.001)
+            trash = [
+                {
+                    "ImagePath": f"detected/{uuid.uuid4().hex}.jpg",
+                    "Latitude": main_lat + self.random.uniform(-0.0005, 0.0005),
+                    "Longitude": main_lon + self.random.uniform(-0.0005, 0.0005),
+                }
+                for _ in range(trash_count)
+            ]
+        main_payload = {"TaskId": task_id, "Status": "Succeeded", "Result": {"Latitude": main_lat, "Longitude": main_lon}}
+        trash_payload = {"TaskId": task_id, "Status": "Succeeded", "Result": trash}
+        return main_payload, trash_payload
+
+
+def make_handler(simulator: PredictionSimulator):
+    class PredictionHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _reply(self, status_code: int, body: dict) -> None:
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(status_code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_POST(self):
+            if self.path.rstrip("/") != PREDICTION_PATH:
+                self._reply(404, {"error": "Not found"})
+                return
+            length = int(self.headers.get("Content-Length") or 0)
+            try:
+                body = json.loads(self.rfile.read(length) or b"{}")
+            except ValueError:
+                self._reply(400, {"error": "Invalid JSON"})
+                return
+            self._reply(202, simulator.handle(body))
+
+        def log_message(self, format, *args):
+            logger.debug(format % args)
+
+    return PredictionHandler
+
+
+class Command(BaseCommand):
+    help = (
+        "Имитатор сервиса распознавания: принимает POST /api/Prediction в формате "
+        "_send_geo_request_internal и после задержки отправляет основной и мусорный callback'и"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--host", default="0.0.0.0")
+        parser.add_argument("--port", type=int, default=8080)
+        parser.add_argument("--latency-min", type=float, default=1.0, help="Минимальная задержка callback'а, сек")
+        parser.add_argument("--latency-max", type=float, default=5.0, help="Максимальная задержка callback'а, сек")
+        parser.add_argument("--failure-rate", type=float, default=0.05, help="Доля задач со статусом Failed")
+        parser.add_argument("--reject-rate", type=float, default=0.0,
+                            help="Доля задач, отклоняемых с validationErrors")
+        parser.add_argument("--duplicate-rate", type=float, default=0.0,
+                            help="Доля задач, callback'и которых доставляются дважды")
+        parser.add_argument("--trash-min", type=int, default=0, help="Минимум обнаруженных объектов на задачу")
+        parser.add_argument("--trash-max", type=int, default=3, help="Максимум обнаруженных объектов на задачу")
+        parser.add_argument("--callback-base", default=None,
+                            help="Базовый URL бэкенда вместо адресов из запроса, например http://localhost:8000")
+        parser.add_argument("--batch-callbacks", action="store_true",
+                            help="Отправлять результаты через update-image-results/batch/")
+        parser.add_argument("--callback-workers", type=int, default=16, help="Потоков для отправки callback'ов")
+        parser.add_argument("--seed", type=int, default=None, help="Зерно генератора для воспроизводимых прогонов")
+        parser.add_argument("--stats-interval", type=float, default=10.0, help="Период вывода статистики, сек")
+
+    def handle(self, *args, **options):
+        scheduler = CallbackScheduler(options["callback_workers"])
+        simulator = PredictionSimulator(scheduler, options)
+        server = ThreadingHTTPServer((options["host"], options["port"]), make_handler(simulator))
+        server.daemon_threads = True
+
+        stop = threading.Event()
+
+        def report():
+            while not stop.wait(options["stats_interval"]):
+                with simulator.stats_lock, scheduler.stats_lock:
+                    self.stdout.write(
+                        f"requests={simulator.stats['requests']} accepted={simulator.stats['accepted']} "
+                        f"rejected={simulator.stats['rejected']} callbacks_sent={scheduler.stats['sent']} "
+                        f"callback_errors={scheduler.stats['errors']} pending={scheduler.stats['pending']}"
+                    )
+
+        threading.Thread(target=report, daemon=True).start()
+        self.stdout.write(self.style.SUCCESS(
+            f"Prediction simulator listening on http://{options['host']}:{options['port']}{PREDICTION_PATH}"
+        ))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            stop.set()
+            server.server_close()
+            scheduler.stop()
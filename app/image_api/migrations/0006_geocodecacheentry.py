@@ -0,0 +1,30 @@
+# Generated by Django 5.2.6 on 2026-10-16 10:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('image_api', '0005_merge_20251019_1158'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GeocodeCacheEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(help_text='Нормализованный адрес или округлённые координаты', max_length=255, unique=True)),
+                ('kind', models.CharField(choices=[('forward', 'Forward'), ('reverse', 'Reverse')], max_length=10)),
+                ('found', models.BooleanField(default=True, help_text='False — отрицательный ответ (адрес не найден)')),
+                ('address', models.CharField(blank=True, max_length=500, null=True)),
+                ('lat', models.FloatField(blank=True, null=True)),
+                ('lon', models.FloatField(blank=True, null=True)),
+                ('expires_at', models.DateTimeField(db_index=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'db_table': 'geocode_cache',
+            },
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.2.6 on 2026-10-16 12:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('image_api', '0006_geocodecacheentry'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CallbackReceipt',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('task_id', models.CharField(max_length=64)),
+                ('callback_type', models.CharField(choices=[('main', 'Main'), ('trash', 'Trash')], max_length=10)),
+                ('payload_hash', models.CharField(help_text='SHA-256 канонического JSON тела запроса', max_length=64)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('done', 'Done')], default='pending', max_length=10)),
+                ('outcome', models.JSONField(blank=True, null=True)),
+                ('deliveries', models.PositiveIntegerField(default=1)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('completed_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'db_table': 'callback_receipts',
+                'constraints': [models.UniqueConstraint(fields=('task_id', 'callback_type', 'payload_hash'), name='unique_callback_delivery')],
+            },
+        ),
+    ]
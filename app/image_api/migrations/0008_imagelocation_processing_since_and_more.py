@@ -0,0 +1,34 @@
+# Generated by Django 5.2.6 on 2026-10-16 14:05
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+def backfill_processing_since(apps, schema_editor):
+    ImageLocation = apps.get_model('image_api', 'ImageLocation')
+    ImageLocation.objects.filter(status='processing').update(processing_since=models.F('created_at'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('image_api', '0007_callbackreceipt'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='imagelocation',
+            name='processing_since',
+            field=models.DateTimeField(blank=True, default=django.utils.timezone.now, null=True),
+        ),
+        migrations.AddField(
+            model_name='imagelocation',
+            name='dispatch_attempts',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_processing_since, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='imagelocation',
+            index=models.Index(condition=models.Q(('status', 'processing')), fields=['processing_since'], name='imageloc_processing_since_idx'),
+        ),
+    ]
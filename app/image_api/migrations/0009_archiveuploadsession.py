@@ -0,0 +1,39 @@
+# Generated by Django 5.2.6 on 2026-10-16 16:20
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('image_api', '0008_imagelocation_processing_since_and_more'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchiveUploadSession',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('filename', models.CharField(help_text='Ключ архива в S3', max_length=255)),
+                ('original_filename', models.CharField(max_length=255)),
+                ('upload_id', models.CharField(help_text='UploadId multipart-загрузки S3', max_length=255)),
+                ('total_size', models.BigIntegerField()),
+                ('chunk_size', models.PositiveIntegerField()),
+                ('offset', models.BigIntegerField(default=0)),
+                ('parts', models.JSONField(default=list)),
+                ('status', models.CharField(choices=[('uploading', 'Uploading'), ('completing', 'Completing'), ('completed', 'Completed'), ('aborted', 'Aborted')], default='uploading', max_length=10)),
+                ('metadata_filename', models.CharField(blank=True, max_length=255, null=True)),
+                ('metadata_s3_url', models.URLField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('archive', models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='upload_session', to='image_api.uploadedarchive')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'db_table': 'archive_upload_sessions',
+            },
+        ),
+    ]
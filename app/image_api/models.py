@@ -1,7 +1,9 @@
 from django.contrib.auth.models import User
 from django.conf import settings
-from django.db import models
+from django.db import models, transaction
+from django.utils import timezone
 from .services.s3_service import S3Service
+from .services.presign_service import get_presign_service
 import logging
 from django.db.models.signals import post_delete
 from django.dispatch import receiver
@@ -29,12 +31,18 @@ class UploadedImage(models.Model):
 @receiver(post_delete, sender=UploadedImage)
 def delete_file_from_s3(sender, instance, **kwargs):
     if instance.filename:
-        s3 = S3Service()
-        try:
-            s3.delete_file(instance.filename)
-        except Exception as e:
-            logger = logging.getLogger(__name__)
-            logger.error(f"Ошибка при удалении {instance.filename} из S3: {e}")
+        filename = instance.filename
+
+        def delete():
+            s3 = S3Service()
+            try:
+                s3.delete_file(filename)
+            except Exception as e:
+                logger = logging.getLogger(__name__)
+                logger.error(f"Ошибка при удалении {filename} из S3: {e}")
+
+        # Файл удаляется только после фиксации транзакции: при откате запись и файл остаются
+        transaction.on_commit(delete)
         
 class ImageLocation(models.Model):
     # Ссылка на пользователя
@@ -69,6 +77,11 @@ class ImageLocation(models.Model):
     lat = models.FloatField(null=True, blank=True)
     lon = models.FloatField(null=True, blank=True)
 
+    # Когда запись перешла в processing или была последний раз отправлена на распознавание
+    processing_since = models.DateTimeField(default=timezone.now, null=True, blank=True)
+    # Сколько раз зависшая запись отправлялась повторно (sweep_stale_locations_task)
+    dispatch_attempts = models.PositiveSmallIntegerField(default=0)
+
     # Время создания
     created_at = models.DateTimeField(auto_now_add=True)
 
@@ -76,6 +89,14 @@ class ImageLocation(models.Model):
         db_table = 'image_locations'
         verbose_name = 'Image Location'
         verbose_name_plural = 'Image Locations'
+        indexes = [
+            # Частичный индекс: поиск зависших записей не зависит от размера таблицы
+            models.Index(
+                fields=['processing_since'],
+                condition=models.Q(status='processing'),
+                name='imageloc_processing_since_idx'
+            ),
+        ]
 
     def __str__(self):
         return f"Location for {self.image.filename} - {self.status}"
@@ -101,7 +122,22 @@ class ImageLocation(models.Model):
         }
         return mapping.get(self.status, self.status)
     
-    def to_dict(self):
+    def presign_keys(self):
+        """
+        Ключи S3, для которых to_dict() строит presigned-ссылки
+        """
+        keys = [self.image.filename]
+        keys.extend(det.file.filename for det in self.detected_image_mappings.all())
+        return keys
+
+    def to_dict(self, presigned_urls=None):
+        """
+        presigned_urls — заранее подписанные ссылки {filename: url}
+        (см. PresignService.presign_many); без них ссылки подписываются по одной.
+        """
+        if presigned_urls is None:
+            presigned_urls = get_presign_service().presign_many(self.presign_keys())
+
         if self.lat is not None and self.lon is not None:
             main_coordinates = {"lat": self.lat, "lon": self.lon}
         else:
@@ -115,7 +151,7 @@ class ImageLocation(models.Model):
                     "id": det.file.id,
                     "filename": det.file.filename,
                     "file_path": det.file.s3_url or det.file.file_path,
-                    "preview_url": det.file.preview_url,
+                    "preview_url": presigned_urls.get(det.file.filename),
                     # "preview_url": self.preview_url,
                     # preview_url можно тоже добавить, если нужно
                 },
@@ -141,7 +177,7 @@ class ImageLocation(models.Model):
                 "id": self.image.id,
                 "filename": self.image.filename,
                 "file_path": self.file_path,
-                "preview_url": self.preview_url,
+                "preview_url": presigned_urls.get(self.image.filename),
             },
             "trash_images": trash_images,
         }
@@ -156,6 +192,51 @@ class UploadedArchive(models.Model):
     metadata_filename = models.CharField(max_length=255, null=True, blank=True)
     metadata_s3_url = models.URLField(null=True, blank=True)
 
+
+class ArchiveUploadSession(models.Model):
+    """
+    Возобновляемая загрузка архива частями.
+    Каждая часть клиента соответствует одной части multipart-загрузки S3;
+    offset — сколько байт уже принято, parts — [{'PartNumber', 'ETag'}].
+    """
+    STATUS_UPLOADING = 'uploading'
+    STATUS_COMPLETING = 'completing'
+    STATUS_COMPLETED = 'completed'
+    STATUS_ABORTED = 'aborted'
+
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
+    filename = models.CharField(max_length=255, help_text="Ключ архива в S3")
+    original_filename = models.CharField(max_length=255)
+    upload_id = models.CharField(max_length=255, help_text="UploadId multipart-загрузки S3")
+    total_size = models.BigIntegerField()
+    chunk_size = models.PositiveIntegerField()
+    offset = models.BigIntegerField(default=0)
+    parts = models.JSONField(default=list)
+    status = models.CharField(
+        max_length=10,
+        choices=[
+            (STATUS_UPLOADING, 'Uploading'),
+            (STATUS_COMPLETING, 'Completing'),
+            (STATUS_COMPLETED, 'Completed'),
+            (STATUS_ABORTED, 'Aborted'),
+        ],
+        default=STATUS_UPLOADING
+    )
+    metadata_filename = models.CharField(max_length=255, null=True, blank=True)
+    metadata_s3_url = models.URLField(null=True, blank=True)
+    archive = models.OneToOneField(
+        UploadedArchive,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='upload_session'
+    )
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        db_table = 'archive_upload_sessions'
+
 class DetectedImageLocation(models.Model):
     file = models.ForeignKey(
         'UploadedImage',
@@ -174,7 +255,10 @@ class DetectedImageLocation(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     address = models.CharField(max_length=500, null=True, blank=True)
 
-    def to_dict(self):
+    def to_dict(self, presigned_urls=None):
+        if presigned_urls is None:
+            presigned_urls = get_presign_service().presign_many([self.file.filename])
+
         return {
             'id': self.id,
             'image': {
@@ -183,7 +267,7 @@ class DetectedImageLocation(models.Model):
                 'original_filename': self.file.original_filename,
                 'file_path': self.file.file_path,
                 's3_url': self.file.s3_url,
-                'preview_url': self.file.preview_url,
+                'preview_url': presigned_urls.get(self.file.filename),
                 'uploaded_at': self.file.uploaded_at.isoformat(),
             },
             'image_location_id': self.image_location_id,
@@ -191,4 +275,73 @@ class DetectedImageLocation(models.Model):
             'lon': self.lon,
             'created_at': self.created_at.isoformat(),
             'address': self.address,
-        }
\ No newline at end of file
+        }
+
+class GeocodeCacheEntry(models.Model):
+    """
+    Постоянный (второй) уровень кеша геокодирования, общий для всех воркеров
+    """
+    KIND_FORWARD = 'forward'
+    KIND_REVERSE = 'reverse'
+
+    key = models.CharField(max_length=255, unique=True, help_text="Нормализованный адрес или округлённые координаты")
+    kind = models.CharField(
+        max_length=10,
+        choices=[
+            (KIND_FORWARD, 'Forward'),
+            (KIND_REVERSE, 'Reverse'),
+        ]
+    )
+    found = models.BooleanField(default=True, help_text="False — отрицательный ответ (адрес не найден)")
+    address = models.CharField(max_length=500, null=True, blank=True)
+    lat = models.FloatField(null=True, blank=True)
+    lon = models.FloatField(null=True, blank=True)
+    expires_at = models.DateTimeField(db_index=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        db_table = 'geocode_cache'
+
+
+class CallbackReceipt(models.Model):
+    """
+    Журнал принятых callback'ов сервиса распознавания.
+    Повторная доставка того же результата (TaskId, тип, хеш содержимого)
+    не применяется заново, а получает сохранённый итог обработки.
+    """
+    TYPE_MAIN = 'main'
+    TYPE_TRASH = 'trash'
+
+    STATUS_PENDING = 'pending'
+    STATUS_DONE = 'done'
+
+    task_id = models.CharField(max_length=64)
+    callback_type = models.CharField(
+        max_length=10,
+        choices=[
+            (TYPE_MAIN, 'Main'),
+            (TYPE_TRASH, 'Trash'),
+        ]
+    )
+    payload_hash = models.CharField(max_length=64, help_text="SHA-256 канонического JSON тела запроса")
+    status = models.CharField(
+        max_length=10,
+        choices=[
+            (STATUS_PENDING, 'Pending'),
+            (STATUS_DONE, 'Done'),
+        ],
+        default=STATUS_PENDING
+    )
+    outcome = models.JSONField(null=True, blank=True)
+    deliveries = models.PositiveIntegerField(default=1)
+    created_at = models.DateTimeField(auto_now_add=True)
+    completed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        db_table = 'callback_receipts'
+        constraints = [
+            models.UniqueConstraint(
+                fields=['task_id', 'callback_type', 'payload_hash'],
+                name='unique_callback_delivery'
+            ),
+        ]
@@ -1,5 +1,6 @@
+from django.conf import settings
 from rest_framework import serializers
-from .models import UploadedImage, ImageLocation, DetectedImageLocation
+from .models import UploadedImage, ImageLocation, DetectedImageLocation, ArchiveUploadSession
 
 
 class UploadedImageSerializer(serializers.ModelSerializer):
@@ -68,3 +69,91 @@ class ImageDataSerializer(serializers.Serializer):
 
 class UploadImagesRequestSerializer(serializers.Serializer):
     images_data = ImageDataSerializer(many=True)
+
+
+class DirectUploadFileSerializer(serializers.Serializer):
+    name = serializers.CharField(max_length=200)
+    content_type = serializers.CharField(required=False, allow_blank=True, max_length=100)
+    address = serializers.CharField(required=False, allow_null=True, allow_blank=True)
+    lat = serializers.FloatField(required=False, allow_null=True)
+    lon = serializers.FloatField(required=False, allow_null=True)
+    angle = serializers.FloatField(required=False, allow_null=True)
+    height = serializers.FloatField(required=False, allow_null=True)
+
+
+class DirectUploadRequestSerializer(serializers.Serializer):
+    files = DirectUploadFileSerializer(many=True, allow_empty=False)
+
+    def validate_files(self, value):
+        if len(value) > settings.DIRECT_UPLOAD_MAX_FILES:
+            raise serializers.ValidationError(
+                f"Too many files in one request: {len(value)} > {settings.DIRECT_UPLOAD_MAX_FILES}."
+            )
+        return value
+
+
+class DirectUploadFinalizeSerializer(serializers.Serializer):
+    upload_token = serializers.CharField()
+
+
+class ArchiveUploadSessionCreateSerializer(serializers.Serializer):
+    filename = serializers.CharField(max_length=200)
+    total_size = serializers.IntegerField(min_value=1)
+    # Тот же формат, что и JSON-файл метаданных upload-archive: [{"image": ..., ...}]
+    metadata = serializers.ListField(child=serializers.DictField(), required=False, allow_null=True)
+
+    def validate_total_size(self, value):
+        if value > settings.ARCHIVE_UPLOAD_MAX_SIZE:
+            raise serializers.ValidationError(
+                f"Archive is too large: {value} > {settings.ARCHIVE_UPLOAD_MAX_SIZE} bytes."
+            )
+        return value
+
+
+class ArchiveUploadSessionSerializer(serializers.ModelSerializer):
+    session_id = serializers.IntegerField(source='id', read_only=True)
+    archive_id = serializers.IntegerField(read_only=True, allow_null=True)
+
+    class Meta:
+        model = ArchiveUploadSession
+        fields = ['session_id', 'filename', 'original_filename', 'total_size', 'chunk_size', 'offset',
+                  'status', 'archive_id', 'created_at', 'updated_at']
+        read_only_fields = fields
+
+
+class MainResultSerializer(serializers.Serializer):
+    Latitude = serializers.FloatField(required=False, allow_null=True)
+    Longitude = serializers.FloatField(required=False, allow_null=True)
+
+
+class MainResultCallbackSerializer(serializers.Serializer):
+    # Длина ограничена полем CallbackReceipt.task_id
+    TaskId = serializers.CharField(max_length=64)
+    Status = serializers.CharField()
+    ErrorCode = serializers.CharField(required=False, allow_null=True, allow_blank=True)
+    ErrorMessage = serializers.CharField(required=False, allow_null=True, allow_blank=True)
+    Result = MainResultSerializer(required=False, allow_null=True)
+
+
+class TrashResultCallbackSerializer(serializers.Serializer):
+    TaskId = serializers.CharField(max_length=64)
+    Status = serializers.CharField()
+    ErrorCode = serializers.CharField(required=False, allow_null=True, allow_blank=True)
+    ErrorMessage = serializers.CharField(required=False, allow_null=True, allow_blank=True)
+    # Элементы без ImagePath/координат пропускаются при обработке, поэтому здесь не проверяются
+    Result = serializers.ListField(child=serializers.DictField(), required=False, allow_null=True)
+
+
+class BatchResultCallbackSerializer(serializers.Serializer):
+    Main = MainResultCallbackSerializer(many=True, required=False, default=list)
+    Trash = TrashResultCallbackSerializer(many=True, required=False, default=list)
+
+    def validate(self, attrs):
+        total = len(attrs["Main"]) + len(attrs["Trash"])
+        if total == 0:
+            raise serializers.ValidationError("At least one result is required.")
+        if total > settings.CALLBACK_BATCH_MAX_ITEMS:
+            raise serializers.ValidationError(
+                f"Too many results in one batch: {total} > {settings.CALLBACK_BATCH_MAX_ITEMS}."
+            )
+        return attrs
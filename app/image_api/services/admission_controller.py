@@ -0,0 +1,100 @@
+import json
+import logging
+from typing import Any, Dict, Iterable, List
+
+from django.conf import settings
+
+from image_api.services.prediction_batcher import PENDING_KEY, PredictionBatcher
+from image_api.services.redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+INFLIGHT_KEY = "prediction:inflight"
+
+# Атомарно освобождает просроченные слоты и переносит из буфера ожидающих
+# задач в «в работе» столько задач, сколько помещается в окно.
+# Время берётся у Redis, чтобы часы воркеров не влияли на таймауты.
+ADMIT_SCRIPT = """
+local window = tonumber(ARGV[1])
+local max_items = tonumber(ARGV[2])
+local timeout = tonumber(ARGV[3])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local expired = redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', now)
+local limit = max_items
+if window > 0 then
+    limit = math.min(limit, window - redis.call('ZCARD', KEYS[2]))
+end
+if limit <= 0 then
+    return {expired, {}}
+end
+local items = redis.call('LRANGE', KEYS[1], 0, limit - 1)
+if #items > 0 then
+    redis.call('LTRIM', KEYS[1], #items, -1)
+    for _, item in ipairs(items) do
+        redis.call('ZADD', KEYS[2], now + timeout, tostring(cjson.decode(item)['task_id']))
+    end
+end
+return {expired, items}
+"""
+
+
+class AdmissionController:
+    """
+    Ограничивает число задач, одновременно находящихся в сервисе распознавания.
+
+    Отправленные задачи хранятся в ZSET с крайним сроком ответа. Слот
+    освобождается, когда приходит основной или мусорный callback задачи,
+    когда сервис отклонил задачу, или по истечении PREDICTION_INFLIGHT_TIMEOUT.
+    Пока окно PREDICTION_INFLIGHT_WINDOW заполнено, новые задачи ждут в
+    буфере PredictionBatcher. PREDICTION_INFLIGHT_WINDOW = 0 снимает ограничение.
+    """
+
+    def __init__(self):
+        self.redis = get_redis()
+        self.window = settings.PREDICTION_INFLIGHT_WINDOW
+        self.timeout = settings.PREDICTION_INFLIGHT_TIMEOUT
+        self._admit_script = None
+
+    def admit(self, max_items: int) -> List[Dict[str, Any]]:
+        """
+        Забирает из буфера не больше max_items задач, помещающихся в окно, и занимает для них слоты
+        """
+        if self._admit_script is None:
+            self._admit_script = self.redis.register_script(ADMIT_SCRIPT)
+        expired, items = self._admit_script(
+            keys=[PENDING_KEY, INFLIGHT_KEY],
+            args=[self.window, max_items, self.timeout]
+        )
+        if expired:
+            logger.warning(f"{expired} prediction tasks timed out without a callback, slots released")
+        return [json.loads(item) for item in items]
+
+    def release(self, task_ids: Iterable[Any]) -> int:
+        """
+        Освобождает слоты задач. Если освободилось место, а в буфере есть задачи, запускает отправку
+        """
+        members = [str(task_id) for task_id in task_ids]
+        if not members:
+            return 0
+        released = self.redis.zrem(INFLIGHT_KEY, *members)
+        if released:
+            batcher = PredictionBatcher()
+            if batcher.size():
+                batcher.kick_flush()
+        return released
+
+    def in_flight(self) -> int:
+        return self.redis.zcard(INFLIGHT_KEY)
+
+    def get_stats(self) -> dict:
+        """
+        Заполнение окна и глубина очереди ожидающих задач
+        """
+        in_flight = self.in_flight()
+        return {
+            "window": self.window,
+            "in_flight": in_flight,
+            "available": max(self.window - in_flight, 0) if self.window > 0 else None,
+            "held": PredictionBatcher().size(),
+        }
@@ -1,14 +1,37 @@
+import json
+import math
+import os
+import shutil
+import tempfile
 import uuid
 import zipfile
 import io
 import logging
+from datetime import timedelta
 from django.conf import settings
-from .s3_service import S3Service
-from image_api.models import UploadedArchive
+from django.db import transaction
+from django.utils import timezone
+from .s3_service import S3Service, MIN_MULTIPART_PART_SIZE
+from image_api.models import UploadedArchive, ArchiveUploadSession
 from image_api.tasks import process_archive_task
 
 logger = logging.getLogger(__name__)
 
+# Предел S3 на число частей одной multipart-загрузки
+MAX_MULTIPART_PARTS = 10000
+
+
+class UploadSessionError(Exception):
+    """
+    Ошибка возобновляемой загрузки; status_code — HTTP-статус ответа клиенту
+    """
+
+    def __init__(self, message, status_code=400, offset=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.offset = offset
+
+
 class ArchiveUploadService:
     def __init__(self, user):
         self.user = user
@@ -17,29 +40,22 @@ class ArchiveUploadService:
     def upload_archive(self, archive_file, metadata_file=None):
         # Загружаем архив
         archive_filename = f"archives/{uuid.uuid4()}_{archive_file.name}"
-        archive_content = archive_file.read()
 
-        success = self.s3_service.upload_file(archive_filename, archive_content, content_type="application/zip")
+        # Архив читается частями и не буферизуется в памяти целиком
+        success = self.s3_service.upload_fileobj_multipart(archive_filename, archive_file, content_type="application/zip")
         if not success:
             raise Exception("Failed to upload archive to S3")
 
-        archive_s3_url = self.s3_service.generate_file_url(archive_filename)
-
         metadata_filename = None
         metadata_s3_url = None
 
         if metadata_file:
-            metadata_filename = f"archives/{uuid.uuid4()}_{metadata_file.name}"
-            metadata_content = metadata_file.read()
-            success = self.s3_service.upload_file(metadata_filename, metadata_content, content_type="application/json")
-            if not success:
-                raise Exception("Failed to upload metadata JSON to S3")
-            metadata_s3_url = self.s3_service.generate_file_url(metadata_filename)
+            metadata_filename, metadata_s3_url = self._upload_metadata(metadata_file.name, metadata_file.read())
 
         archive = UploadedArchive.objects.create(
             filename=archive_filename,
             original_filename=archive_file.name,
-            s3_url=archive_s3_url,
+            s3_url=self.s3_service.generate_file_url(archive_filename),
             user=self.user,
             metadata_filename=metadata_filename,
             metadata_s3_url=metadata_s3_url
@@ -48,3 +64,224 @@ class ArchiveUploadService:
         # Задачу в очередь
         process_archive_task.delay(archive.id)
         return archive
+
+    def _upload_metadata(self, name, content):
+        metadata_filename = f"archives/{uuid.uuid4()}_{name}"
+        success = self.s3_service.upload_file(metadata_filename, content, content_type="application/json")
+        if not success:
+            raise Exception("Failed to upload metadata JSON to S3")
+        return metadata_filename, self.s3_service.generate_file_url(metadata_filename)
+
+    # --- Возобновляемая загрузка частями ---
+
+    def create_session(self, name, total_size, metadata=None):
+        """
+        Начинает multipart-загрузку архива размером total_size байт.
+        Размер части выбирается сервером: не меньше ARCHIVE_UPLOAD_CHUNK_SIZE
+        и такой, чтобы архив уложился в 10000 частей S3. Если начать загрузку
+        не удалось, уже созданные в S3 загрузка и метаданные удаляются
+        """
+        if total_size > settings.ARCHIVE_UPLOAD_MAX_SIZE:
+            raise UploadSessionError(f"Archive is too large: {total_size} > {settings.ARCHIVE_UPLOAD_MAX_SIZE} bytes")
+        chunk_size = max(settings.ARCHIVE_UPLOAD_CHUNK_SIZE, MIN_MULTIPART_PART_SIZE)
+        if total_size > chunk_size * MAX_MULTIPART_PARTS:
+            # Округляем вверх до целого мегабайта
+            chunk_size = math.ceil(total_size / MAX_MULTIPART_PARTS / (1024 * 1024)) * 1024 * 1024
+
+        # Клиент не управляет раскладкой ключей: оставляем только имя файла
+        name = os.path.basename(name.replace("\\", "/")).strip() or "archive.zip"
+
+        filename = f"archives/{uuid.uuid4()}_{name}"
+        upload_id = self.s3_service.create_multipart_upload(filename, content_type="application/zip")
+
+        metadata_filename = None
+        metadata_s3_url = None
+        try:
+            if metadata is not None:
+                metadata_filename, metadata_s3_url = self._upload_metadata(
+                    "metadata.json", json.dumps(metadata, ensure_ascii=False).encode("utf-8")
+                )
+            return ArchiveUploadSession.objects.create(
+                user=self.user,
+                filename=filename,
+                original_filename=name,
+                upload_id=upload_id,
+                total_size=total_size,
+                chunk_size=chunk_size,
+                metadata_filename=metadata_filename,
+                metadata_s3_url=metadata_s3_url,
+            )
+        except Exception:
+            # Без сессии эти объекты не найдёт ни клиент, ни expire_stale_sessions
+            self.s3_service.abort_multipart_upload(filename, upload_id)
+            if metadata_filename:
+                self.s3_service.delete_file(metadata_filename)
+            raise
+
+    def get_session(self, session_id):
+        try:
+            return ArchiveUploadSession.objects.get(id=session_id, user=self.user)
+        except ArchiveUploadSession.DoesNotExist:
+            raise UploadSessionError("Upload session not found", status_code=404)
+
+    def upload_chunk(self, session_id, offset, stream, content_length):
+        """
+        Принимает часть архива, начинающуюся с offset, и загружает её как часть S3.
+
+        Части принимаются строго по порядку; каждая, кроме последней, ровно
+        chunk_size байт. Часть загружается в S3 вне транзакции, а смещение
+        сдвигается короткой транзакцией с блокировкой сессии. Повтор той же
+        части после обрыва перезаписывает её в S3 под тем же номером.
+        Тело читается во временный файл (в памяти до FILE_UPLOAD_MAX_MEMORY_SIZE).
+        """
+        session = self.get_session(session_id)
+        if session.status != ArchiveUploadSession.STATUS_UPLOADING:
+            raise UploadSessionError(f"Upload session is {session.status}", status_code=409, offset=session.offset)
+        if offset != session.offset or offset % session.chunk_size:
+            raise UploadSessionError("Offset mismatch", status_code=409, offset=session.offset)
+
+        expected = min(session.chunk_size, session.total_size - offset)
+        if expected <= 0:
+            raise UploadSessionError("Upload is already complete", status_code=409, offset=session.offset)
+        if content_length != expected:
+            raise UploadSessionError(f"Chunk must be exactly {expected} bytes", offset=session.offset)
+
+        part_number = offset // session.chunk_size + 1
+        with tempfile.SpooledTemporaryFile(max_size=settings.FILE_UPLOAD_MAX_MEMORY_SIZE) as body:
+            shutil.copyfileobj(stream, body, 1024 * 1024)
+            if body.tell() != expected:
+                raise UploadSessionError(f"Chunk must be exactly {expected} bytes", offset=session.offset)
+            body.seek(0)
+            try:
+                etag = self.s3_service.upload_part(session.filename, session.upload_id, part_number, body)
+            except Exception as e:
+                logger.error(f"Failed to upload part {part_number} of {session.filename}: {str(e)}")
+                raise UploadSessionError("Failed to upload chunk to S3", status_code=502, offset=session.offset)
+
+        with transaction.atomic():
+            session = ArchiveUploadSession.objects.select_for_update().get(id=session.id)
+            # Параллельный запрос с той же частью мог успеть раньше
+            if session.status != ArchiveUploadSession.STATUS_UPLOADING or session.offset != offset:
+                raise UploadSessionError("Offset mismatch", status_code=409, offset=session.offset)
+            session.parts.append({"PartNumber": part_number, "ETag": etag})
+            session.offset = offset + expected
+            session.save(update_fields=["parts", "offset", "updated_at"])
+        return session
+
+    def complete_session(self, session_id):
+        """
+        Завершает multipart-загрузку, создаёт UploadedArchive и ставит его в
+        обработку. Повторный вызов для завершённой сессии возвращает тот же архив.
+
+        Сессия, оставшаяся в completing дольше ARCHIVE_UPLOAD_COMPLETE_TIMEOUT
+        (процесс упал или запись архива не удалась), завершается повторно:
+        если объект уже собран в S3, архив создаётся без повторного завершения.
+        """
+        with transaction.atomic():
+            session = ArchiveUploadSession.objects.select_for_update().get(id=self.get_session(session_id).id)
+            if session.status == ArchiveUploadSession.STATUS_COMPLETED:
+                return session.archive
+            if session.status == ArchiveUploadSession.STATUS_COMPLETING:
+                stale_after = timezone.now() - timedelta(seconds=settings.ARCHIVE_UPLOAD_COMPLETE_TIMEOUT)
+                if session.updated_at > stale_after:
+                    raise UploadSessionError("Upload is being completed", status_code=409, offset=session.offset)
+                logger.warning(f"Resuming stale completion of upload session {session.id}")
+            elif session.status != ArchiveUploadSession.STATUS_UPLOADING:
+                raise UploadSessionError(f"Upload session is {session.status}", status_code=409, offset=session.offset)
+            if session.offset != session.total_size:
+                raise UploadSessionError("Upload is not finished", status_code=409, offset=session.offset)
+            # Отметка не даёт двум запросам одновременно завершать загрузку в S3
+            session.status = ArchiveUploadSession.STATUS_COMPLETING
+            session.save(update_fields=["status", "updated_at"])
+
+        if not self._is_assembled(session):
+            try:
+                self.s3_service.complete_multipart_upload(session.filename, session.upload_id, session.parts)
+            except Exception as e:
+                logger.error(f"Failed to complete multipart upload for {session.filename}: {str(e)}")
+                # S3 мог завершить загрузку, хотя ответ не дошёл (таймаут)
+                if not self._is_assembled(session):
+                    session.status = ArchiveUploadSession.STATUS_UPLOADING
+                    session.save(update_fields=["status", "updated_at"])
+                    raise UploadSessionError("Failed to complete upload in S3", status_code=502, offset=session.offset)
+
+        with transaction.atomic():
+            session = ArchiveUploadSession.objects.select_for_update().get(id=session.id)
+            if session.status == ArchiveUploadSession.STATUS_COMPLETED:
+                return session.archive
+            if session.status != ArchiveUploadSession.STATUS_COMPLETING:
+                raise UploadSessionError(f"Upload session is {session.status}", status_code=409, offset=session.offset)
+            archive = UploadedArchive.objects.create(
+                filename=session.filename,
+                original_filename=session.original_filename,
+                s3_url=self.s3_service.generate_file_url(session.filename),
+                user=self.user,
+                metadata_filename=session.metadata_filename,
+                metadata_s3_url=session.metadata_s3_url
+            )
+            session.archive = archive
+            session.status = ArchiveUploadSession.STATUS_COMPLETED
+            session.save(update_fields=["archive", "status", "updated_at"])
+            transaction.on_commit(lambda: process_archive_task.delay(archive.id))
+        return archive
+
+    def _is_assembled(self, session):
+        """
+        Объект архива уже собран в S3 целиком
+        """
+        return self.s3_service.head_file(session.filename) == session.total_size
+
+    def abort_session(self, session_id):
+        """
+        Отменяет незавершённую загрузку и освобождает уже загруженные части в S3
+        """
+        with transaction.atomic():
+            session = ArchiveUploadSession.objects.select_for_update().get(id=self.get_session(session_id).id)
+            if session.status != ArchiveUploadSession.STATUS_UPLOADING:
+                raise UploadSessionError(f"Upload session is {session.status}", status_code=409, offset=session.offset)
+            session.status = ArchiveUploadSession.STATUS_ABORTED
+            session.save(update_fields=["status", "updated_at"])
+
+        self.s3_service.abort_multipart_upload(session.filename, session.upload_id)
+        if session.metadata_filename:
+            self.s3_service.delete_file(session.metadata_filename)
+        return session
+
+
+def expire_stale_sessions():
+    """
+    Отменяет загрузки, которые не менялись дольше ARCHIVE_UPLOAD_SESSION_MAX_AGE:
+    освобождает части multipart-загрузки (S3 хранит и тарифицирует их до отмены),
+    удаляет собранный, но не зарегистрированный объект архива и метаданные.
+    Возвращает число отменённых сессий
+    """
+    cutoff = timezone.now() - timedelta(seconds=settings.ARCHIVE_UPLOAD_SESSION_MAX_AGE)
+    stale_statuses = (ArchiveUploadSession.STATUS_UPLOADING, ArchiveUploadSession.STATUS_COMPLETING)
+    s3_service = S3Service()
+    expired = 0
+
+    stale_ids = list(
+        ArchiveUploadSession.objects
+        .filter(status__in=stale_statuses, updated_at__lt=cutoff)
+        .values_list("id", flat=True)[:settings.ARCHIVE_UPLOAD_CLEANUP_BATCH_SIZE]
+    )
+    for session_id in stale_ids:
+        with transaction.atomic():
+            session = ArchiveUploadSession.objects.select_for_update().get(id=session_id)
+            # Сессию могли завершить или продолжить после выборки
+            if session.status not in stale_statuses or session.updated_at >= cutoff:
+                continue
+            was_completing = session.status == ArchiveUploadSession.STATUS_COMPLETING
+            session.status = ArchiveUploadSession.STATUS_ABORTED
+            session.save(update_fields=["status", "updated_at"])
+
+        s3_service.abort_multipart_upload(session.filename, session.upload_id)
+        if was_completing:
+            s3_service.delete_file(session.filename)
+        if session.metadata_filename:
+            s3_service.delete_file(session.metadata_filename)
+        expired += 1
+
+    if expired:
+        logger.warning(f"Expired {expired} stale archive upload sessions")
+    return expired
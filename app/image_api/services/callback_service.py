@@ -0,0 +1,387 @@
+import os
+import json
+import hashlib
+import logging
+from typing import Any, Dict, List, Optional, Tuple
+
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from image_api.models import ImageLocation, UploadedImage, DetectedImageLocation, CallbackReceipt
+from image_api.services.geocoding_service import GeocodingService
+from image_api.services.geocoding_queue import PRIORITY_LOW, PRIORITY_NORMAL
+
+logger = logging.getLogger(__name__)
+
+OUTCOME_DONE = "done"
+OUTCOME_FAILED = "failed"
+OUTCOME_NOT_FOUND = "not_found"
+
+
+def payload_digest(payload: Dict[str, Any]) -> str:
+    """
+    SHA-256 канонического JSON (ключи отсортированы, без пробелов)
+    """
+    canonical = json.dumps(payload, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class CallbackService:
+    """
+    Применяет результаты сервиса распознавания к ImageLocation.
+    Вызывается из воркеров очереди callbacks; возвращает итог обработки
+    в виде словаря {'outcome', 'message', ...}.
+
+    Каждая доставка регистрируется в CallbackReceipt по ключу
+    (TaskId, тип callback'а, хеш содержимого): повторы не применяются
+    повторно, а получают сохранённый итог.
+    """
+
+    def register_delivery(self, callback_type: str, payload: Dict[str, Any]) -> Tuple[CallbackReceipt, bool]:
+        """
+        Регистрирует доставку callback'а. Возвращает (квитанция, новая ли доставка).
+        Параллельные доставки одного результата безопасны: вставку выполняет
+        get_or_create, а конфликт по уникальному ключу превращается в чтение.
+        """
+        receipt, created = CallbackReceipt.objects.get_or_create(
+            task_id=str(payload.get("TaskId")),
+            callback_type=callback_type,
+            payload_hash=payload_digest(payload),
+        )
+        if not created:
+            CallbackReceipt.objects.filter(id=receipt.id).update(deliveries=F("deliveries") + 1)
+            logger.info(f"Duplicate {callback_type} callback for TaskId {receipt.task_id} (receipt {receipt.id})")
+        return receipt, created
+
+    def process(self, callback_type: str, payload: Dict[str, Any], receipt_id: Optional[int] = None) -> Dict[str, Any]:
+        """
+        Применяет callback не более одного раза на квитанцию и сохраняет итог
+        """
+        apply = self.apply_main_result if callback_type == CallbackReceipt.TYPE_MAIN else self.apply_trash_result
+        if receipt_id is None:
+            return apply(payload)
+
+        with transaction.atomic():
+            # Блокировка строки не даёт двум воркерам применить одну доставку одновременно
+            receipt = CallbackReceipt.objects.select_for_update().filter(id=receipt_id).first()
+            if receipt is not None and receipt.status == CallbackReceipt.STATUS_DONE:
+                logger.info(f"Callback receipt {receipt_id} already applied, skipping")
+                return receipt.outcome
+
+            outcome = apply(payload)
+
+            if receipt is not None:
+                receipt.status = CallbackReceipt.STATUS_DONE
+                receipt.outcome = outcome
+                receipt.completed_at = timezone.now()
+                receipt.save(update_fields=["status", "outcome", "completed_at"])
+        return outcome
+
+    @staticmethod
+    def _get_location(task_id) -> Optional[ImageLocation]:
+        """
+        ImageLocation по TaskId; нечисловой TaskId считается ненайденной записью
+        """
+        if not str(task_id).isdigit():
+            return None
+        return ImageLocation.objects.filter(id=int(task_id)).first()
+
+    def apply_main_result(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Основной результат: статус задачи и координаты места съёмки
+        """
+        task_id = payload.get("TaskId")
+
+        image_location = self._get_location(task_id)
+        if image_location is None:
+            logger.warning(f"ImageLocation with id={task_id} not found")
+            return {"outcome": OUTCOME_NOT_FOUND, "message": f"ImageLocation with id={task_id} not found"}
+
+        address = image_location.address
+        outcome = self._apply_main_to(image_location, payload)
+        image_location.save(update_fields=["status", "lat", "lon"])
+
+        # Адрес определяется в фоне через очередь геокодирования
+        if self._needs_address(image_location, payload, address):
+            transaction.on_commit(lambda: GeocodingService().submit_reverse(
+                image_location.lat, image_location.lon,
+                {"type": "image_location", "id": image_location.id},
+                PRIORITY_NORMAL
+            ))
+
+        return outcome
+
+    @staticmethod
+    def _apply_main_to(image_location: ImageLocation, payload: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Переносит основной результат в объект ImageLocation без сохранения
+        """
+        status_response = payload.get("Status")
+        result = payload.get("Result") or {}
+
+        # Обновляем статус в зависимости от ответа
+        if status_response == "Succeeded":
+            image_location.status = "done"
+        elif status_response == "Failed":
+            image_location.status = "failed"
+
+        # Обновляем координаты, если статус успешный
+        if status_response == "Succeeded":
+            latitude = result.get("Latitude")
+            longitude = result.get("Longitude")
+            if latitude is not None and image_location.lat is None:
+                image_location.lat = latitude
+            if longitude is not None and image_location.lon is None:
+                image_location.lon = longitude
+
+        return {
+            "outcome": OUTCOME_DONE,
+            "message": f"Updated record {payload.get('TaskId')}",
+            "new_status": image_location.status,
+        }
+
+    @staticmethod
+    def _needs_address(image_location: ImageLocation, payload: Dict[str, Any], address: Optional[str]) -> bool:
+        return payload.get("Status") == "Succeeded" and address is None \
+            and image_location.lat is not None and image_location.lon is not None
+
+    def apply_trash_result(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Результат поиска мусора: изображения с обнаруженными объектами и их координаты
+        """
+        task_id = payload.get("TaskId")
+        status_response = payload.get("Status")
+
+        image_location = self._get_location(task_id)
+        if image_location is None:
+            logger.warning(f"ImageLocation с id {task_id} не найден.")
+            return {"outcome": OUTCOME_NOT_FOUND, "message": f"ImageLocation с id {task_id} не найден."}
+
+        if status_response != "Succeeded":
+            outcome = self._apply_trash_failure_to(image_location, payload)
+            image_location.save(update_fields=["status", "error_reason"])
+            return outcome
+
+        # Собираем все записи в памяти и вставляем их пачкой в одной транзакции
+        uploaded_images, points = self._build_trash_rows(image_location, payload.get("Result") or [])
+
+        with transaction.atomic():
+            # PostgreSQL возвращает первичные ключи вставленных строк
+            UploadedImage.objects.bulk_create(uploaded_images)
+            detected_locations = DetectedImageLocation.objects.bulk_create([
+                DetectedImageLocation(
+                    file=uploaded_image,
+                    image_location=image_location,
+                    lat=latitude,
+                    lon=longitude,
+                    address="",
+                )
+                for uploaded_image, (latitude, longitude) in zip(uploaded_images, points)
+            ])
+
+            image_location.status = "done"
+            image_location.save(update_fields=["status"])
+
+            # Адреса обнаруженных объектов определяются в фоне через очередь геокодирования
+            pending_addresses = [
+                (det.lat, det.lon, {"type": "detected_location", "id": det.id})
+                for det in detected_locations
+            ]
+            transaction.on_commit(
+                lambda: GeocodingService().submit_reverse_many(pending_addresses, PRIORITY_LOW)
+            )
+
+        processed_count = len(detected_locations)
+        logger.info(f"Создано {processed_count} DetectedImageLocation для TaskId {task_id}")
+        return {
+            "outcome": OUTCOME_DONE,
+            "message": f"Успешно обработано {processed_count} элементов.",
+            "processed": processed_count,
+        }
+
+    @staticmethod
+    def _apply_trash_failure_to(image_location: ImageLocation, payload: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Переносит неуспешный результат поиска мусора в объект ImageLocation без сохранения
+        """
+        error_message = payload.get("ErrorMessage")
+        image_location.status = "failed"
+        image_location.error_reason = error_message
+        return {
+            "outcome": OUTCOME_FAILED,
+            "message": f"Задача завершилась со статусом {payload.get('Status')}. Ошибка: {error_message}",
+        }
+
+    @staticmethod
+    def _build_trash_rows(image_location: ImageLocation, result_array: List[Dict[str, Any]]):
+        """
+        Строит несохранённые UploadedImage и координаты обнаруженных объектов
+        """
+        uploaded_images = []
+        points = []
+        for item in result_array:
+            image_path = item.get("ImagePath")
+            latitude = item.get("Latitude")
+            longitude = item.get("Longitude")
+
+            if not image_path or latitude is None or longitude is None:
+                logger.warning(f"Пропускаем элемент в Result из-за отсутствия данных: {item}")
+                continue
+
+            filename = os.path.basename(image_path)
+            uploaded_images.append(UploadedImage(
+                filename=filename,
+                original_filename=filename,
+                file_path=image_path,
+                s3_url=image_path,
+                user_id=image_location.user_id
+            ))
+            points.append((latitude, longitude))
+        return uploaded_images, points
+
+    def apply_batch(self, main_payloads: List[Dict[str, Any]],
+                    trash_payloads: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Применяет пачку результатов сервиса распознавания за одну транзакцию.
+
+        Доставки регистрируются в CallbackReceipt одним INSERT; уже применённые
+        получают сохранённый итог. Записи ImageLocation читаются одним запросом
+        с блокировкой строк и обновляются одним bulk_update, изображения и обнаруженные объекты
+        создаются через bulk_create. Основные результаты применяются раньше
+        результатов поиска мусора той же задачи. Возвращает итоги по каждому
+        элементу в порядке main, затем trash.
+        """
+        deliveries = [
+            (CallbackReceipt.TYPE_MAIN, payload, payload_digest(payload)) for payload in main_payloads
+        ] + [
+            (CallbackReceipt.TYPE_TRASH, payload, payload_digest(payload)) for payload in trash_payloads
+        ]
+
+        def receipt_key(callback_type, payload, digest):
+            return str(payload.get("TaskId")), callback_type, digest
+
+        keys = {receipt_key(*delivery) for delivery in deliveries}
+        task_ids = {task_id for task_id, _, _ in keys}
+
+        outcomes = [None] * len(deliveries)
+        first_index = {}
+        to_apply = []
+
+        with transaction.atomic():
+            existing = self._select_receipts(task_ids, keys, lock=False)
+            if existing:
+                CallbackReceipt.objects.filter(id__in=[r.id for r in existing.values()]) \
+                    .update(deliveries=F("deliveries") + 1)
+            CallbackReceipt.objects.bulk_create(
+                [CallbackReceipt(task_id=task_id, callback_type=callback_type, payload_hash=digest)
+                 for task_id, callback_type, digest in keys - existing.keys()],
+                ignore_conflicts=True,
+            )
+            # Блокировка квитанций не даёт параллельной пачке или воркеру применить их одновременно
+            receipts = self._select_receipts(task_ids, keys, lock=True)
+
+            for index, delivery in enumerate(deliveries):
+                key = receipt_key(*delivery)
+                if key in first_index:
+                    continue
+                first_index[key] = index
+                receipt = receipts[key]
+                if receipt.status == CallbackReceipt.STATUS_DONE:
+                    outcomes[index] = receipt.outcome
+                else:
+                    to_apply.append((index, delivery[0], delivery[1], receipt))
+
+            location_ids = {int(p["TaskId"]) for _, _, p, _ in to_apply if str(p.get("TaskId")).isdigit()}
+            # Записи блокируются до bulk_update, чтобы параллельный process() той же записи
+            # не был перезаписан устаревшими данными; порядок по id исключает взаимные блокировки
+            locations = {
+                loc.id: loc
+                for loc in ImageLocation.objects.select_for_update().filter(id__in=location_ids).order_by("id")
+            }
+            initial_addresses = {pk: loc.address for pk, loc in locations.items()}
+
+            uploaded_images = []
+            detected = []
+            pending_addresses = []
+            for index, callback_type, payload, receipt in to_apply:
+                task_id = str(payload.get("TaskId"))
+                image_location = locations.get(int(task_id)) if task_id.isdigit() else None
+                if image_location is None:
+                    logger.warning(f"ImageLocation with id={task_id} not found")
+                    outcome = {"outcome": OUTCOME_NOT_FOUND, "message": f"ImageLocation with id={task_id} not found"}
+                elif callback_type == CallbackReceipt.TYPE_MAIN:
+                    outcome = self._apply_main_to(image_location, payload)
+                    if self._needs_address(image_location, payload, initial_addresses[image_location.id]):
+                        pending_addresses.append(image_location)
+                elif payload.get("Status") != "Succeeded":
+                    outcome = self._apply_trash_failure_to(image_location, payload)
+                else:
+                    images, points = self._build_trash_rows(image_location, payload.get("Result") or [])
+                    uploaded_images.extend(images)
+                    detected.extend(
+                        (image_location, image, lat, lon) for image, (lat, lon) in zip(images, points)
+                    )
+                    image_location.status = "done"
+                    outcome = {
+                        "outcome": OUTCOME_DONE,
+                        "message": f"Успешно обработано {len(images)} элементов.",
+                        "processed": len(images),
+                    }
+                outcomes[index] = outcome
+                receipt.outcome = outcome
+                receipt.status = CallbackReceipt.STATUS_DONE
+                receipt.completed_at = timezone.now()
+
+            # PostgreSQL возвращает первичные ключи вставленных строк
+            UploadedImage.objects.bulk_create(uploaded_images)
+            detected_locations = DetectedImageLocation.objects.bulk_create([
+                DetectedImageLocation(file=image, image_location=image_location, lat=lat, lon=lon, address="")
+                for image_location, image, lat, lon in detected
+            ])
+            ImageLocation.objects.bulk_update(list(locations.values()), ["status", "lat", "lon", "error_reason"])
+            CallbackReceipt.objects.bulk_update(
+                [receipt for _, _, _, receipt in to_apply], ["status", "outcome", "completed_at"]
+            )
+
+            # Адреса определяются в фоне через очередь геокодирования
+            main_points = [
+                (loc.lat, loc.lon, {"type": "image_location", "id": loc.id}) for loc in pending_addresses
+            ]
+            detected_points = [
+                (det.lat, det.lon, {"type": "detected_location", "id": det.id}) for det in detected_locations
+            ]
+
+            def submit_geocoding():
+                service = GeocodingService()
+                service.submit_reverse_many(main_points, PRIORITY_NORMAL)
+                service.submit_reverse_many(detected_points, PRIORITY_LOW)
+
+            transaction.on_commit(submit_geocoding)
+
+        logger.info(f"Applied callback batch: {len(to_apply)} of {len(deliveries)} deliveries")
+
+        applied = {index for index, _, _, _ in to_apply}
+        results = []
+        for index, delivery in enumerate(deliveries):
+            key = receipt_key(*delivery)
+            results.append({
+                "task_id": key[0],
+                "type": delivery[0],
+                "duplicate": index not in applied,
+                **(outcomes[first_index[key]] or {}),
+            })
+        return results
+
+    @staticmethod
+    def _select_receipts(task_ids, keys, lock: bool) -> Dict[tuple, CallbackReceipt]:
+        queryset = CallbackReceipt.objects.filter(task_id__in=task_ids)
+        if lock:
+            # Единый порядок блокировки исключает взаимные блокировки параллельных пачек
+            queryset = queryset.select_for_update().order_by("id")
+        receipts = {}
+        for receipt in queryset:
+            key = (receipt.task_id, receipt.callback_type, receipt.payload_hash)
+            if key in keys:
+                receipts[key] = receipt
+        return receipts
@@ -0,0 +1,155 @@
+import logging
+import os
+import uuid
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core import signing
+from django.db import DatabaseError, transaction
+
+from image_api.models import UploadedImage
+from image_api.services.image_upload_service import ImageUploadService
+from image_api.services.s3_service import S3Service
+
+logger = logging.getLogger(__name__)
+
+TOKEN_SALT = "image_api.direct_upload"
+
+# Метаданные файла, которые переносятся из запроса ссылок в ImageLocation
+META_FIELDS = ("address", "lat", "lon", "angle", "height")
+
+
+class DirectUploadService:
+    """
+    Загрузка изображений клиентом напрямую в S3, минуя веб-сервер.
+
+    Первый шаг (issue) выбирает ключи объектов и выдаёт presigned PUT-ссылки
+    вместе с подписанным токеном, в котором перечислены ключи и метаданные
+    файлов. Второй шаг (verify_uploads, finalize) проверяет токен и наличие
+    объектов HEAD-запросами и регистрирует записи так же, как обычная загрузка.
+    Повторное подтверждение того же токена возвращает уже созданные записи.
+    """
+
+    def __init__(self, user):
+        self.user = user
+        self.s3_service = S3Service()
+
+    @staticmethod
+    def _safe_name(name: str, index: int) -> str:
+        # Клиент не управляет раскладкой ключей: оставляем только имя файла
+        return os.path.basename(name.replace("\\", "/")).strip() or f"file_{index}"
+
+    def issue(self, files):
+        """
+        Выдаёт ссылки на загрузку для файлов вида {'name', 'content_type', 'address', ...}.
+        Возвращает {'upload_token', 'expires_in', 'uploads'} или None, если ссылку подписать не удалось
+        """
+        expires_in = settings.DIRECT_UPLOAD_URL_EXPIRES
+        uploads, manifest = [], []
+        for i, item in enumerate(files):
+            original_filename = self._safe_name(item["name"], i)
+            filename = f"{uuid.uuid4()}_{original_filename}"
+            url = self.s3_service.generate_upload_url(filename, expires_in)
+            if url is None:
+                return None
+
+            uploads.append({
+                "file_index": i,
+                "filename": original_filename,
+                "key": filename,
+                "url": url,
+                "method": "PUT",
+                "headers": {"Content-Type": item.get("content_type") or "application/octet-stream"},
+            })
+            manifest.append({
+                "index": i,
+                "filename": filename,
+                "original_filename": original_filename,
+                **{field: item.get(field) for field in META_FIELDS},
+            })
+
+        token = signing.dumps({"user": self.user.pk, "files": manifest}, salt=TOKEN_SALT, compress=True)
+        return {"upload_token": token, "expires_in": expires_in, "uploads": uploads}
+
+    def load_manifest(self, token: str):
+        """
+        Возвращает список файлов из токена или None, если токен подделан, просрочен или выдан другому пользователю
+        """
+        try:
+            data = signing.loads(token, salt=TOKEN_SALT, max_age=settings.DIRECT_UPLOAD_TOKEN_MAX_AGE)
+        except signing.BadSignature:
+            return None
+        if data.get("user") != self.user.pk:
+            return None
+        return data["files"]
+
+    def verify_uploads(self, manifest):
+        """
+        Проверяет, что все объекты из токена загружены.
+        Возвращает (uploaded_files, validation_errors); uploaded_files в формате
+        S3Service.batch_upload. Слишком большие объекты удаляются из S3
+        """
+        filenames = [entry["filename"] for entry in manifest]
+        sizes = self.s3_service.batch_head(filenames)
+
+        uploaded_files, validation_errors, oversized = [], [], []
+        for entry in manifest:
+            filename = entry["filename"]
+            size = sizes.get(filename)
+            error = None
+            if size is None:
+                error = "File was not uploaded"
+            elif size == 0:
+                error = "Empty file"
+            elif size > settings.DIRECT_UPLOAD_MAX_FILE_SIZE:
+                error = f"File is too large: {size} > {settings.DIRECT_UPLOAD_MAX_FILE_SIZE} bytes"
+                oversized.append(filename)
+
+            if error:
+                validation_errors.append({
+                    "file_index": entry["index"],
+                    "filename": entry["original_filename"],
+                    "error": error,
+                })
+                continue
+            uploaded_files.append({
+                "filename": filename,
+                "original_filename": entry["original_filename"],
+                "index": entry["index"],
+                "url": self.s3_service.generate_file_url(filename),
+            })
+
+        if oversized:
+            self.s3_service.batch_delete(oversized)
+        return uploaded_files, validation_errors
+
+    def finalize(self, manifest, uploaded_files):
+        """
+        Регистрирует проверенные файлы и отправляет их на распознавание после фиксации транзакции.
+        Объекты в S3 при ошибке БД не удаляются: подтверждение можно повторить тем же токеном.
+        Файлы токена регистрируются одной транзакцией, поэтому если они уже зарегистрированы
+        (повтор после потерянного ответа или параллельный запрос), возвращаются существующие записи
+        """
+        meta_by_index = {entry["index"]: entry for entry in manifest}
+        filenames = [f["filename"] for f in uploaded_files]
+        try:
+            with transaction.atomic():
+                # Блокировка строки пользователя упорядочивает параллельные подтверждения:
+                # второе дождётся первого и увидит созданные им записи
+                get_user_model().objects.select_for_update().filter(pk=self.user.pk).first()
+                registered = list(UploadedImage.objects.filter(user=self.user, filename__in=filenames))
+                if registered:
+                    logger.info(f"Direct upload of {len(registered)} files already registered, returning existing records")
+                    return registered, None
+                uploaded_images = ImageUploadService(self.user).register_and_dispatch(uploaded_files, meta_by_index)
+        except DatabaseError as db_error:
+            logger.error(f"Database error while registering {len(uploaded_files)} direct uploads: {str(db_error)}")
+            return None, [
+                {
+                    "file_index": f["index"],
+                    "filename": f["original_filename"],
+                    "error": f"Database error: {str(db_error)}"
+                }
+                for f in uploaded_files
+            ]
+        return uploaded_images, None
@@ -0,0 +1,196 @@
+import csv
+import logging
+import math
+import os
+import threading
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+
+from django.conf import settings
+from geopy.geocoders import Nominatim
+
+from image_api.services.rate_limiter import RedisTokenBucket
+
+logger = logging.getLogger(__name__)
+
+EARTH_RADIUS_M = 6371000
+
+
+def normalize_address(address: str) -> str:
+    """
+    Приводит адрес к каноническому виду для ключа кеша
+    """
+    return " ".join(address.lower().replace(",", " ").split())
+
+
+class GeocoderBackend:
+    """
+    Интерфейс геокодера. Оба метода возвращают None, если ничего не найдено,
+    и выбрасывают исключение при ошибке самого геокодера.
+    """
+    name = "base"
+
+    def geocode(self, address: str) -> Optional[Tuple[float, float]]:
+        raise NotImplementedError
+
+    def reverse(self, lat: float, lon: float) -> Optional[str]:
+        raise NotImplementedError
+
+
+class NominatimBackend(GeocoderBackend):
+    """
+    Сетевой геокодер Nominatim; запросы ограничены общим token bucket
+    """
+    name = "nominatim"
+
+    def __init__(self):
+        self.client = Nominatim(user_agent=settings.GEOCODING_USER_AGENT, timeout=settings.GEOCODING_TIMEOUT)
+        self.rate_limiter = RedisTokenBucket(
+            "nominatim", settings.GEOCODING_RATE_LIMIT, settings.GEOCODING_RATE_BURST
+        )
+
+    def geocode(self, address: str) -> Optional[Tuple[float, float]]:
+        self.rate_limiter.acquire(timeout=settings.GEOCODING_RATE_WAIT_TIMEOUT)
+        loc = self.client.geocode(address)
+        return (loc.latitude, loc.longitude) if loc else None
+
+    def reverse(self, lat: float, lon: float) -> Optional[str]:
+        self.rate_limiter.acquire(timeout=settings.GEOCODING_RATE_WAIT_TIMEOUT)
+        loc = self.client.reverse((lat, lon))
+        return loc.address if loc else None
+
+
+class OfflineGeocoderBackend(GeocoderBackend):
+    """
+    Локальный геокодер по справочнику адресных точек.
+
+    Справочник — CSV с колонками lat, lon, address (разделитель «,» или «;»).
+    Улицы можно задать набором точек вдоль сегментов. Точки раскладываются
+    по сетке ячеек размером cell_deg градусов; ближайшая точка ищется в
+    расширяющихся кольцах ячеек вокруг запроса, но не дальше max_distance_m.
+    Прямое геокодирование — точное совпадение нормализованного адреса.
+    """
+    name = "offline"
+
+    def __init__(self, path: str, cell_deg: float = 0.005, max_distance_m: float = 200):
+        self.path = path
+        self.cell_deg = cell_deg
+        self.max_distance_m = max_distance_m
+        self._grid: Dict[Tuple[int, int], List[Tuple[float, float, str]]] = defaultdict(list)
+        self._by_address: Dict[str, Tuple[float, float]] = {}
+        self._load()
+
+    def _load(self) -> None:
+        with open(self.path, newline="", encoding="utf-8-sig") as f:
+            sample = f.read(4096)
+            f.seek(0)
+            dialect = csv.Sniffer().sniff(sample, delimiters=",;")
+            count = 0
+            for row in csv.DictReader(f, dialect=dialect):
+                try:
+                    lat, lon = float(row["lat"]), float(row["lon"])
+                except (KeyError, TypeError, ValueError):
+                    continue
+                address = (row.get("address") or "").strip()
+                if not address:
+                    continue
+                self._grid[self._cell(lat, lon)].append((lat, lon, address))
+                self._by_address.setdefault(normalize_address(address), (lat, lon))
+                count += 1
+        logger.info(f"Offline geocoder loaded {count} address points from {self.path}")
+
+    def _cell(self, lat: float, lon: float) -> Tuple[int, int]:
+        return int(math.floor(lat / self.cell_deg)), int(math.floor(lon / self.cell_deg))
+
+    @staticmethod
+    def _distance_m(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+        # Равнопромежуточное приближение — достаточно точно на расстояниях в сотни метров
+        x = math.radians(lon2 - lon1) * math.cos(math.radians((lat1 + lat2) / 2))
+        y = math.radians(lat2 - lat1)
+        return EARTH_RADIUS_M * math.hypot(x, y)
+
+    def geocode(self, address: str) -> Optional[Tuple[float, float]]:
+        return self._by_address.get(normalize_address(address))
+
+    def reverse(self, lat: float, lon: float) -> Optional[str]:
+        center_row, center_col = self._cell(lat, lon)
+        # Минимальный размер ячейки в метрах (по долготе ячейка сужается к полюсам)
+        cell_m = math.radians(self.cell_deg) * EARTH_RADIUS_M * max(math.cos(math.radians(lat)), 0.01)
+        max_ring = int(math.ceil(self.max_distance_m / cell_m)) + 1
+
+        best_address, best_distance = None, self.max_distance_m
+        for ring in range(max_ring + 1):
+            # Точки из кольца ring не ближе (ring - 1) ячеек — дальше искать бессмысленно
+            if best_address is not None and (ring - 1) * cell_m > best_distance:
+                break
+            for row in range(center_row - ring, center_row + ring + 1):
+                for col in range(center_col - ring, center_col + ring + 1):
+                    if max(abs(row - center_row), abs(col - center_col)) != ring:
+                        continue
+                    for p_lat, p_lon, address in self._grid.get((row, col), ()):
+                        distance = self._distance_m(lat, lon, p_lat, p_lon)
+                        if distance <= best_distance:
+                            best_address, best_distance = address, distance
+        return best_address
+
+
+class FallbackGeocoderBackend(GeocoderBackend):
+    """
+    Сначала локальный справочник, при отсутствии ответа — сетевой геокодер
+    """
+    name = "offline_fallback"
+
+    def __init__(self, primary: GeocoderBackend, fallback: GeocoderBackend):
+        self.primary = primary
+        self.fallback = fallback
+
+    def geocode(self, address: str) -> Optional[Tuple[float, float]]:
+        return self.primary.geocode(address) or self.fallback.geocode(address)
+
+    def reverse(self, lat: float, lon: float) -> Optional[str]:
+        return self.primary.reverse(lat, lon) or self.fallback.reverse(lat, lon)
+
+
+def build_geocoder_backend(name: str) -> GeocoderBackend:
+    """
+    Создаёт геокодер по имени: nominatim, offline или offline_fallback
+    """
+    if name == NominatimBackend.name:
+        return NominatimBackend()
+
+    offline = OfflineGeocoderBackend(
+        settings.GEOCODER_OFFLINE_PATH,
+        cell_deg=settings.GEOCODER_OFFLINE_CELL_DEG,
+        max_distance_m=settings.GEOCODER_OFFLINE_MAX_DISTANCE_M,
+    )
+    if name == OfflineGeocoderBackend.name:
+        return offline
+    if name == FallbackGeocoderBackend.name:
+        return FallbackGeocoderBackend(offline, NominatimBackend())
+    raise ValueError(f"Unknown geocoder backend: {name}")
+
+
+_backend_lock = threading.Lock()
+_backend = None
+
+
+def _reset_backend():
+    global _backend_lock, _backend
+    _backend_lock = threading.Lock()
+    _backend = None
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_backend)
+
+
+def get_geocoder_backend() -> GeocoderBackend:
+    """
+    Возвращает геокодер, выбранный настройкой GEOCODER_BACKEND (один на процесс)
+    """
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                _backend = build_geocoder_backend(settings.GEOCODER_BACKEND)
+    return _backend
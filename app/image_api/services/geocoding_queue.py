@@ -0,0 +1,203 @@
+import json
+import logging
+import time
+from typing import Any, Dict, List, Optional, Set
+
+from image_api.services.redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+# Приоритеты запросов: меньше — срочнее
+PRIORITY_HIGH = 0      # от результата зависит отправка на распознавание
+PRIORITY_NORMAL = 1    # адрес основной локации
+PRIORITY_LOW = 2       # адреса обнаруженных объектов
+
+KIND_FORWARD = "forward"
+KIND_REVERSE = "reverse"
+
+QUEUE_KEY = "geocoding:queue"
+DELAYED_KEY = "geocoding:delayed"
+REQUEST_KEY = "geocoding:request:{}"
+TARGETS_KEY = "geocoding:targets:{}"
+WORKER_LOCK_KEY = "geocoding:worker:lock"
+WORKER_KICK_KEY = "geocoding:worker:kick"
+WORKER_DELAYED_KICK_KEY = "geocoding:worker:kick:delayed"
+
+# Атомарно извлекает самый приоритетный запрос вместе со всеми ожидающими его целями,
+# чтобы цель, добавленная между чтением и удалением, не потерялась.
+POP_SCRIPT = """
+local popped = redis.call('ZPOPMIN', KEYS[1])
+if #popped == 0 then
+    return nil
+end
+local lookup = popped[1]
+local request_key = ARGV[1] .. lookup
+local targets_key = ARGV[2] .. lookup
+local request = redis.call('HGETALL', request_key)
+local targets = redis.call('LRANGE', targets_key, 0, -1)
+redis.call('DEL', request_key, targets_key)
+return {lookup, popped[2], request, targets}
+"""
+
+# Переносит в очередь отложенные запросы, срок повтора которых наступил.
+# Запрос, который уже выполнен по новой постановке (данных нет), пропускается.
+PROMOTE_SCRIPT = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+for _, lookup in ipairs(due) do
+    redis.call('ZREM', KEYS[1], lookup)
+    local priority = redis.call('HGET', ARGV[2] .. lookup, 'priority')
+    if priority then
+        redis.call('ZADD', KEYS[2], 'LT', tonumber(priority) * 1e10 + tonumber(ARGV[1]), lookup)
+    end
+end
+return #due
+"""
+
+
+class GeocodingQueue:
+    """
+    Очередь запросов геокодирования в Redis.
+
+    Одинаковые запросы объединяются: ключ запроса (нормализованный адрес или
+    округлённые координаты, см. GeocodingService) хранится в очереди один раз,
+    а все записи, ожидающие ответ, копятся в его списке целей. Очередь
+    упорядочена по приоритету, затем по времени постановки. Обрабатывает её
+    geocoding_worker_task.
+
+    Запрос, на который геокодер не ответил, откладывается (requeue) в
+    отдельный ZSET со временем повтора и возвращается в очередь при
+    следующем запуске воркера (promote_due).
+    """
+
+    def __init__(self):
+        self.redis = get_redis()
+        self._pop_script = None
+        self._promote_script = None
+
+    def submit(self, kind: str, lookup_key: str, query: Any, target: Dict[str, Any],
+               priority: int = PRIORITY_NORMAL) -> None:
+        """
+        Ставит запрос в очередь. target — запись, которую нужно обновить результатом:
+        {'type': 'image_location' | 'detected_location', 'id': ..., 'dispatch': bool}
+        """
+        self.submit_many([(kind, lookup_key, query, target, priority)])
+
+    def submit_many(self, lookups: List[tuple]) -> None:
+        """
+        Пакетная постановка запросов: список (kind, lookup_key, query, target, priority)
+        """
+        if not lookups:
+            return
+        now = time.time()
+        pipe = self.redis.pipeline(transaction=True)
+        for kind, lookup_key, query, target, priority in lookups:
+            pipe.hset(REQUEST_KEY.format(lookup_key), mapping={"kind": kind, "query": json.dumps(query)})
+            pipe.rpush(TARGETS_KEY.format(lookup_key), json.dumps(target))
+            # LT: повторный запрос может только повысить приоритет уже стоящего в очереди
+            pipe.zadd(QUEUE_KEY, {lookup_key: priority * 1e10 + now}, lt=True)
+        pipe.execute()
+        self.kick_worker()
+
+    def kick_worker(self) -> None:
+        """
+        Запускает воркер, если он ещё не работает
+        """
+        from image_api.tasks import geocoding_worker_task
+
+        if self.redis.exists(WORKER_LOCK_KEY):
+            return
+        # Не ставим задачу повторно при каждом submit в пределах секунды
+        if self.redis.set(WORKER_KICK_KEY, 1, nx=True, ex=1):
+            geocoding_worker_task.delay()
+        # Запущенный в эту секунду воркер мог уже завершиться, не увидев новый запрос:
+        # отложенный запуск подберёт его (не больше одного такого запуска в секунду)
+        elif self.redis.set(WORKER_DELAYED_KICK_KEY, 1, nx=True, ex=1):
+            geocoding_worker_task.apply_async(countdown=1)
+
+    def pop(self) -> Optional[Dict[str, Any]]:
+        """
+        Извлекает самый приоритетный запрос:
+        {'key', 'kind', 'query', 'targets', 'priority', 'attempts'} или None
+        """
+        if self._pop_script is None:
+            self._pop_script = self.redis.register_script(POP_SCRIPT)
+        popped = self._pop_script(
+            keys=[QUEUE_KEY],
+            args=[REQUEST_KEY.format(""), TARGETS_KEY.format("")]
+        )
+        if not popped:
+            return None
+        lookup_key, score, request, targets = popped
+        request = dict(zip(request[::2], request[1::2]))
+        return {
+            "key": lookup_key,
+            "kind": request.get("kind"),
+            "query": json.loads(request["query"]) if "query" in request else None,
+            "targets": [json.loads(t) for t in targets],
+            "priority": int(float(score) // 1e10),
+            "attempts": int(request.get("attempts", 0)),
+        }
+
+    def requeue(self, item: Dict[str, Any], attempts: int, delay: float) -> None:
+        """
+        Откладывает запрос вместе с его целями на delay секунд
+        """
+        lookup_key = item["key"]
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.hset(REQUEST_KEY.format(lookup_key), mapping={
+            "kind": item["kind"],
+            "query": json.dumps(item["query"]),
+            "priority": item["priority"],
+            "attempts": attempts,
+        })
+        if item["targets"]:
+            pipe.rpush(TARGETS_KEY.format(lookup_key), *[json.dumps(t) for t in item["targets"]])
+        pipe.zadd(DELAYED_KEY, {lookup_key: time.time() + delay})
+        pipe.execute()
+
+    def promote_due(self) -> int:
+        """
+        Возвращает в очередь отложенные запросы, время повтора которых наступило
+        """
+        if self._promote_script is None:
+            self._promote_script = self.redis.register_script(PROMOTE_SCRIPT)
+        return self._promote_script(keys=[DELAYED_KEY, QUEUE_KEY], args=[time.time(), REQUEST_KEY.format("")])
+
+    def next_retry_delay(self) -> Optional[float]:
+        """
+        Через сколько секунд наступит ближайший повтор отложенного запроса (None — отложенных нет)
+        """
+        earliest = self.redis.zrange(DELAYED_KEY, 0, 0, withscores=True)
+        if not earliest:
+            return None
+        return max(earliest[0][1] - time.time(), 0)
+
+    def pending_dispatch_ids(self) -> Set[int]:
+        """
+        id ImageLocation, которые ждут прямого геокодирования для отправки на распознавание
+        (в очереди или среди отложенных повторов)
+        """
+        lookups = set(self.redis.zrange(QUEUE_KEY, 0, -1)) | set(self.redis.zrange(DELAYED_KEY, 0, -1))
+        if not lookups:
+            return set()
+        pipe = self.redis.pipeline(transaction=False)
+        for lookup_key in lookups:
+            pipe.lrange(TARGETS_KEY.format(lookup_key), 0, -1)
+        ids = set()
+        for targets in pipe.execute():
+            for target in map(json.loads, targets):
+                if target["type"] == "image_location" and target.get("dispatch"):
+                    ids.add(target["id"])
+        return ids
+
+    def acquire_worker_lock(self, ttl: int) -> bool:
+        return bool(self.redis.set(WORKER_LOCK_KEY, 1, nx=True, ex=ttl))
+
+    def refresh_worker_lock(self, ttl: int) -> None:
+        self.redis.expire(WORKER_LOCK_KEY, ttl)
+
+    def release_worker_lock(self) -> None:
+        self.redis.delete(WORKER_LOCK_KEY)
+
+    def size(self) -> int:
+        return self.redis.zcard(QUEUE_KEY)
@@ -0,0 +1,260 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import timedelta
+from typing import Optional, Tuple
+
+from django.conf import settings
+from django.utils.functional import cached_property
+from django.utils import timezone
+
+from image_api.models import GeocodeCacheEntry
+from image_api.services.geocoder_backends import get_geocoder_backend, normalize_address
+from image_api.services.geocoding_queue import (
+    GeocodingQueue, KIND_FORWARD, KIND_REVERSE, PRIORITY_NORMAL
+)
+from image_api.services.redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+STATS_KEY = "geocoding:stats"
+
+# Значение-маркер «адрес не найден» в локальном кеше
+NOT_FOUND = object()
+
+
+class GeocodingError(Exception):
+    """
+    Геокодер не ответил (таймаут, ошибка сети, лимит частоты запросов); результат не кешируется
+    """
+
+
+class LRUCache:
+    """
+    Потокобезопасный LRU-кеш с ограничением времени жизни записей
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._data = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            value, expires_at = item
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl: float) -> None:
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+
+_local_cache = LRUCache(settings.GEOCODING_LRU_SIZE)
+
+
+def _reset_local_state():
+    global _local_cache
+    _local_cache = LRUCache(settings.GEOCODING_LRU_SIZE)
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_local_state)
+
+
+class GeocodingService:
+    """
+    Геокодирование с двухуровневым кешем:
+    1) LRU в памяти процесса;
+    2) таблица GeocodeCacheEntry в БД, общая для всех воркеров.
+
+    Ключ прямого геокодирования — нормализованный адрес, обратного —
+    координаты, округлённые до GEOCODING_COORD_PRECISION знаков.
+    Отрицательные ответы («не найдено») тоже кешируются, но на меньший срок.
+    Счётчики попаданий/промахов хранятся в Redis (см. get_stats).
+
+    Сам геокодер выбирается настройкой GEOCODER_BACKEND (Nominatim,
+    локальный справочник или справочник с откатом на Nominatim, см.
+    geocoder_backends). Обращения к Nominatim проходят через общий для всех
+    процессов token bucket (GEOCODING_RATE_LIMIT запросов в секунду). Код
+    запросов не вызывает геокодер напрямую, а ставит поиск в очередь через
+    submit_forward/submit_reverse; её разбирает geocoding_worker_task.
+    """
+
+    def __init__(self):
+        self.ttl = settings.GEOCODING_CACHE_TTL
+        self.negative_ttl = settings.GEOCODING_NEGATIVE_TTL
+        self.precision = settings.GEOCODING_COORD_PRECISION
+
+    @cached_property
+    def backend(self):
+        """
+        Геокодер создаётся при первом поиске: процессы, которые только ставят
+        запросы в очередь, не загружают справочник и не создают клиент Nominatim
+        """
+        return get_geocoder_backend()
+
+    @staticmethod
+    def _count(field: str) -> None:
+        try:
+            get_redis().hincrby(STATS_KEY, field, 1)
+        except Exception as e:
+            logger.debug(f"Failed to update geocoding stats: {e}")
+
+    def forward_key(self, address: str) -> str:
+        digest = hashlib.sha1(normalize_address(address).encode("utf-8")).hexdigest()
+        return f"forward:{digest}"
+
+    def reverse_key(self, lat: float, lon: float) -> str:
+        return f"reverse:{float(lat):.{self.precision}f},{float(lon):.{self.precision}f}"
+
+    def _lookup(self, key: str):
+        """
+        Ищет значение в кешах. Возвращает (найдено_в_кеше, значение | NOT_FOUND)
+        """
+        value = _local_cache.get(key)
+        if value is not None:
+            self._count("l1_hits")
+            return True, value
+
+        entry = GeocodeCacheEntry.objects.filter(key=key, expires_at__gt=timezone.now()).first()
+        if entry is None:
+            self._count("misses")
+            return False, None
+
+        self._count("l2_hits")
+        if not entry.found:
+            value = NOT_FOUND
+        elif entry.kind == GeocodeCacheEntry.KIND_FORWARD:
+            value = (entry.lat, entry.lon)
+        else:
+            value = entry.address
+        ttl = (entry.expires_at - timezone.now()).total_seconds()
+        _local_cache.set(key, value, ttl)
+        return True, value
+
+    def _store(self, key: str, kind: str, value, address=None, lat=None, lon=None) -> None:
+        found = value is not NOT_FOUND
+        ttl = self.ttl if found else self.negative_ttl
+        _local_cache.set(key, value, ttl)
+        try:
+            GeocodeCacheEntry.objects.update_or_create(
+                key=key,
+                defaults={
+                    "kind": kind,
+                    "found": found,
+                    "address": address,
+                    "lat": lat,
+                    "lon": lon,
+                    "expires_at": timezone.now() + timedelta(seconds=ttl),
+                },
+            )
+        except Exception as e:
+            logger.error(f"Failed to persist geocoding cache entry {key}: {e}")
+
+    def geocode(self, address: str) -> Optional[Tuple[float, float]]:
+        """
+        Прямое геокодирование: адрес -> (lat, lon) или None.
+        Сбой геокодера приводит к GeocodingError, а не к «не найдено»
+        """
+        if not address:
+            return None
+        key = self.forward_key(address)
+        cached, value = self._lookup(key)
+        if cached:
+            return None if value is NOT_FOUND else value
+
+        try:
+            coords = self.backend.geocode(address)
+        except Exception as e:
+            self._count("errors")
+            logger.warning(f"Ошибка геокодирования {address}: {e}")
+            raise GeocodingError(str(e)) from e
+
+        if not coords:
+            self._store(key, GeocodeCacheEntry.KIND_FORWARD, NOT_FOUND)
+            return None
+        self._store(key, GeocodeCacheEntry.KIND_FORWARD, coords, lat=coords[0], lon=coords[1])
+        return coords
+
+    def reverse(self, lat: Optional[float], lon: Optional[float]) -> Optional[str]:
+        """
+        Обратное геокодирование: (lat, lon) -> адрес или None.
+        Сбой геокодера приводит к GeocodingError, а не к «не найдено»
+        """
+        if lat is None or lon is None:
+            return None
+        key = self.reverse_key(lat, lon)
+        cached, value = self._lookup(key)
+        if cached:
+            return None if value is NOT_FOUND else value
+
+        try:
+            address = self.backend.reverse(lat, lon)
+        except Exception as e:
+            self._count("errors")
+            logger.warning(f"Ошибка reverse для {lat}, {lon}: {e}")
+            raise GeocodingError(str(e)) from e
+
+        if not address:
+            self._store(key, GeocodeCacheEntry.KIND_REVERSE, NOT_FOUND)
+            return None
+        self._store(key, GeocodeCacheEntry.KIND_REVERSE, address, address=address)
+        return address
+
+    def resolve(self, kind: str, query):
+        """
+        Выполняет поиск из очереди: адрес для KIND_FORWARD, [lat, lon] для KIND_REVERSE
+        """
+        if kind == KIND_FORWARD:
+            return self.geocode(query)
+        return self.reverse(*query)
+
+    def submit_forward(self, address: str, target: dict, priority: int = PRIORITY_NORMAL) -> None:
+        """
+        Ставит в очередь определение координат по адресу для записи target
+        """
+        GeocodingQueue().submit(KIND_FORWARD, self.forward_key(address), address, target, priority)
+
+    def submit_reverse(self, lat: float, lon: float, target: dict, priority: int = PRIORITY_NORMAL) -> None:
+        """
+        Ставит в очередь определение адреса по координатам для записи target
+        """
+        GeocodingQueue().submit(KIND_REVERSE, self.reverse_key(lat, lon), [lat, lon], target, priority)
+
+    def submit_reverse_many(self, points, priority: int = PRIORITY_NORMAL) -> None:
+        """
+        Пакетная постановка обратного геокодирования: points — список (lat, lon, target)
+        """
+        GeocodingQueue().submit_many([
+            (KIND_REVERSE, self.reverse_key(lat, lon), [lat, lon], target, priority)
+            for lat, lon, target in points
+        ])
+
+    @staticmethod
+    def get_stats() -> dict:
+        """
+        Счётчики кеша геокодирования по всем процессам
+        """
+        raw = get_redis().hgetall(STATS_KEY)
+        stats = {field: int(raw.get(field, 0)) for field in ("l1_hits", "l2_hits", "misses", "errors")}
+        lookups = stats["l1_hits"] + stats["l2_hits"] + stats["misses"]
+        stats["hit_ratio"] = round((stats["l1_hits"] + stats["l2_hits"]) / lookups, 4) if lookups else None
+        stats["queue_size"] = GeocodingQueue().size()
+        return stats
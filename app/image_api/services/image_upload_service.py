@@ -1,11 +1,51 @@
 import uuid
 import logging
-from django.db import transaction
+from django.db import DatabaseError, transaction
+from django.utils import timezone
 from image_api.models import UploadedImage, ImageLocation
+from image_api.services.prediction_batcher import dispatch_geo_tasks
 from image_api.services.s3_service import S3Service
 
 logger = logging.getLogger(__name__)
 
+
+def needs_forward_geocoding(location):
+    """
+    True, если у записи есть адрес, но нет координат
+    """
+    return bool(location.address) and (location.lat is None or location.lon is None)
+
+
+def needs_reverse_geocoding(location):
+    """
+    True, если у записи есть координаты, но нет адреса
+    """
+    return location.lat is not None and location.lon is not None and not location.address
+
+
+def needs_geocoding(location):
+    """
+    True, если у записи есть только адрес или только координаты
+    """
+    return needs_forward_geocoding(location) or needs_reverse_geocoding(location)
+
+
+def build_geo_task(location, image_filename=None):
+    """
+    Формирует описание задачи для сервиса распознавания.
+    image_filename можно передать, если имя файла уже известно, — тогда
+    связанный UploadedImage не читается.
+    """
+    return {
+        "task_id": location.id,
+        "image_filename": image_filename if image_filename is not None else location.image.filename,
+        "angle": location.angle,
+        "height": location.height,
+        "lat": location.lat,
+        "lon": location.lon,
+    }
+
+
 class ImageUploadService:
     def __init__(self, user):
         self.user = user
@@ -50,50 +90,73 @@ class ImageUploadService:
 
         return validated_files, validation_errors
 
-    @transaction.atomic
     def upload_and_process(self, validated_files):
-        from image_api.tasks import process_geo_tasks
-        uploaded_images = []
-        upload_errors = []
-
+        """
+        Загрузка в два этапа: файлы параллельно загружаются в S3 вне транзакции,
+        затем записи создаются короткой транзакцией из двух bulk_create.
+        Отправка на распознавание выполняется только после фиксации транзакции,
+        чтобы callback не пришёл раньше, чем записи станут видны. Если записи
+        создать не удалось, загруженные объекты удаляются из S3.
+        """
         upload_results = self.s3_service.batch_upload(validated_files)
-
-        # Успешные загрузки
-        for success_file in upload_results['successful']:
-            try:
-                uploaded = UploadedImage.objects.create(
-                    filename=success_file['filename'],
-                    original_filename=success_file['original_filename'],
-                    file_path=f"uploads/{success_file['filename']}",
-                    s3_url=success_file['url'],
-                    user=self.user
-                )
-                # сохраняем index, чтобы потом найти метаданные
-                uploaded._file_index = success_file['index']
-                uploaded_images.append(uploaded)
-                logger.info(f"Database record created: {success_file['filename']}")
-            except Exception as db_error:
-                logger.error(f"Database error for {success_file['filename']}: {str(db_error)}")
-                self.s3_service.delete_file(success_file['filename'])
-                upload_errors.append({
-                    "file_index": success_file['index'],
-                    "filename": success_file['original_filename'],
+        successful = upload_results['successful']
+
+        if upload_results['failed']:
+            self.s3_service.batch_delete([f['filename'] for f in successful])
+            return None, upload_results['failed']
+
+        # Метаданные по index: поиск для каждого файла за O(1)
+        meta_by_index = {f["index"]: f for f in validated_files}
+        try:
+            uploaded_images = self.register_and_dispatch(successful, meta_by_index)
+        except DatabaseError as db_error:
+            logger.error(f"Database error while registering {len(successful)} uploads: {str(db_error)}")
+            self.s3_service.batch_delete([f['filename'] for f in successful])
+            return None, [
+                {
+                    "file_index": f['index'],
+                    "filename": f['original_filename'],
                     "error": f"Database error: {str(db_error)}"
-                })
+                }
+                for f in successful
+            ]
 
-        upload_errors.extend(upload_results['failed'])
+        return uploaded_images, None
 
-        if upload_errors:
-            self._rollback(uploaded_images)
-            return None, upload_errors
+    def register_and_dispatch(self, uploaded_files, meta_by_index):
+        """
+        Регистрирует уже загруженные в S3 файлы короткой транзакцией и после её
+        фиксации отправляет их на распознавание. Возвращает созданные UploadedImage
+        """
+        image_filenames = [f['filename'] for f in uploaded_files]
+        with transaction.atomic():
+            uploaded_images, image_locations = self.register_uploads(uploaded_files, meta_by_index)
+            transaction.on_commit(lambda: self._dispatch(image_locations, image_filenames))
+        return uploaded_images
+
+    def register_uploads(self, uploaded_files, meta_by_index):
+        """
+        Создаёт UploadedImage и ImageLocation для загруженных в S3 файлов двумя
+        bulk_create. uploaded_files — список {'filename', 'original_filename',
+        'index', 'url'}, meta_by_index — метаданные файла по его index.
+        Возвращает (uploaded_images, image_locations) в порядке uploaded_files.
+        """
+        # PostgreSQL возвращает первичные ключи вставленных строк
+        uploaded_images = UploadedImage.objects.bulk_create([
+            UploadedImage(
+                filename=f['filename'],
+                original_filename=f['original_filename'],
+                file_path=f"uploads/{f['filename']}",
+                s3_url=f['url'],
+                user=self.user
+            )
+            for f in uploaded_files
+        ])
 
-        # Создаём ImageLocation с метаданными
         image_locations = []
-        for uploaded_image in uploaded_images:
-            # ищем словарь из validated_files по index
-            meta = next((f for f in validated_files if f["index"] == uploaded_image._file_index), {})
-
-            location = ImageLocation.objects.create(
+        for f, uploaded_image in zip(uploaded_files, uploaded_images):
+            meta = meta_by_index.get(f['index'], {})
+            image_locations.append(ImageLocation(
                 user=self.user,
                 image=uploaded_image,
                 status='processing',
@@ -102,62 +165,57 @@ class ImageUploadService:
                 lon=meta.get("lon"),
                 angle=meta.get("angle"),
                 height=meta.get("height"),
-            )
-            image_locations.append(location)
-
-        # Отправляем в Celery
-        images_data = [
-            {
-                "task_id": loc.id,
-                "image_filename": loc.image.filename,
-                "angle": loc.angle,
-                "height": loc.height,
-                "lat": loc.lat,
-                "lon": loc.lon,
-            }
-            for loc in image_locations
+            ))
+        ImageLocation.objects.bulk_create(image_locations)
+
+        logger.info(f"Database records created for {len(uploaded_images)} uploads")
+        return uploaded_images, image_locations
+
+    def _dispatch(self, image_locations, image_filenames):
+        """
+        Отправляет новые записи на распознавание или сначала на геокодирование
+        """
+        from image_api.tasks import enrich_locations_task
+
+        # Записи без координат отправляются на распознавание после геокодирования;
+        # адрес по координатам определяется в фоне и отправку не задерживает
+        ready = [
+            build_geo_task(loc, filename)
+            for loc, filename in zip(image_locations, image_filenames)
+            if not needs_forward_geocoding(loc)
         ]
-        process_geo_tasks.delay(images_data)
-
-        return uploaded_images, None
-
-    @transaction.atomic
-    def retry_result(self, image_location):
-        from image_api.tasks import process_geo_tasks
-
-        # Удаление всех связанных DetectedImageLocation
-        for det in image_location.detected_image_mappings.all():
-            if det.file:
-                s3 = S3Service()
-                s3.delete_file(det.file.filename)
-                det.file.delete()
-        image_location.detected_image_mappings.all().delete()
-
-    
-
-        # Перевод в статус "ожидает"
-        image_location.status = "processing"
-        image_location.error_reason = None
-        image_location.save(update_fields=["status", "error_reason"])
-
-        # данные для задачи
-        images_data = [{
-            "task_id": image_location.id,
-            "image_filename": image_location.image.filename,
-            "angle": image_location.angle,
-            "height": image_location.height,
-            "lat": image_location.lat,
-            "lon": image_location.lon,
-        }]
+        to_enrich = [loc.id for loc in image_locations if needs_geocoding(loc)]
 
         # Отправляем в Celery
-        process_geo_tasks.delay(images_data)
-
+        if ready:
+            dispatch_geo_tasks(ready)
+        if to_enrich:
+            enrich_locations_task.delay(to_enrich)
 
-    def _rollback(self, uploaded_images):
-        for uploaded_image in uploaded_images:
-            try:
-                uploaded_image.delete()
-                self.s3_service.delete_file(uploaded_image.filename)
-            except Exception as e:
-                logger.error(f"Rollback error for {uploaded_image.filename}: {str(e)}")
+    def retry_result(self, image_location):
+        """
+        Повторная обработка: обнаруженные объекты удаляются, запись возвращается
+        в processing. Изменения в БД выполняются одной короткой транзакцией;
+        файлы удаляются из S3 (сигнал post_delete UploadedImage) и задача
+        отправляется на распознавание только после её фиксации.
+        """
+        detected_file_ids = list(
+            image_location.detected_image_mappings.filter(file__isnull=False).values_list('file_id', flat=True)
+        )
+
+        with transaction.atomic():
+            image_location.detected_image_mappings.all().delete()
+            UploadedImage.objects.filter(id__in=detected_file_ids).delete()
+
+            # Перевод в статус "ожидает"
+            image_location.status = "processing"
+            image_location.error_reason = None
+            image_location.processing_since = timezone.now()
+            image_location.dispatch_attempts = 0
+            image_location.save(update_fields=["status", "error_reason", "processing_since", "dispatch_attempts"])
+
+            # данные для задачи
+            images_data = [build_geo_task(image_location)]
+
+            # Отправляем в Celery после фиксации изменений
+            transaction.on_commit(lambda: dispatch_geo_tasks(images_data))
@@ -0,0 +1,97 @@
+import json
+import logging
+import math
+from typing import Any, Dict, List, Set
+
+from django.conf import settings
+
+from image_api.services.redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+PENDING_KEY = "prediction:pending"
+FLUSH_SCHEDULED_KEY = "prediction:flush:scheduled"
+FLUSH_KICK_KEY = "prediction:flush:kick"
+
+
+class PredictionBatcher:
+    """
+    Накопитель задач на распознавание в Redis.
+
+    Загрузки добавляют задачи в общий список, а flush_prediction_batch_task
+    отправляет их одним запросом: сразу, как только набралось
+    PREDICTION_BATCH_SIZE задач, или не позже чем через
+    PREDICTION_BATCH_MAX_DELAY секунд после первой задачи в пустом буфере.
+    Так много мелких загрузок превращаются в несколько крупных запросов.
+
+    Буфер же служит очередью задач, ожидающих места в окне
+    AdmissionController: отправка забирает из него только те задачи, для
+    которых есть свободный слот.
+    """
+
+    def __init__(self):
+        self.redis = get_redis()
+        self.batch_size = settings.PREDICTION_BATCH_SIZE
+        self.max_delay = settings.PREDICTION_BATCH_MAX_DELAY
+
+    def add(self, tasks: List[Dict[str, Any]]) -> None:
+        """
+        Добавляет задачи (в формате build_geo_task) и планирует отправку
+        """
+        if not tasks:
+            return
+        size = self.redis.rpush(PENDING_KEY, *[json.dumps(task) for task in tasks])
+
+        # Отправляем сразу, если накопление выключено или этим добавлением
+        # перешли очередную границу batch_size
+        if self.max_delay <= 0 or size // self.batch_size > (size - len(tasks)) // self.batch_size:
+            self.kick_flush()
+            return
+        self.schedule_flush(self.max_delay)
+
+    def schedule_flush(self, countdown: float) -> None:
+        """
+        Планирует отложенную отправку, если она ещё не запланирована. Ключ живёт
+        дольше окна, чтобы потерянная задача не блокировала планирование навсегда
+        """
+        from image_api.tasks import flush_prediction_batch_task
+
+        ttl = int(math.ceil(countdown)) * 2 + 5
+        if self.redis.set(FLUSH_SCHEDULED_KEY, 1, nx=True, ex=ttl):
+            flush_prediction_batch_task.apply_async(countdown=countdown)
+
+    def kick_flush(self) -> None:
+        """
+        Запускает отправку немедленно (не чаще раза в секунду)
+        """
+        from image_api.tasks import flush_prediction_batch_task
+
+        if self.redis.set(FLUSH_KICK_KEY, 1, nx=True, ex=1):
+            flush_prediction_batch_task.delay()
+        else:
+            # Недавно запущенная отправка могла уже прочитать буфер — страхуемся отложенной
+            self.schedule_flush(1)
+
+    def reset_schedule(self) -> None:
+        """
+        Снимает отметку о запланированной отправке: следующее добавление запланирует новую
+        """
+        self.redis.delete(FLUSH_SCHEDULED_KEY)
+
+    def size(self) -> int:
+        return self.redis.llen(PENDING_KEY)
+
+    def pending_task_ids(self) -> Set[str]:
+        """
+        task_id задач, которые ещё ждут отправки в буфере
+        """
+        return {str(json.loads(item)["task_id"]) for item in self.redis.lrange(PENDING_KEY, 0, -1)}
+
+
+def dispatch_geo_tasks(tasks: List[Dict[str, Any]]) -> None:
+    """
+    Отправляет задачи на распознавание через накопитель.
+    При PREDICTION_BATCH_MAX_DELAY = 0 задачи не ждут пачку, но по-прежнему
+    проходят через окно AdmissionController.
+    """
+    PredictionBatcher().add(tasks)
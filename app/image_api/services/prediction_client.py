@@ -0,0 +1,211 @@
+import json
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Tuple
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+
+class PredictionServiceClient:
+    """
+    HTTP-клиент сервиса распознавания.
+
+    Держит одну requests.Session на процесс, поэтому соединения с сервисом
+    переиспользуются (keep-alive) вместо установки нового TCP/TLS на каждую
+    отправку. Тело запроса сериализуется один раз. Ошибки соединения и ответы
+    5xx повторяются с экспоненциальной задержкой и случайным разбросом (full
+    jitter). Таймаут чтения не повторяется: сервис мог уже принять задачи.
+
+    Большие наборы задач отправляются частями (dispatch) параллельно; сессия
+    потокобезопасна для такого использования, а пул соединений должен быть не
+    меньше PREDICTION_DISPATCH_CONCURRENCY.
+    """
+
+    def __init__(self, base_url: str, callback_base_url: str, connect_timeout: float, read_timeout: float,
+                 retries: int, backoff: float, backoff_max: float, pool_size: int):
+        self.url = f"{base_url}:8080/api/Prediction"
+        self.main_callback_url = f"{callback_base_url}:8000/api/update-image-result/"
+        self.trash_callback_url = f"{callback_base_url}:8000/api/update-image-trash-result/"
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update({
+            "Content-Type": "application/json",
+            "Accept": "*/*"
+        })
+
+    def build_payload(self, images: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """
+        Формирует тело запроса из задач вида build_geo_task
+        """
+        return {
+            "mainCallback": self.main_callback_url,
+            "callbackUrl": self.main_callback_url,  # Для обратной совместимости
+            "trashCallback": self.trash_callback_url,
+            "tasks": [
+                {
+                    "fileName": img['image_filename'],
+                    "taskId": str(img['task_id']),
+                    "angle": img['angle'],
+                    "height": img['height'],
+                    "lat": img['lat'],
+                    "lon": img['lon'],
+                }
+                for img in images
+            ]
+        }
+
+    def _sleep_before_retry(self, attempt: int) -> None:
+        delay = min(self.backoff_max, self.backoff * (2 ** attempt))
+        time.sleep(random.uniform(0, delay))
+
+    def _post(self, body: bytes) -> requests.Response:
+        """
+        POST с повтором при ошибке соединения и ответах 5xx
+        """
+        for attempt in range(self.retries + 1):
+            try:
+                response = self.session.post(self.url, data=body, timeout=self.timeout)
+            except requests.exceptions.ConnectionError as e:
+                if attempt == self.retries:
+                    raise
+                logger.warning(f"Prediction service connection error (attempt {attempt + 1}): {e}")
+            else:
+                if response.status_code < 500 or attempt == self.retries:
+                    return response
+                logger.warning(
+                    f"Prediction service returned {response.status_code} (attempt {attempt + 1}), retrying"
+                )
+            self._sleep_before_retry(attempt)
+
+    def send_tasks(self, images: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """
+        Отправляет задачи на распознавание одним запросом.
+
+        Returns:
+            dict: {
+                'success': list of task_ids successfully queued,
+                'errors': list of dicts with {'task_id', 'error'},
+                'raw_response': original response dict (optional),
+                'request_error': описание ошибки, если запрос целиком не принят, иначе None,
+                'retryable': можно ли повторить отправку (ошибка соединения, таймаут соединения, 5xx),
+                'delivery_unknown': ответ не получен по таймауту чтения — сервис мог принять задачи
+            }
+        """
+        payload = self.build_payload(images)
+        body = json.dumps(payload).encode("utf-8")
+
+        def failed(error: str, retryable: bool, delivery_unknown: bool = False) -> Dict[str, Any]:
+            return {'success': [], 'errors': [], 'raw_response': None,
+                    'request_error': error, 'retryable': retryable, 'delivery_unknown': delivery_unknown}
+
+        try:
+            logger.info(f"Sending geo request for {len(images)} images")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"Payload: {body.decode('utf-8')}")
+
+            response = self._post(body)
+            logger.info(f"Geo service response status: {response.status_code}")
+
+            if response.status_code != 202:
+                logger.error(f"Geo service returned non-202 status: {response.status_code}, body: {response.text}")
+                return failed(f"HTTP {response.status_code}", response.status_code >= 500)
+
+            try:
+                result = response.json()
+            except ValueError:
+                logger.error("Geo service returned invalid JSON")
+                return failed("Invalid JSON in response", False)
+            logger.info(f"Geo service returned: {result}")
+
+            return {
+                'success': list(result.get("jobs", [])),
+                'errors': [
+                    {
+                        'task_id': error.get('taskId'),
+                        'error': error.get('error')
+                    }
+                    for error in result.get("validationErrors", [])
+                ],
+                'raw_response': result,
+                'request_error': None,
+                'retryable': False,
+                'delivery_unknown': False,
+            }
+
+        except requests.exceptions.ReadTimeout as e:
+            # Запрос мог быть принят: повторная отправка создала бы дубли задач
+            logger.error(f"Read timeout while calling geo service: {e}")
+            return failed(str(e), False, delivery_unknown=True)
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Exception while calling geo service: {e}", exc_info=True)
+            return failed(str(e), True)
+        except Exception as e:
+            logger.error(f"Exception while calling geo service: {e}", exc_info=True)
+            return failed(str(e), False)
+
+    def dispatch(self, images: List[Dict[str, Any]], chunk_size: int = None,
+                 concurrency: int = None) -> List[Tuple[List[Dict[str, Any]], Dict[str, Any]]]:
+        """
+        Отправляет задачи частями по chunk_size, не более concurrency запросов одновременно.
+        Возвращает список (задачи части, результат send_tasks) в порядке частей, чтобы
+        ошибку одной части можно было обработать, не трогая остальные.
+        """
+        chunk_size = max(1, chunk_size or settings.PREDICTION_CHUNK_SIZE)
+        concurrency = concurrency or settings.PREDICTION_DISPATCH_CONCURRENCY
+        chunks = [images[i:i + chunk_size] for i in range(0, len(images), chunk_size)]
+        if len(chunks) <= 1 or concurrency <= 1:
+            return [(chunk, self.send_tasks(chunk)) for chunk in chunks]
+
+        with ThreadPoolExecutor(max_workers=min(concurrency, len(chunks))) as executor:
+            return list(zip(chunks, executor.map(self.send_tasks, chunks)))
+
+
+_client_lock = threading.Lock()
+_client = None
+
+
+def _reset_prediction_client():
+    global _client_lock, _client
+    _client_lock = threading.Lock()
+    _client = None
+
+
+if hasattr(os, 'register_at_fork'):
+    # Соединения пула нельзя делить между процессами после fork
+    os.register_at_fork(after_in_child=_reset_prediction_client)
+
+
+def get_prediction_client() -> PredictionServiceClient:
+    """
+    Возвращает общий для процесса клиент сервиса распознавания
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = PredictionServiceClient(
+                    base_url=settings.EXTERNAL_SERVICE_URL,
+                    callback_base_url=settings.API_BASE_URL,
+                    connect_timeout=settings.PREDICTION_CONNECT_TIMEOUT,
+                    read_timeout=settings.PREDICTION_READ_TIMEOUT,
+                    retries=settings.PREDICTION_RETRIES,
+                    backoff=settings.PREDICTION_RETRY_BACKOFF,
+                    backoff_max=settings.PREDICTION_RETRY_BACKOFF_MAX,
+                    pool_size=settings.PREDICTION_POOL_SIZE,
+                )
+    return _client
@@ -0,0 +1,186 @@
+import hashlib
+import hmac
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Dict, Iterable, Optional
+from urllib.parse import quote, urlparse
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+SIGNING_ALGORITHM = "AWS4-HMAC-SHA256"
+
+
+class PresignService:
+    """
+    Подписывает GET-ссылки на объекты S3 (SigV4, query-string) без boto3,
+    а также PUT-ссылки для загрузки объектов клиентом напрямую в S3.
+
+    Ссылки строятся так же, как это делал S3Service.generate_presigned_url:
+    подпись считается для внутреннего эндпоинта, а хост в готовой ссылке
+    заменяется на публичный (AWS_S3_PUBLIC_ENDPOINT).
+
+    Время подписи округляется вниз до начала «корзины» длиной cache_bucket
+    секунд, поэтому в пределах корзины ссылка на файл детерминирована и
+    кешируется по ключу (filename, номер корзины). Производный ключ подписи
+    зависит только от даты и региона и переиспользуется весь день.
+    """
+
+    def __init__(self, bucket_name: str, endpoint_url: str, public_endpoint: str, region: str,
+                 access_key: str, secret_key: str, cache_bucket: int = 300, cache_size: int = 10000):
+        self.bucket_name = bucket_name
+        self.region = region
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.cache_bucket = cache_bucket
+        self.cache_size = cache_size
+
+        endpoint = urlparse(endpoint_url)
+        self.host = self._strip_default_port(endpoint.scheme, endpoint.netloc)
+        public = urlparse(public_endpoint if "://" in public_endpoint else f"http://{public_endpoint}")
+        self.public_base = f"{public.scheme}://{public.netloc}"
+
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()
+        self._signing_keys = {}
+
+    @staticmethod
+    def _strip_default_port(scheme: str, netloc: str) -> str:
+        # Стандартный порт не входит в подписываемый заголовок Host
+        if (scheme == "http" and netloc.endswith(":80")) or (scheme == "https" and netloc.endswith(":443")):
+            return netloc.rsplit(":", 1)[0]
+        return netloc
+
+    def _signing_key(self, datestamp: str) -> bytes:
+        key = self._signing_keys.get(datestamp)
+        if key is None:
+            k_date = hmac.new(f"AWS4{self.secret_key}".encode(), datestamp.encode(), hashlib.sha256).digest()
+            k_region = hmac.new(k_date, self.region.encode(), hashlib.sha256).digest()
+            k_service = hmac.new(k_region, b"s3", hashlib.sha256).digest()
+            key = hmac.new(k_service, b"aws4_request", hashlib.sha256).digest()
+            # Храним ключ только для актуальной даты
+            self._signing_keys = {datestamp: key}
+        return key
+
+    def _canonical_uri(self, filename: str) -> str:
+        # Path-style адресация (AWS_S3_ADDRESSING_STYLE = "path")
+        return f"/{quote(self.bucket_name, safe='~')}/{quote(filename, safe='/~')}"
+
+    def _sign(self, filename: str, signed_at: int, expires_in: int, method: str = "GET") -> str:
+        moment = datetime.fromtimestamp(signed_at, tz=timezone.utc)
+        amz_date = moment.strftime("%Y%m%dT%H%M%SZ")
+        datestamp = moment.strftime("%Y%m%d")
+        scope = f"{datestamp}/{self.region}/s3/aws4_request"
+
+        canonical_uri = self._canonical_uri(filename)
+        query = sorted({
+            "X-Amz-Algorithm": SIGNING_ALGORITHM,
+            "X-Amz-Credential": f"{self.access_key}/{scope}",
+            "X-Amz-Date": amz_date,
+            "X-Amz-Expires": str(expires_in),
+            "X-Amz-SignedHeaders": "host",
+        }.items())
+        canonical_query = "&".join(f"{quote(k, safe='~')}={quote(v, safe='~')}" for k, v in query)
+
+        canonical_request = "\n".join([
+            method,
+            canonical_uri,
+            canonical_query,
+            f"host:{self.host}\n",
+            "host",
+            "UNSIGNED-PAYLOAD",
+        ])
+        string_to_sign = "\n".join([
+            SIGNING_ALGORITHM,
+            amz_date,
+            scope,
+            hashlib.sha256(canonical_request.encode()).hexdigest(),
+        ])
+        signature = hmac.new(self._signing_key(datestamp), string_to_sign.encode(), hashlib.sha256).hexdigest()
+        return f"{self.public_base}{canonical_uri}?{canonical_query}&X-Amz-Signature={signature}"
+
+    def presign_many(self, filenames: Iterable[str], expires_in: int = 3600) -> Dict[str, Optional[str]]:
+        """
+        Возвращает словарь {filename: presigned URL} для набора ключей.
+        Повторные ключи и ключи из кеша не подписываются заново.
+        """
+        bucket = int(time.time()) // self.cache_bucket
+        signed_at = bucket * self.cache_bucket
+        # Запас на длину корзины: ссылка из кеша живёт не меньше expires_in секунд
+        expires = expires_in + self.cache_bucket
+
+        urls = {}
+        with self._lock:
+            for filename in filenames:
+                if not filename or filename in urls:
+                    continue
+                cache_key = (filename, bucket, expires_in)
+                url = self._cache.get(cache_key)
+                if url is None:
+                    try:
+                        url = self._sign(filename, signed_at, expires)
+                    except Exception as e:
+                        logger.error(f"Error generating presigned URL for {filename}: {str(e)}")
+                        urls[filename] = None
+                        continue
+                    self._cache[cache_key] = url
+                    if len(self._cache) > self.cache_size:
+                        self._cache.popitem(last=False)
+                else:
+                    self._cache.move_to_end(cache_key)
+                urls[filename] = url
+        return urls
+
+    def presign(self, filename: str, expires_in: int = 3600) -> Optional[str]:
+        """
+        Возвращает presigned URL для одного ключа
+        """
+        return self.presign_many([filename], expires_in).get(filename)
+
+    def presign_put(self, filename: str, expires_in: int = 900) -> str:
+        """
+        Возвращает ссылку для загрузки объекта методом PUT напрямую в S3.
+        Подписывается только заголовок Host, поэтому Content-Type клиент задаёт сам.
+        Такие ссылки одноразовые по смыслу и не кешируются.
+        """
+        return self._sign(filename, int(time.time()), expires_in, method="PUT")
+
+
+_service_lock = threading.Lock()
+_service = None
+
+
+def _reset_presign_service():
+    global _service_lock, _service
+    _service_lock = threading.Lock()
+    _service = None
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_presign_service)
+
+
+def get_presign_service() -> PresignService:
+    """
+    Возвращает общий для процесса экземпляр PresignService
+    """
+    global _service
+    if _service is None:
+        with _service_lock:
+            if _service is None:
+                _service = PresignService(
+                    bucket_name=settings.AWS_STORAGE_BUCKET_NAME,
+                    endpoint_url=settings.AWS_S3_ENDPOINT_URL,
+                    public_endpoint=settings.AWS_S3_PUBLIC_ENDPOINT,
+                    region=settings.AWS_S3_REGION_NAME,
+                    access_key=settings.AWS_ACCESS_KEY_ID,
+                    secret_key=settings.AWS_SECRET_ACCESS_KEY,
+                    cache_bucket=settings.PRESIGNED_URL_CACHE_BUCKET,
+                    cache_size=settings.PRESIGNED_URL_CACHE_SIZE,
+                )
+    return _service
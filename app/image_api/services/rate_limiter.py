@@ -0,0 +1,67 @@
+import logging
+import time
+
+from image_api.services.redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+# Атомарное пополнение и списание токена. Время берётся у Redis, поэтому
+# часы разных воркеров не влияют на лимит. Возвращает 0, если токен выдан,
+# иначе — сколько миллисекунд подождать до появления следующего.
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+local data = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(data[1]) or capacity
+local ts = tonumber(data[2]) or now
+tokens = math.min(capacity, tokens + (now - ts) * rate / 1000)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = math.ceil((1 - tokens) * 1000 / rate)
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil(capacity * 1000 / rate) + 1000)
+return wait
+"""
+
+
+class RateLimitTimeout(Exception):
+    pass
+
+
+class RedisTokenBucket:
+    """
+    Распределённый token bucket в Redis: не больше rate запросов в секунду
+    суммарно по всем процессам, с допустимым всплеском capacity.
+    """
+
+    def __init__(self, name: str, rate: float, capacity: int = 1):
+        self.key = f"ratelimit:{name}"
+        self.rate = rate
+        self.capacity = capacity
+        self._script = None
+
+    def try_acquire(self) -> int:
+        """
+        Пытается получить токен. Возвращает 0 при успехе или время ожидания в мс
+        """
+        if self._script is None:
+            self._script = get_redis().register_script(TOKEN_BUCKET_SCRIPT)
+        return int(self._script(keys=[self.key], args=[self.rate, self.capacity]))
+
+    def acquire(self, timeout: float = None) -> None:
+        """
+        Блокирует поток, пока не будет получен токен; по истечении timeout — RateLimitTimeout
+        """
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while True:
+            wait_ms = self.try_acquire()
+            if wait_ms == 0:
+                return
+            if deadline is not None and time.monotonic() + wait_ms / 1000 > deadline:
+                raise RateLimitTimeout(f"Rate limit {self.key} not acquired within {timeout}s")
+            time.sleep(wait_ms / 1000)
@@ -0,0 +1,50 @@
+import os
+import logging
+import threading
+
+import redis
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Один клиент Redis (и его пул соединений) на процесс; после fork создаётся заново
+_client_lock = threading.Lock()
+_client_registry = {}
+
+
+def _reset_client_registry():
+    """
+    Сбрасывает реестр в дочернем процессе после fork
+    """
+    global _client_lock
+    _client_lock = threading.Lock()
+    _client_registry.clear()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_client_registry)
+
+
+def get_redis() -> redis.Redis:
+    """
+    Возвращает общий для процесса клиент Redis для служебных данных приложения
+    (кеши, счётчики, очереди). Использует отдельную от брокера Celery базу REDIS_APP_DB.
+    """
+    pid = os.getpid()
+    client = _client_registry.get(pid)
+    if client is not None:
+        return client
+
+    with _client_lock:
+        client = _client_registry.get(pid)
+        if client is None:
+            _client_registry.clear()
+            client = redis.Redis(
+                host=settings.REDIS_HOST,
+                port=int(settings.REDIS_PORT),
+                password=settings.REDIS_PASSWORD or None,
+                db=settings.REDIS_APP_DB,
+                decode_responses=True,
+            )
+            _client_registry[pid] = client
+    return client
@@ -1,29 +1,160 @@
 import os
 import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import boto3
+from botocore.config import Config
 from botocore.exceptions import ClientError
 from typing import List, Dict, Any, Optional
 from urllib.parse import urlparse, urlunparse
 
 from django.conf import settings
 
+from image_api.services.presign_service import get_presign_service
+
 AWS_S3_ENDPOINT_URL = settings.AWS_S3_ENDPOINT_URL
 AWS_ACCESS_KEY_ID = settings.AWS_ACCESS_KEY_ID
 AWS_SECRET_ACCESS_KEY = settings.AWS_SECRET_ACCESS_KEY
 AWS_S3_REGION_NAME = settings.AWS_S3_REGION_NAME
+AWS_S3_MAX_POOL_CONNECTIONS = settings.AWS_S3_MAX_POOL_CONNECTIONS
+AWS_S3_UPLOAD_CONCURRENCY = settings.AWS_S3_UPLOAD_CONCURRENCY
+AWS_S3_UPLOAD_RETRIES = settings.AWS_S3_UPLOAD_RETRIES
+AWS_S3_UPLOAD_RETRY_BACKOFF = settings.AWS_S3_UPLOAD_RETRY_BACKOFF
+AWS_S3_MULTIPART_PART_SIZE = settings.AWS_S3_MULTIPART_PART_SIZE
+AWS_S3_MULTIPART_CONCURRENCY = settings.AWS_S3_MULTIPART_CONCURRENCY
+AWS_S3_RANGE_READ_BLOCK_SIZE = settings.AWS_S3_RANGE_READ_BLOCK_SIZE
+
+# Минимальный размер части multipart-загрузки в S3 (кроме последней)
+MIN_MULTIPART_PART_SIZE = 5 * 1024 * 1024
 
 logger = logging.getLogger(__name__)
 
+# Реестр клиентов S3: один клиент (и его пул соединений) на процесс.
+# Ключ — pid, поэтому после fork (gunicorn, Celery prefork) дочерний процесс
+# не унаследует сокеты родителя, а создаст собственный клиент.
+_client_lock = threading.Lock()
+_client_registry = {}
+
+
+def _reset_client_registry():
+    """
+    Сбрасывает реестр в дочернем процессе после fork
+    """
+    global _client_lock
+    _client_lock = threading.Lock()
+    _client_registry.clear()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_client_registry)
+
+
+def get_s3_client():
+    """
+    Возвращает общий для процесса клиент S3.
+    Клиенты boto3 потокобезопасны, поэтому один экземпляр используется
+    всеми потоками (gthread-воркеры, пулы загрузки).
+    """
+    pid = os.getpid()
+    client = _client_registry.get(pid)
+    if client is not None:
+        return client
+
+    with _client_lock:
+        client = _client_registry.get(pid)
+        if client is None:
+            # Клиенты, созданные до fork, в этом процессе не используются
+            _client_registry.clear()
+            session = boto3.session.Session()
+            client = session.client(
+                's3',
+                endpoint_url=AWS_S3_ENDPOINT_URL,
+                aws_access_key_id=AWS_ACCESS_KEY_ID,
+                aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
+                region_name=AWS_S3_REGION_NAME,
+                config=Config(
+                    max_pool_connections=AWS_S3_MAX_POOL_CONNECTIONS,
+                    s3={'addressing_style': settings.AWS_S3_ADDRESSING_STYLE},
+                ),
+            )
+            _client_registry[pid] = client
+            logger.info(f"S3 client created for pid {pid} (pool size {AWS_S3_MAX_POOL_CONNECTIONS})")
+    return client
+
+
+class S3RangeReader:
+    """
+    Файлоподобный объект (только чтение, с seek) поверх объекта S3.
+    Данные читаются ranged GET-запросами блоками не меньше block_size,
+    поэтому zipfile может прочитать центральный каталог и отдельные записи
+    архива, не скачивая его целиком.
+    """
+
+    def __init__(self, s3_client, bucket_name: str, key: str, block_size: int = None):
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.key = key
+        self.block_size = block_size or AWS_S3_RANGE_READ_BLOCK_SIZE
+        head = s3_client.head_object(Bucket=bucket_name, Key=key)
+        self.size = head['ContentLength']
+        self._pos = 0
+        self._buffer = b''
+        self._buffer_start = 0
+        self.requests_made = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        if whence == os.SEEK_SET:
+            self._pos = offset
+        elif whence == os.SEEK_CUR:
+            self._pos += offset
+        elif whence == os.SEEK_END:
+            self._pos = self.size + offset
+        else:
+            raise ValueError(f"Invalid whence: {whence}")
+        self._pos = max(0, self._pos)
+        return self._pos
+
+    def read(self, size: int = -1) -> bytes:
+        remaining = self.size - self._pos
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        if size <= 0:
+            return b''
+
+        offset = self._pos - self._buffer_start
+        if offset < 0 or offset + size > len(self._buffer):
+            end = min(self._pos + max(size, self.block_size), self.size) - 1
+            response = self.s3_client.get_object(
+                Bucket=self.bucket_name,
+                Key=self.key,
+                Range=f"bytes={self._pos}-{end}"
+            )
+            self._buffer = response['Body'].read()
+            self._buffer_start = self._pos
+            self.requests_made += 1
+            offset = 0
+
+        data = self._buffer[offset:offset + size]
+        self._pos += len(data)
+        return data
+
+    def close(self) -> None:
+        self._buffer = b''
+
 
 class S3Service:
     def __init__(self):
-        self.s3_client = boto3.client(
-            's3',
-            endpoint_url=AWS_S3_ENDPOINT_URL,
-            aws_access_key_id=AWS_ACCESS_KEY_ID,
-            aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
-            region_name=AWS_S3_REGION_NAME,
-        )
+        self.s3_client = get_s3_client()
         self.bucket_name = os.getenv('AWS_STORAGE_BUCKET_NAME')
 
     def upload_file(self, filename: str, content: bytes, content_type: str = 'application/octet-stream') -> bool:
@@ -71,23 +202,44 @@ class S3Service:
         endpoint_url = os.getenv('AWS_S3_ENDPOINT_URL', '').rstrip('/')
         return f"{endpoint_url}/{self.bucket_name}/{filename}"
 
+    def upload_file_with_retry(self, filename: str, content: bytes,
+                               content_type: str = 'application/octet-stream') -> bool:
+        """
+        Загружает файл в S3, повторяя попытку с экспоненциальной задержкой
+        """
+        for attempt in range(AWS_S3_UPLOAD_RETRIES + 1):
+            if attempt:
+                delay = AWS_S3_UPLOAD_RETRY_BACKOFF * (2 ** (attempt - 1))
+                logger.warning(f"Retrying S3 upload for {filename} in {delay:.2f}s (attempt {attempt + 1})")
+                time.sleep(delay)
+            if self.upload_file(filename, content, content_type):
+                return True
+        return False
+
     def batch_upload(self, files_data: List[Dict[str, Any]]) -> Dict[str, Any]:
         """
-        Загружает несколько файлов в S3
-        Возвращает словарь с результатами загрузки
+        Загружает несколько файлов в S3 параллельно (до AWS_S3_UPLOAD_CONCURRENCY одновременно)
+        Возвращает словарь с результатами загрузки в порядке входного списка
         """
         results = {
             'successful': [],
             'failed': []
         }
+        if not files_data:
+            return results
 
-        for file_data in files_data:
-            success = self.upload_file(
+        def upload(file_data):
+            return self.upload_file_with_retry(
                 filename=file_data['filename'],
                 content=file_data['content'],
                 content_type=file_data.get('content_type', 'application/octet-stream')
             )
 
+        workers = min(AWS_S3_UPLOAD_CONCURRENCY, len(files_data))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            outcomes = list(executor.map(upload, files_data))
+
+        for file_data, success in zip(files_data, outcomes):
             if success:
                 results['successful'].append({
                     'filename': file_data['filename'],
@@ -104,16 +256,177 @@ class S3Service:
 
         return results
 
+    def create_multipart_upload(self, filename: str, content_type: str = 'application/octet-stream') -> str:
+        """
+        Начинает multipart-загрузку и возвращает её UploadId
+        """
+        response = self.s3_client.create_multipart_upload(
+            Bucket=self.bucket_name,
+            Key=filename,
+            ContentType=content_type
+        )
+        return response['UploadId']
+
+    def upload_part(self, filename: str, upload_id: str, part_number: int, body) -> str:
+        """
+        Загружает одну часть multipart-загрузки и возвращает её ETag
+        """
+        response = self.s3_client.upload_part(
+            Bucket=self.bucket_name,
+            Key=filename,
+            UploadId=upload_id,
+            PartNumber=part_number,
+            Body=body
+        )
+        return response['ETag']
+
+    def complete_multipart_upload(self, filename: str, upload_id: str, parts: List[Dict[str, Any]]) -> None:
+        """
+        Завершает multipart-загрузку; parts — список {'PartNumber', 'ETag'}
+        """
+        self.s3_client.complete_multipart_upload(
+            Bucket=self.bucket_name,
+            Key=filename,
+            UploadId=upload_id,
+            MultipartUpload={'Parts': sorted(parts, key=lambda p: p['PartNumber'])}
+        )
+
+    def abort_multipart_upload(self, filename: str, upload_id: str) -> bool:
+        """
+        Отменяет multipart-загрузку и освобождает уже загруженные части
+        """
+        try:
+            self.s3_client.abort_multipart_upload(
+                Bucket=self.bucket_name,
+                Key=filename,
+                UploadId=upload_id
+            )
+            logger.info(f"Aborted multipart upload for {filename}")
+            return True
+        except Exception as e:
+            logger.error(f"Failed to abort multipart upload for {filename}: {str(e)}")
+            return False
+
+    @staticmethod
+    def _iter_chunks(file_obj, chunk_size: int):
+        if hasattr(file_obj, 'chunks'):
+            # Django UploadedFile
+            yield from file_obj.chunks(chunk_size)
+            return
+        while True:
+            chunk = file_obj.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+    def upload_fileobj_multipart(self, filename: str, file_obj, content_type: str = 'application/octet-stream',
+                                 part_size: int = None, concurrency: int = None) -> bool:
+        """
+        Потоково загружает файловый объект в S3 частями.
+        Части читаются по одной и загружаются параллельно; одновременно в памяти
+        находится не больше concurrency + 1 частей, независимо от размера файла.
+        При любой ошибке загрузка отменяется (abort_multipart_upload).
+        """
+        part_size = max(part_size or AWS_S3_MULTIPART_PART_SIZE, MIN_MULTIPART_PART_SIZE)
+        concurrency = concurrency or AWS_S3_MULTIPART_CONCURRENCY
+
+        if hasattr(file_obj, 'seek'):
+            file_obj.seek(0)
+
+        # Небольшие файлы проще отправить одним PUT
+        size = getattr(file_obj, 'size', None)
+        if size is not None and size <= part_size:
+            return self.upload_file(filename, file_obj.read(), content_type)
+
+        try:
+            upload_id = self.create_multipart_upload(filename, content_type)
+        except Exception as e:
+            logger.error(f"Failed to start multipart upload for {filename}: {str(e)}")
+            return False
+
+        slots = threading.BoundedSemaphore(concurrency)
+        failed = threading.Event()
+        futures = []
+
+        def on_part_done(future):
+            if future.exception() is not None:
+                failed.set()
+            slots.release()
+
+        try:
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                for part_number, chunk in enumerate(self._iter_chunks(file_obj, part_size), start=1):
+                    slots.acquire()
+                    if failed.is_set():
+                        # Часть уже не загрузилась — дальше читать файл незачем
+                        slots.release()
+                        break
+                    future = executor.submit(self.upload_part, filename, upload_id, part_number, chunk)
+                    future.add_done_callback(on_part_done)
+                    futures.append((part_number, future))
+
+            parts = [{'PartNumber': number, 'ETag': future.result()} for number, future in futures]
+            if not parts:
+                raise ValueError("Empty file")
+            self.complete_multipart_upload(filename, upload_id, parts)
+            logger.info(f"Uploaded to S3 in {len(parts)} parts: {filename}")
+            return True
+        except Exception as e:
+            logger.error(f"Multipart upload error for {filename}: {str(e)}")
+            self.abort_multipart_upload(filename, upload_id)
+            return False
+
+    def open_range_reader(self, filename: str) -> S3RangeReader:
+        """
+        Открывает объект S3 для чтения с произвольным доступом (ranged GET)
+        """
+        return S3RangeReader(self.s3_client, self.bucket_name, filename)
+
     def batch_delete(self, filenames: List[str]) -> bool:
         """
-        Удаляет несколько файлов из S3
+        Удаляет несколько файлов из S3 запросами DeleteObjects (до 1000 ключей в каждом)
         """
         success = True
-        for filename in filenames:
-            if not self.delete_file(filename):
+        for start in range(0, len(filenames), 1000):
+            chunk = filenames[start:start + 1000]
+            try:
+                response = self.s3_client.delete_objects(
+                    Bucket=self.bucket_name,
+                    Delete={'Objects': [{'Key': filename} for filename in chunk], 'Quiet': True}
+                )
+            except Exception as e:
+                logger.error(f"S3 batch delete error for {len(chunk)} files: {str(e)}")
+                success = False
+                continue
+            for error in response.get('Errors', []):
+                logger.error(f"S3 delete error for {error.get('Key')}: {error.get('Message')}")
                 success = False
         return success
 
+    def batch_head(self, filenames: List[str]) -> Dict[str, Optional[int]]:
+        """
+        Проверяет наличие нескольких объектов параллельными HEAD-запросами.
+        Возвращает размер каждого объекта в байтах или None, если объекта нет
+        """
+        if not filenames:
+            return {}
+
+        workers = min(AWS_S3_UPLOAD_CONCURRENCY, len(filenames))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return dict(zip(filenames, executor.map(self.head_file, filenames)))
+
+    def head_file(self, filename: str) -> Optional[int]:
+        """
+        Размер объекта в байтах или None, если объекта нет
+        """
+        try:
+            response = self.s3_client.head_object(Bucket=self.bucket_name, Key=filename)
+            return response['ContentLength']
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') not in ('404', 'NoSuchKey', 'NotFound'):
+                logger.error(f"S3 head error for {filename}: {str(e)}")
+            return None
+
     def validate_connection(self) -> bool:
         """
         Проверяет возможность подключения к S3
@@ -144,18 +457,20 @@ class S3Service:
         """
         Генерирует presigned URL для приватного объекта.
         expires_in — срок жизни ссылки в секундах (по умолчанию 1 час).
+        Подпись и кеширование выполняет PresignService.
         """
         try:
-            url = self.s3_client.generate_presigned_url(
-                "get_object",
-                Params={"Bucket": self.bucket_name, "Key": filename},
-                ExpiresIn=expires_in
-            )
-            public_host = settings.AWS_S3_PUBLIC_ENDPOINT
-            url = self.rewrite_presigned_url(url, public_host)
-            return url
+            return get_presign_service().presign(filename, expires_in)
         except Exception as e:
             logger.error(f"Error generating presigned URL for {filename}: {str(e)}")
             return None
-        
-     
+
+    def generate_upload_url(self, filename: str, expires_in: int = 900) -> Optional[str]:
+        """
+        Генерирует presigned URL для загрузки объекта клиентом методом PUT
+        """
+        try:
+            return get_presign_service().presign_put(filename, expires_in)
+        except Exception as e:
+            logger.error(f"Error generating upload URL for {filename}: {str(e)}")
+            return None
@@ -1,15 +1,30 @@
-from celery import shared_task
-from .models import ImageLocation
-from .utils import _send_geo_request_internal  # внутренняя версия _send_geo_request
+from celery import chord, shared_task
+from .models import ImageLocation, DetectedImageLocation
 from django.core.exceptions import ObjectDoesNotExist
+from django.db import DatabaseError
+from django.db.models import F, Q
+from django.utils import timezone
 import logging
-from image_api.models import UploadedArchive
-from image_api.services.image_upload_service import ImageUploadService
+from image_api.models import UploadedArchive, CallbackReceipt
+from image_api.services.image_upload_service import (
+    ImageUploadService, build_geo_task, needs_forward_geocoding, needs_reverse_geocoding
+)
+from image_api.services.geocoding_service import GeocodingService, GeocodingError
+from image_api.services.callback_service import CallbackService
+from image_api.services.geocoding_queue import GeocodingQueue, KIND_FORWARD, PRIORITY_HIGH, PRIORITY_NORMAL
+from image_api.services.admission_controller import AdmissionController
+from image_api.services.prediction_batcher import PredictionBatcher, dispatch_geo_tasks
+from image_api.services.prediction_client import get_prediction_client
 from image_api.services.s3_service import S3Service
 import zipfile
-import io
+from collections import defaultdict
+from datetime import timedelta
+import math
+import resource
+import sys
 import uuid
 import json
+from django.conf import settings
 
 logger = logging.getLogger(__name__)
 
@@ -17,92 +32,475 @@ DEFAULT_ANGLE=0
 DEFAULT_HEIGHT=1.5
 
 @shared_task
-def process_geo_tasks(images_data):
+def process_geo_tasks(images_data, attempt=0):
     """
     Асинхронная задача для отправки запроса на геолокацию.
+    Задачи отправляются частями; если часть не принята целиком из-за сбоя
+    сервиса, повторно отправляются только её задачи, остальные не затрагиваются.
+    Часть, ответ на которую не получен по таймауту чтения, не повторяется.
     """
-    geo_result = _send_geo_request_internal(images_data)
+    retry_images = []
+    accepted_ids = []
+    failed_errors = defaultdict(list)
 
-    if geo_result:
+    for chunk, geo_result in get_prediction_client().dispatch(images_data):
         for error in geo_result['errors']:
-            task_id = error['task_id']
+            failed_errors[error.get('error')].append(error['task_id'])
+
+        if geo_result['request_error'] is None:
+            rejected = {str(error['task_id']) for error in geo_result['errors']}
+            accepted_ids.extend(img['task_id'] for img in chunk if str(img['task_id']) not in rejected)
+            continue
+        if geo_result['delivery_unknown']:
+            # Сервис мог принять задачи: не отправляем повторно, записи остаются в processing,
+            # и если результат не придёт, их повторно отправит sweep_stale_locations_task
+            logger.warning(f"Geo request for {len(chunk)} tasks timed out: {geo_result['request_error']}")
+            accepted_ids.extend(img['task_id'] for img in chunk)
+            continue
+        if geo_result['retryable'] and attempt < settings.PREDICTION_DISPATCH_RETRIES:
+            retry_images.extend(chunk)
+        else:
+            logger.error(f"Geo request for {len(chunk)} tasks failed: {geo_result['request_error']}")
+            failed_errors[f"Prediction request failed: {geo_result['request_error']}"].extend(
+                img['task_id'] for img in chunk
+            )
+
+    for error_reason, task_ids in failed_errors.items():
+        ids = [int(task_id) for task_id in task_ids if str(task_id).isdigit()]
+        updated = ImageLocation.objects.filter(id__in=ids).update(status='failed', error_reason=error_reason)
+        logger.info(f"Marked {updated} ImageLocation as 'failed': {error_reason}")
+    # Срок ожидания результата отсчитывается от фактической отправки
+    if accepted_ids:
+        ImageLocation.objects.filter(id__in=accepted_ids, status='processing').update(processing_since=timezone.now())
+    # Отклонённые задачи не ждут callback — освобождаем их слоты в окне
+    AdmissionController().release(
+        task_id for task_ids in failed_errors.values() for task_id in task_ids
+    )
+
+    if retry_images:
+        countdown = settings.PREDICTION_DISPATCH_RETRY_BACKOFF * (2 ** attempt)
+        logger.warning(f"Retrying dispatch of {len(retry_images)} tasks in {countdown}s (attempt {attempt + 1})")
+        process_geo_tasks.apply_async(args=[retry_images, attempt + 1], countdown=countdown)
+
+@shared_task
+def flush_prediction_batch_task():
+    """
+    Отправляет накопленные задачи на распознавание пачками по PREDICTION_BATCH_SIZE,
+    не превышая окно задач в работе (AdmissionController)
+    """
+    batcher = PredictionBatcher()
+    admission = AdmissionController()
+    # Снимаем отметку до чтения буфера: задачи, добавленные после этого,
+    # либо попадут в текущую отправку, либо запланируют следующую
+    batcher.reset_schedule()
+    while True:
+        images_data = admission.admit(settings.PREDICTION_BATCH_SIZE)
+        if not images_data:
+            break
+        logger.info(f"Flushing prediction batch of {len(images_data)} tasks")
+        process_geo_tasks(images_data)
+        if len(images_data) < settings.PREDICTION_BATCH_SIZE:
+            break
+
+    # Окно заполнено: оставшиеся задачи ждут освобождения слотов (callback или таймаут)
+    held = batcher.size()
+    if held:
+        logger.info(f"{held} prediction tasks held until the in-flight window frees up")
+        batcher.schedule_flush(settings.PREDICTION_ADMISSION_POLL_INTERVAL)
+
+
+@shared_task
+def sweep_stale_locations_task():
+    """
+    Периодическая задача (Celery beat): находит записи, которые дольше
+    PROCESSING_STALE_AFTER секунд остаются в processing, и отправляет их
+    повторно пачками. После PROCESSING_MAX_REDISPATCHES повторов запись
+    помечается failed. Записи, которые ещё ждут в буфере PredictionBatcher
+    (например, пока окно AdmissionController заполнено) или в очереди
+    геокодирования, не отправляются повторно: для них срок ожидания
+    отсчитывается заново. Выборка идёт по
+    частичному индексу status='processing', поэтому её стоимость зависит от
+    числа зависших записей, а не от размера таблицы.
+    """
+    cutoff = timezone.now() - timedelta(seconds=settings.PROCESSING_STALE_AFTER)
+    max_attempts = settings.PROCESSING_MAX_REDISPATCHES
+    redispatched = failed = waiting = 0
+    # Задачи из буфера и записи, ждущие геокодирования, ещё не отправлялись —
+    # повторная отправка создала бы дубли
+    waiting_ids = PredictionBatcher().pending_task_ids()
+    waiting_ids |= {str(location_id) for location_id in GeocodingQueue().pending_dispatch_ids()}
+
+    while redispatched + failed + waiting < settings.PROCESSING_SWEEP_MAX_ITEMS:
+        stale = list(
+            ImageLocation.objects
+            .filter(status='processing', processing_since__lt=cutoff)
+            .order_by('processing_since')
+            .only('id', 'address', 'lat', 'lon', 'dispatch_attempts')[:settings.PROCESSING_SWEEP_BATCH_SIZE]
+        )
+        if not stale:
+            break
+
+        still_waiting = [loc.id for loc in stale if str(loc.id) in waiting_ids]
+        if still_waiting:
+            ImageLocation.objects.filter(id__in=still_waiting, status='processing').update(
+                processing_since=timezone.now()
+            )
+            stale = [loc for loc in stale if str(loc.id) not in waiting_ids]
+            waiting += len(still_waiting)
+
+        exhausted = [loc.id for loc in stale if loc.dispatch_attempts >= max_attempts]
+        retry = [loc for loc in stale if loc.dispatch_attempts < max_attempts]
+
+        if exhausted:
+            ImageLocation.objects.filter(id__in=exhausted, status='processing').update(
+                status='failed',
+                error_reason=f"No result from prediction service after {max_attempts} retries"
+            )
+        if retry:
+            # Сдвигаем processing_since, чтобы запись не попала в следующую пачку этого же прохода
+            ImageLocation.objects.filter(id__in=[loc.id for loc in retry], status='processing').update(
+                processing_since=timezone.now(),
+                dispatch_attempts=F('dispatch_attempts') + 1
+            )
+        # Слоты зависших задач в окне больше не нужны
+        AdmissionController().release(loc.id for loc in stale)
+
+        # Записи без координат снова проходят геокодирование, остальные — сразу на распознавание
+        to_enrich = [loc.id for loc in retry if needs_forward_geocoding(loc)]
+        if to_enrich:
+            enrich_locations_task.delay(to_enrich)
+        _dispatch_locations([loc.id for loc in retry if not needs_forward_geocoding(loc)])
+
+        redispatched += len(retry)
+        failed += len(exhausted)
+
+    if redispatched or failed:
+        logger.warning(f"Stale processing sweep: {redispatched} re-dispatched, {failed} marked failed")
+    if waiting:
+        logger.info(f"Stale processing sweep: {waiting} still waiting for geocoding or in the prediction buffer")
+    return {"redispatched": redispatched, "failed": failed, "waiting": waiting}
+
+
+@shared_task
+def expire_archive_upload_sessions_task():
+    """
+    Периодическая задача (Celery beat): отменяет возобновляемые загрузки архивов,
+    брошенные клиентом, и освобождает их части и объекты в S3
+    """
+    # Сервис загрузки архивов сам импортирует задачи этого модуля
+    from image_api.services.archive_upload_service import expire_stale_sessions
+
+    return {"expired": expire_stale_sessions()}
+
+
+@shared_task
+def enrich_locations_task(location_ids):
+    """
+    Фоновое геокодирование новых ImageLocation: ставит в очередь геокодирования
+    определение координат по адресу (с последующей отправкой на распознавание)
+    и адреса по координатам. Сами запросы выполняет geocoding_worker_task.
+    """
+    geocoding = GeocodingService()
+    locations = ImageLocation.objects.filter(id__in=location_ids).only('id', 'address', 'lat', 'lon')
+
+    for location in locations:
+        target = {"type": "image_location", "id": location.id}
+        if needs_forward_geocoding(location):
+            geocoding.submit_forward(location.address, {**target, "dispatch": True}, PRIORITY_HIGH)
+        elif needs_reverse_geocoding(location):
+            geocoding.submit_reverse(location.lat, location.lon, target, PRIORITY_NORMAL)
+
+
+def _apply_geocoding_result(kind, result, targets):
+    """
+    Записывает результат геокодирования во все ожидающие его записи.
+    Возвращает id ImageLocation, которые после этого нужно отправить на распознавание.
+    """
+    location_ids = [t["id"] for t in targets if t["type"] == "image_location"]
+    detected_ids = [t["id"] for t in targets if t["type"] == "detected_location"]
+
+    if result is not None:
+        if kind == KIND_FORWARD:
+            lat, lon = result
+            ImageLocation.objects.filter(id__in=location_ids, lat__isnull=True).update(lat=lat, lon=lon)
+        else:
+            ImageLocation.objects.filter(id__in=location_ids).filter(
+                Q(address__isnull=True) | Q(address="")
+            ).update(address=result)
+            DetectedImageLocation.objects.filter(id__in=detected_ids).update(address=result)
+
+    return [t["id"] for t in targets if t["type"] == "image_location" and t.get("dispatch")]
+
+
+def _dispatch_locations(location_ids):
+    locations = ImageLocation.objects.filter(id__in=location_ids, status='processing').select_related('image')
+    dispatch_geo_tasks([build_geo_task(loc) for loc in locations])
+
+
+@shared_task
+def geocoding_worker_task():
+    """
+    Единственный на все воркеры обработчик очереди геокодирования.
+    Берёт запросы по приоритету, выполняет их с учётом общего лимита
+    частоты запросов к Nominatim и раздаёт результат всем ожидающим записям.
+    Запрос, на который геокодер не ответил, повторяется с экспоненциальной
+    задержкой (см. _handle_geocoding_failure).
+    """
+    queue = GeocodingQueue()
+    lock_ttl = settings.GEOCODING_WORKER_LOCK_TTL
+    if not queue.acquire_worker_lock(lock_ttl):
+        return
+    queue.promote_due()
+
+    geocoding = GeocodingService()
+    to_dispatch = []
+    processed = 0
+    try:
+        while processed < settings.GEOCODING_WORKER_MAX_ITEMS:
+            item = queue.pop()
+            if item is None:
+                break
+            queue.refresh_worker_lock(lock_ttl)
+
             try:
-                location = ImageLocation.objects.get(id=int(task_id))
-                location.status = 'failed'
-                location.save()
-                logger.info(f"Updated ImageLocation {location.id} to 'failed'")
-            except ImageLocation.DoesNotExist:
-                logger.warning(f"ImageLocation not found for task_id={task_id}")
-    else:
-        logger.error("Geo request failed with no result returned.")
+                result = geocoding.resolve(item["kind"], item["query"])
+                to_dispatch.extend(_apply_geocoding_result(item["kind"], result, item["targets"]))
+            except GeocodingError as e:
+                _handle_geocoding_failure(queue, item, e)
+            except Exception as e:
+                logger.error(f"Failed to process geocoding lookup {item['key']}: {e}", exc_info=True)
+                to_dispatch.extend(t["id"] for t in item["targets"] if t.get("dispatch"))
+            processed += 1
+
+            if len(to_dispatch) >= settings.GEOCODING_ENRICHMENT_BATCH_SIZE:
+                _dispatch_locations(to_dispatch)
+                to_dispatch = []
+    finally:
+        queue.release_worker_lock()
+        if to_dispatch:
+            _dispatch_locations(to_dispatch)
+
+    logger.info(f"Geocoding worker processed {processed} lookups")
+    # Запросы, поступившие во время работы или сверх лимита, — следующему запуску
+    if queue.size():
+        geocoding_worker_task.delay()
+        return
+    retry_delay = queue.next_retry_delay()
+    if retry_delay is not None:
+        geocoding_worker_task.apply_async(countdown=max(1, math.ceil(retry_delay)))
+
+
+def _handle_geocoding_failure(queue, item, error):
+    """
+    Откладывает запрос, на который геокодер не ответил, с экспоненциальной задержкой.
+    После GEOCODING_MAX_RETRIES попыток записи, ожидавшие координаты для отправки
+    на распознавание, помечаются failed; адреса остаются незаполненными.
+    """
+    attempts = item["attempts"] + 1
+    if attempts <= settings.GEOCODING_MAX_RETRIES:
+        delay = settings.GEOCODING_RETRY_BACKOFF * (2 ** (attempts - 1))
+        logger.warning(f"Geocoding lookup {item['key']} failed ({error}), retry {attempts} in {delay}s")
+        queue.requeue(item, attempts, delay)
+        return
+
+    logger.error(f"Geocoding lookup {item['key']} failed after {attempts} attempts: {error}")
+    if item["kind"] == KIND_FORWARD:
+        location_ids = [t["id"] for t in item["targets"] if t["type"] == "image_location" and t.get("dispatch")]
+        ImageLocation.objects.filter(id__in=location_ids, status='processing').update(
+            status='failed', error_reason=f"Geocoding failed: {error}"
+        )
+
+
+@shared_task(bind=True, acks_late=True, max_retries=5)
+def apply_main_result_task(self, payload, receipt_id=None):
+    """
+    Применяет основной результат распознавания, принятый image_location_callback
+    """
+    try:
+        return CallbackService().process(CallbackReceipt.TYPE_MAIN, payload, receipt_id)
+    except DatabaseError as e:
+        logger.error(f"Failed to apply main result for TaskId {payload.get('TaskId')}: {e}")
+        raise self.retry(exc=e, countdown=2 ** self.request.retries)
+
+
+@shared_task(bind=True, acks_late=True, max_retries=5)
+def apply_trash_result_task(self, payload, receipt_id=None):
+    """
+    Применяет результат поиска мусора, принятый image_trash_result_callback
+    """
+    try:
+        return CallbackService().process(CallbackReceipt.TYPE_TRASH, payload, receipt_id)
+    except DatabaseError as e:
+        logger.error(f"Failed to apply trash result for TaskId {payload.get('TaskId')}: {e}")
+        raise self.retry(exc=e, countdown=2 ** self.request.retries)
+
+
+def _peak_rss_mb():
+    """
+    Пиковый RSS процесса воркера в МБ за всё время его жизни (getrusage учитывает
+    и память, занятую внутри upload_and_process, а не только между порциями)
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux возвращает килобайты, macOS — байты
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def _load_archive_metadata(s3, archive):
+    """
+    Загружает JSON с метаданными архива и возвращает словарь по имени файла
+    """
+    if not archive.metadata_filename:
+        return {}
+    try:
+        meta_obj = s3.s3_client.get_object(Bucket=s3.bucket_name, Key=archive.metadata_filename)
+        meta_bytes = meta_obj["Body"].read()
+        metadata_list = json.loads(meta_bytes.decode("utf-8"))
+        # превращаем список в словарь по имени файла
+        return {item["image"]: item for item in metadata_list}
+    except Exception as e:
+        logger.error(f"Failed to load metadata JSON for archive {archive.id}: {e}")
+        return {}
+
+
+def _index_archive_entries(zf):
+    """
+    Строит индекс изображений по центральному каталогу архива: список [index, name]
+    """
+    entries = []
+    image_files = [f for f in zf.namelist() if not f.endswith("/")]
+
+    for i, name in enumerate(image_files):
+        if not name.lower().endswith((".jpg", ".jpeg", ".png", ".gif")):
+            logger.warning(f"Skipped non-image file: {name}")
+            continue
+        entries.append([i, name])
+    return entries
+
+
+def _iter_archive_batches(zf, entries, metadata_map, batch_size):
+    """
+    Читает изображения entries из архива и отдаёт их порциями по batch_size.
+    В памяти одновременно находится только содержимое текущей порции.
+    """
+    batch = []
+
+    for i, name in entries:
+        with zf.open(name) as file_data:
+            content = file_data.read()
+
+        # берём метаданные, если есть
+        meta = metadata_map.get(name, {})
+        batch.append({
+            "filename": f"{uuid.uuid4()}_{name}",
+            "content": content,
+            "original_filename": name,
+            "index": i,
+            "content_type": (
+                "image/jpeg" if name.lower().endswith(("jpg", "jpeg")) else "image/png"
+            ),
+            "address": meta.get("address"),
+            "lat": meta.get("lat"),
+            "lon": meta.get("lon"),
+            "angle": meta.get("angle", DEFAULT_ANGLE),
+            "height": meta.get("height", DEFAULT_HEIGHT),
+        })
+
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
 
 @shared_task
 def process_archive_task(archive_id):
+    """
+    Координатор обработки архива: читает центральный каталог ZIP (ranged GET),
+    делит изображения на части по ARCHIVE_CHUNK_SIZE и запускает их обработку
+    параллельными подзадачами. По завершении всех частей chord вызывает
+    finalize_archive_task.
+    """
     try:
         archive = UploadedArchive.objects.get(id=archive_id)
         logger.info(f"Processing archive {archive.filename}")
 
         s3 = S3Service()
+        with zipfile.ZipFile(s3.open_range_reader(archive.filename)) as zf:
+            entries = _index_archive_entries(zf)
 
-        # Скачиваем архив
-        obj = s3.s3_client.get_object(Bucket=s3.bucket_name, Key=archive.filename)
-        file_bytes = obj["Body"].read()
+        if not entries:
+            logger.warning(f"Archive {archive_id} contains no images")
+            return
 
-        # Загружаем JSON, если есть
-        metadata_map = {}
-        if archive.metadata_filename:
-            try:
-                meta_obj = s3.s3_client.get_object(Bucket=s3.bucket_name, Key=archive.metadata_filename)
-                meta_bytes = meta_obj["Body"].read()
-                metadata_list = json.loads(meta_bytes.decode("utf-8"))
-                # превращаем список в словарь по имени файла
-                metadata_map = {item["image"]: item for item in metadata_list}
-            except Exception as e:
-                logger.error(f"Failed to load metadata JSON for archive {archive_id}: {e}")
-
-        validated_files = []
-        with zipfile.ZipFile(io.BytesIO(file_bytes)) as zf:
-            image_files = [f for f in zf.namelist() if not f.endswith("/")]
-
-            for i, name in enumerate(image_files):
-                if not name.lower().endswith((".jpg", ".jpeg", ".png", ".gif")):
-                    logger.warning(f"Skipped non-image file: {name}")
-                    continue
-
-                with zf.open(name) as file_data:
-                    content = file_data.read()
-
-                # берём метаданные, если есть
-                meta = metadata_map.get(name, {})
-                validated_files.append({
-                    "filename": f"{uuid.uuid4()}_{name}",
-                    "content": content,
-                    "original_filename": name,
-                    "index": i,
-                    "content_type": (
-                        "image/jpeg" if name.lower().endswith(("jpg", "jpeg")) else "image/png"
-                    ),
-                    "address": meta.get("address"),
-                    "lat": meta.get("lat"),
-                    "lon": meta.get("lon"),
-                    "angle": meta.get("angle", DEFAULT_ANGLE),
-                    "height": meta.get("height", DEFAULT_HEIGHT),
-                })
-
-        if validated_files:
-            service = ImageUploadService(archive.user)
-            uploaded_images, errors = service.upload_and_process(validated_files)
-            if errors:
-                logger.error(f"Errors while processing archive {archive_id}: {errors}")
-            else:
-                try:
-                    s3.delete_file(archive.filename)
-                    if archive.metadata_filename:
-                        s3.delete_file(archive.metadata_filename)
-                    archive.delete()
-                    logger.info(f"Archive {archive.filename} and metadata deleted from DB and S3")
-                except Exception as cleanup_error:
-                    logger.error(f"Cleanup error for archive {archive_id}: {cleanup_error}")
+        chunk_size = settings.ARCHIVE_CHUNK_SIZE
+        chunks = [entries[i:i + chunk_size] for i in range(0, len(entries), chunk_size)]
+        logger.info(f"Archive {archive_id}: {len(entries)} images split into {len(chunks)} chunks")
+
+        chord(
+            process_archive_chunk_task.s(archive_id, chunk) for chunk in chunks
+        )(finalize_archive_task.s(archive_id))
 
     except Exception as e:
         logger.error(f"Error processing archive {archive_id}: {str(e)}")
+
+
+@shared_task
+def process_archive_chunk_task(archive_id, entries):
+    """
+    Обрабатывает часть архива: извлекает изображения entries ([index, name]),
+    загружает их в S3, создаёт записи в БД и отправляет на распознавание.
+    Возвращает {'processed', 'errors', 'peak_rss_mb'} для finalize_archive_task.
+    """
+    result = {'processed': 0, 'errors': [], 'peak_rss_mb': None}
+    try:
+        archive = UploadedArchive.objects.get(id=archive_id)
+        s3 = S3Service()
+        metadata_map = _load_archive_metadata(s3, archive)
+        service = ImageUploadService(archive.user)
+
+        with zipfile.ZipFile(s3.open_range_reader(archive.filename)) as zf:
+            for batch in _iter_archive_batches(zf, entries, metadata_map, settings.ARCHIVE_PROCESSING_BATCH_SIZE):
+                _, batch_errors = service.upload_and_process(batch)
+                if batch_errors:
+                    result['errors'].extend(batch_errors)
+                else:
+                    result['processed'] += len(batch)
+        result['peak_rss_mb'] = round(_peak_rss_mb(), 1)
+
+    except Exception as e:
+        logger.error(f"Error processing chunk of archive {archive_id}: {str(e)}")
+        result['errors'].append({'error': str(e)})
+
+    return result
+
+
+@shared_task
+def finalize_archive_task(chunk_results, archive_id):
+    """
+    Завершение обработки архива: если все части обработаны без ошибок,
+    удаляет архив и метаданные из S3 и БД.
+    """
+    processed_count = sum(r['processed'] for r in chunk_results)
+    errors = [error for r in chunk_results for error in r['errors']]
+    peaks = [r['peak_rss_mb'] for r in chunk_results if r.get('peak_rss_mb') is not None]
+
+    logger.info(
+        f"Archive {archive_id}: {processed_count} images processed in {len(chunk_results)} chunks, "
+        f"peak worker RSS (process high-water mark) {max(peaks, default=0):.1f} MB"
+    )
+
+    if errors:
+        logger.error(f"Errors while processing archive {archive_id}: {errors}")
+        return
+
+    try:
+        archive = UploadedArchive.objects.get(id=archive_id)
+        s3 = S3Service()
+        s3.delete_file(archive.filename)
+        if archive.metadata_filename:
+            s3.delete_file(archive.metadata_filename)
+        archive.delete()
+        logger.info(f"Archive {archive.filename} and metadata deleted from DB and S3")
+    except Exception as cleanup_error:
+        logger.error(f"Cleanup error for archive {archive_id}: {cleanup_error}")
@@ -1,3 +1,327 @@
-from django.test import TestCase
+import io
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from botocore.exceptions import ClientError
+from django.contrib.auth import get_user_model
+from django.db import DatabaseError
+from django.db.models import QuerySet
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from .models import ArchiveUploadSession, CallbackReceipt, ImageLocation, UploadedImage
+from .services.archive_upload_service import ArchiveUploadService, UploadSessionError
+from .services.callback_service import CallbackService
+from .tasks import sweep_stale_locations_task
+
+
+def create_location(user, **fields):
+    image = UploadedImage.objects.create(
+        filename="photo.jpg", original_filename="photo.jpg", file_path="uploads/photo.jpg",
+        s3_url="http://s3.invalid/photo.jpg", user=user
+    )
+    return ImageLocation.objects.create(user=user, image=image, **fields)
+
+
+class CallbackIdempotencyTests(TestCase):
+    """
+    Повторные доставки image_location_callback: квитанции pending и done
+    """
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username="owner", password="secret")
+        self.location = create_location(self.user, status="processing", lat=55.75, lon=37.61, address="Москва")
+        self.client = APIClient()
+        self.url = reverse("image-location-callback")
+        self.payload = {"TaskId": str(self.location.id), "Status": "Failed"}
+
+        release = mock.patch("image_api.callbacks.AdmissionController.release")
+        release.start()
+        self.addCleanup(release.stop)
+        apply_task = mock.patch("image_api.callbacks.apply_main_result_task")
+        self.apply_task = apply_task.start()
+        self.addCleanup(apply_task.stop)
+
+    def post(self, payload=None):
+        return self.client.post(self.url, payload or self.payload, format="json")
+
+    def test_new_delivery_is_enqueued(self):
+        response = self.post()
+
+        self.assertEqual(response.status_code, 202)
+        receipt = CallbackReceipt.objects.get()
+        self.assertEqual(receipt.status, CallbackReceipt.STATUS_PENDING)
+        self.apply_task.delay.assert_called_once_with(mock.ANY, receipt.id)
+
+    def test_pending_duplicate_is_enqueued_again(self):
+        self.post()
+        response = self.post()
+
+        self.assertEqual(response.status_code, 202)
+        self.assertTrue(response.data["duplicate"])
+        receipt = CallbackReceipt.objects.get()
+        self.assertEqual(receipt.deliveries, 2)
+        self.assertEqual(self.apply_task.delay.call_count, 2)
+
+    def test_done_duplicate_returns_saved_outcome(self):
+        self.post()
+        receipt = CallbackReceipt.objects.get()
+        outcome = CallbackService().process(CallbackReceipt.TYPE_MAIN, self.payload, receipt.id)
+
+        response = self.post()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["status"], "duplicate")
+        self.assertEqual(response.data["outcome"], outcome)
+        self.apply_task.delay.assert_called_once()
+
+    def test_receipt_is_applied_once(self):
+        receipt, _ = CallbackService().register_delivery(CallbackReceipt.TYPE_MAIN, self.payload)
+        first = CallbackService().process(CallbackReceipt.TYPE_MAIN, self.payload, receipt.id)
+        ImageLocation.objects.filter(id=self.location.id).update(status="processing")
+
+        second = CallbackService().process(CallbackReceipt.TYPE_MAIN, self.payload, receipt.id)
+
+        self.assertEqual(second, first)
+        self.location.refresh_from_db()
+        self.assertEqual(self.location.status, "processing")
+
+    def test_overlong_task_id_is_rejected(self):
+        response = self.post({"TaskId": "1" * 65, "Status": "Failed"})
+
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("TaskId", response.data["details"])
+        self.assertFalse(CallbackReceipt.objects.exists())
+        self.apply_task.delay.assert_not_called()
+
+
+class BatchCallbackTests(TestCase):
+    """
+    CallbackService.apply_batch: блокировка ImageLocation и повторные пачки
+    """
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username="owner", password="secret")
+        self.locations = [create_location(self.user, status="processing", address="Москва") for _ in range(2)]
+        self.main = [
+            {"TaskId": str(location.id), "Status": "Succeeded", "Result": {"Latitude": 55.7, "Longitude": 37.6}}
+            for location in self.locations
+        ]
+
+    def test_locations_are_locked_before_update(self):
+        locked_models = []
+        select_for_update = QuerySet.select_for_update
+
+        def spy(queryset, *args, **kwargs):
+            locked_models.append(queryset.model)
+            return select_for_update(queryset, *args, **kwargs)
+
+        with mock.patch.object(QuerySet, "select_for_update", spy):
+            results = CallbackService().apply_batch(self.main, [])
+
+        self.assertIn(ImageLocation, locked_models)
+        self.assertEqual([r["outcome"] for r in results], ["done", "done"])
+        for location in self.locations:
+            location.refresh_from_db()
+            self.assertEqual((location.status, location.lat, location.lon), ("done", 55.7, 37.6))
+
+    def test_repeated_batch_is_not_applied_again(self):
+        CallbackService().apply_batch(self.main, [])
+        ImageLocation.objects.filter(id=self.locations[0].id).update(status="processing")
+
+        results = CallbackService().apply_batch(self.main, [])
+
+        self.assertTrue(all(r["duplicate"] for r in results))
+        self.locations[0].refresh_from_db()
+        self.assertEqual(self.locations[0].status, "processing")
+
+
+@override_settings(PROCESSING_STALE_AFTER=60, PROCESSING_MAX_REDISPATCHES=3)
+class SweepStaleLocationsTests(TestCase):
+    """
+    sweep_stale_locations_task при заполненной очереди геокодирования
+    """
+
+    def setUp(self):
+        user = get_user_model().objects.create_user(username="owner", password="secret")
+        stale_since = timezone.now() - timedelta(hours=1)
+        # Обе записи без координат: ждут прямого геокодирования
+        self.geocoding = create_location(user, status="processing", address="Москва", processing_since=stale_since)
+        self.lost = create_location(user, status="processing", address="Казань", processing_since=stale_since)
+
+        patches = {
+            "buffered": mock.patch("image_api.tasks.PredictionBatcher.pending_task_ids", return_value=set()),
+            "queued": mock.patch("image_api.tasks.GeocodingQueue.pending_dispatch_ids",
+                                 return_value={self.geocoding.id}),
+            "release": mock.patch("image_api.tasks.AdmissionController.release"),
+            "enrich": mock.patch("image_api.tasks.enrich_locations_task"),
+            "dispatch": mock.patch("image_api.tasks.dispatch_geo_tasks"),
+        }
+        self.mocks = {name: patch.start() for name, patch in patches.items()}
+        for patch in patches.values():
+            self.addCleanup(patch.stop)
+
+    def test_locations_waiting_for_geocoding_are_not_redispatched(self):
+        result = sweep_stale_locations_task()
+
+        self.assertEqual(result, {"redispatched": 1, "failed": 0, "waiting": 1})
+        self.mocks["enrich"].delay.assert_called_once_with([self.lost.id])
+
+        self.geocoding.refresh_from_db()
+        self.assertEqual(self.geocoding.dispatch_attempts, 0)
+        self.assertGreater(self.geocoding.processing_since, timezone.now() - timedelta(minutes=1))
+        self.lost.refresh_from_db()
+        self.assertEqual(self.lost.dispatch_attempts, 1)
+
+
+class DirectUploadFinalizeTests(TestCase):
+    """
+    Повторное подтверждение прямой загрузки тем же токеном
+    """
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username="owner", password="secret")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+        s3_client = mock.Mock()
+        s3_client.head_object.return_value = {"ContentLength": 1024}
+        patches = [
+            mock.patch("image_api.services.s3_service.get_s3_client", return_value=s3_client),
+            mock.patch("image_api.services.s3_service.S3Service.generate_upload_url",
+                       return_value="http://s3.invalid/upload"),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        dispatch = mock.patch("image_api.services.image_upload_service.ImageUploadService._dispatch")
+        self.dispatch = dispatch.start()
+        self.addCleanup(dispatch.stop)
+
+        response = self.client.post(reverse("upload_images_presign"), {"files": [
+            {"name": "a.jpg", "content_type": "image/jpeg", "lat": 55.75, "lon": 37.61},
+            {"name": "b.jpg", "content_type": "image/jpeg", "address": "Москва"},
+        ]}, format="json")
+        self.assertEqual(response.status_code, 200)
+        self.token = response.data["upload_token"]
+
+    def finalize(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(reverse("upload_images_finalize"), {"upload_token": self.token}, format="json")
+
+    def test_repeated_finalize_returns_existing_records(self):
+        first = self.finalize()
+        second = self.finalize()
+
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(first.data, {"uploaded": 2})
+        self.assertEqual(second.data, {"uploaded": 2})
+        self.assertEqual(UploadedImage.objects.filter(user=self.user).count(), 2)
+        self.assertEqual(ImageLocation.objects.filter(user=self.user).count(), 2)
+        self.dispatch.assert_called_once()
+
+
+@override_settings(ARCHIVE_UPLOAD_CHUNK_SIZE=4, ARCHIVE_UPLOAD_MAX_SIZE=10 ** 9)
+class ArchiveUploadSessionTests(TestCase):
+    """
+    Возобновляемая загрузка архива: размер частей, смещения и номера частей S3
+    """
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username="owner", password="secret")
+
+        self.s3_client = mock.Mock()
+        self.s3_client.create_multipart_upload.return_value = {"UploadId": "upload-1"}
+        self.s3_client.upload_part.side_effect = lambda **kwargs: {"ETag": f'"{kwargs["PartNumber"]}"'}
+        self.s3_client.head_object.side_effect = ClientError({"Error": {"Code": "404"}}, "HeadObject")
+        patches = [
+            mock.patch("image_api.services.s3_service.get_s3_client", return_value=self.s3_client),
+            # Минимум S3 в 5 МБ не нужен для проверки арифметики частей
+            mock.patch("image_api.services.archive_upload_service.MIN_MULTIPART_PART_SIZE", 4),
+            mock.patch("image_api.services.archive_upload_service.process_archive_task"),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.service = ArchiveUploadService(self.user)
+
+    def upload(self, session, offset, data):
+        return self.service.upload_chunk(session.id, offset, io.BytesIO(data), len(data))
+
+    def test_chunk_size_grows_to_fit_part_limit(self):
+        self.assertEqual(self.service.create_session("small.zip", 10).chunk_size, 4)
+
+        session = self.service.create_session("large.zip", 4 * 10000 + 1)
+        self.assertEqual(session.chunk_size, 1024 * 1024)
+        self.assertGreaterEqual(session.chunk_size * 10000, session.total_size)
+
+    def test_chunks_map_to_consecutive_parts(self):
+        session = self.service.create_session("archive.zip", 10)
+        self.upload(session, 0, b"aaaa")
+        self.upload(session, 4, b"bbbb")
+        session = self.upload(session, 8, b"cc")
+
+        self.assertEqual(session.offset, 10)
+        self.assertEqual([part["PartNumber"] for part in session.parts], [1, 2, 3])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            archive = self.service.complete_session(session.id)
+        parts = self.s3_client.complete_multipart_upload.call_args.kwargs["MultipartUpload"]["Parts"]
+        self.assertEqual([part["PartNumber"] for part in parts], [1, 2, 3])
+        self.assertEqual(archive.filename, session.filename)
+
+    def test_out_of_order_chunk_is_rejected(self):
+        session = self.service.create_session("archive.zip", 10)
+
+        with self.assertRaises(UploadSessionError) as ctx:
+            self.upload(session, 4, b"bbbb")
+        self.assertEqual((ctx.exception.status_code, ctx.exception.offset), (409, 0))
+
+    def test_repeated_chunk_is_rejected(self):
+        session = self.service.create_session("archive.zip", 10)
+        self.upload(session, 0, b"aaaa")
+
+        with self.assertRaises(UploadSessionError) as ctx:
+            self.upload(session, 0, b"aaaa")
+        self.assertEqual((ctx.exception.status_code, ctx.exception.offset), (409, 4))
+        self.assertEqual(len(ArchiveUploadSession.objects.get(id=session.id).parts), 1)
+
+    def test_chunk_of_wrong_length_is_rejected(self):
+        session = self.service.create_session("archive.zip", 10)
+
+        with self.assertRaises(UploadSessionError) as ctx:
+            self.upload(session, 0, b"aaa")
+        self.assertEqual(ctx.exception.status_code, 400)
+        self.s3_client.upload_part.assert_not_called()
+
+    def test_complete_requires_every_chunk(self):
+        session = self.service.create_session("archive.zip", 10)
+        self.upload(session, 0, b"aaaa")
+
+        with self.assertRaises(UploadSessionError) as ctx:
+            self.service.complete_session(session.id)
+        self.assertEqual((ctx.exception.status_code, ctx.exception.offset), (409, 4))
+
+    @override_settings(ARCHIVE_UPLOAD_MAX_SIZE=100)
+    def test_oversized_archive_is_rejected(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+
+        response = client.post(reverse("upload_archive_sessions"),
+                               {"filename": "archive.zip", "total_size": 101}, format="json")
+
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("total_size", response.data)
+        self.s3_client.create_multipart_upload.assert_not_called()
+
+    def test_failed_session_insert_releases_s3_objects(self):
+        with mock.patch.object(ArchiveUploadSession.objects, "create", side_effect=DatabaseError("insert failed")):
+            with self.assertRaises(DatabaseError):
+                self.service.create_session("archive.zip", 10, metadata=[{"image": "a.jpg"}])
+
+        self.s3_client.abort_multipart_upload.assert_called_once()
+        metadata_key = self.s3_client.put_object.call_args.kwargs["Key"]
+        self.s3_client.delete_object.assert_called_once_with(Bucket=mock.ANY, Key=metadata_key)
@@ -1,16 +1,27 @@
 from django.urls import path
 
-from .callbacks import image_location_callback, image_trash_result_callback
+from .callbacks import image_location_callback, image_trash_result_callback, image_results_batch_callback
 from .views import UploadImageView, GetUserImageLocationsView, DeleteUserImageLocationView, UploadArchiveView, \
-    GetUserDetectedLocation, RetryUserImageLocationView
+    GetUserDetectedLocation, RetryUserImageLocationView, GeocodingStatsView, PredictionStatsView, \
+    DirectUploadPresignView, DirectUploadFinalizeView, ArchiveUploadSessionCreateView, ArchiveUploadSessionView, \
+    ArchiveUploadSessionCompleteView
 
 urlpatterns = [
     path('upload-archive/', UploadArchiveView.as_view(), name='upload_archive'),
+    path('upload-archive/sessions/', ArchiveUploadSessionCreateView.as_view(), name='upload_archive_sessions'),
+    path('upload-archive/sessions/<int:pk>/', ArchiveUploadSessionView.as_view(), name='upload_archive_session'),
+    path('upload-archive/sessions/<int:pk>/complete/', ArchiveUploadSessionCompleteView.as_view(),
+         name='upload_archive_session_complete'),
     path('upload-images/', UploadImageView.as_view(), name='upload_images'),
+    path('upload-images/presign/', DirectUploadPresignView.as_view(), name='upload_images_presign'),
+    path('upload-images/finalize/', DirectUploadFinalizeView.as_view(), name='upload_images_finalize'),
     path('user/image-locations/', GetUserImageLocationsView.as_view(), name='user-image-locations'),
     path('update-image-result/', image_location_callback, name='image-location-callback'),
     path('update-image-trash-result/', image_trash_result_callback, name='image-trash-location-callback'),
+    path('update-image-results/batch/', image_results_batch_callback, name='image-results-batch-callback'),
     path('map/trash-images-by-coordinates/', GetUserDetectedLocation.as_view(), name='user-trash-image-locations'),
     path("image-locations/<int:pk>/", DeleteUserImageLocationView.as_view(), name="delete-image-location"),
     path("image-locations/<int:pk>/retry", RetryUserImageLocationView.as_view(), name="retry-image-location"),
+    path('stats/geocoding/', GeocodingStatsView.as_view(), name='geocoding-stats'),
+    path('stats/prediction/', PredictionStatsView.as_view(), name='prediction-stats'),
 ]
\ No newline at end of file
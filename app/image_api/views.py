@@ -3,18 +3,22 @@ import logging
 
 from django.utils.dateparse import parse_date
 from drf_spectacular.utils import OpenApiExample, OpenApiResponse, extend_schema, OpenApiParameter
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
-from geopy.geocoders import Nominatim
 
 from .filters import ImageLocationDateFilter, RadiusFilter
 from .models import ImageLocation, DetectedImageLocation
 from .pagination import CustomPagination
 from image_api.services.image_upload_service import ImageUploadService
-from image_api.services.archive_upload_service import ArchiveUploadService
-from .serializers import UploadImagesRequestSerializer, ImageDataSerializer
+from image_api.services.direct_upload_service import DirectUploadService
+from image_api.services.archive_upload_service import ArchiveUploadService, UploadSessionError
+from image_api.services.presign_service import get_presign_service
+from image_api.services.geocoding_service import GeocodingService
+from image_api.services.admission_controller import AdmissionController
+from .serializers import UploadImagesRequestSerializer, ImageDataSerializer, DirectUploadRequestSerializer, \
+    DirectUploadFinalizeSerializer, ArchiveUploadSessionCreateSerializer, ArchiveUploadSessionSerializer
 
 logger = logging.getLogger(__name__)
 
@@ -147,9 +151,10 @@ upload_server_error_schema = {
     ],
     summary="Загрузка изображений и создание задач на обработку",
     description="Принимает массив изображений и связанных с ними данных (адрес, координаты, угол, высота). "
-                "Если предоставлен только адрес, производится геокодирование для получения координат. "
-                "Если предоставлены только координаты, производится обратное геокодирование для получения адреса. "
-                "Затем изображения валидируются, загружаются в S3, и создаются задачи для асинхронной обработки.",
+                "Изображения валидируются, загружаются в S3, и создаются задачи для асинхронной обработки. "
+                "Если предоставлен только адрес, координаты определяются геокодированием в фоне, "
+                "если только координаты — адрес определяется обратным геокодированием, "
+                "после чего изображение отправляется на распознавание.",
 )
 class UploadImageView(APIView):
     permission_classes = [IsAuthenticated]
@@ -173,41 +178,19 @@ class UploadImageView(APIView):
 
         serializer = ImageDataSerializer(data=images_data, many=True)
         serializer.is_valid(raise_exception=True)
-        geolocator = Nominatim(user_agent="my_app")
-        images_data = serializer.validated_data
-        processed = []
-        for item in images_data:
-            image = item["image"]
-            address = item.get("address")
-            lat = item.get("lat")
-            lon = item.get("lon")
-
-            # Если есть адрес, но нет координат → геокодируем
-            if address and (lat is None or lon is None):
-                try:
-                    loc = geolocator.geocode(address)
-                    if loc:
-                        lat, lon = loc.latitude, loc.longitude
-                except Exception as e:
-                    print(f" Ошибка геокодирования {address}: {e}")
-
-            # Если есть координаты, но нет адреса → обратное геокодирование
-            if (lat is not None and lon is not None) and not address:
-                try:
-                    loc = geolocator.reverse((lat, lon))
-                    if loc:
-                        address = loc.address
-                except Exception as e:
-                    print(f"Ошибка reverse для {lat}, {lon}: {e}")
-
-            processed.append({
-                "image": image,
-                "address": address,
-                "lat": lat,
-                "lon": lon,
+        # Геокодирование недостающих адреса/координат выполняется в фоне
+        # (enrich_locations_task), поэтому данные сохраняются как есть
+        processed = [
+            {
+                "image": item["image"],
+                "address": item.get("address"),
+                "lat": item.get("lat"),
+                "lon": item.get("lon"),
                 "angle": item.get("angle"),
                 "height": item.get("height"),
-            })
+            }
+            for item in serializer.validated_data
+        ]
 
         service = ImageUploadService(request.user)
         validated_files, validation_errors = service.validate_files(processed)
@@ -233,6 +216,178 @@ class UploadImageView(APIView):
                 logger.error(f"Error deleting {uploaded_image.filename}: {str(delete_error)}")
 
 
+# --- DirectUploadPresignView / DirectUploadFinalizeView ---
+direct_upload_presign_response_schema = {
+    "type": "object",
+    "properties": {
+        "upload_token": {"type": "string"},
+        "expires_in": {"type": "integer"},
+        "uploads": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "file_index": {"type": "integer"},
+                    "filename": {"type": "string"},
+                    "key": {"type": "string"},
+                    "url": {"type": "string"},
+                    "method": {"type": "string"},
+                    "headers": {"type": "object", "additionalProperties": {"type": "string"}}
+                },
+                "required": ["file_index", "filename", "key", "url", "method", "headers"]
+            }
+        }
+    },
+    "required": ["upload_token", "expires_in", "uploads"]
+}
+
+direct_upload_finalize_response_schema = {
+    "type": "object",
+    "properties": {
+        "uploaded": {"type": "integer"}
+    },
+    "required": ["uploaded"]
+}
+
+
+@extend_schema(
+    request=DirectUploadRequestSerializer,
+    responses={
+        200: OpenApiResponse(
+            description="Ссылки на загрузку выданы",
+            response=direct_upload_presign_response_schema
+        ),
+        400: OpenApiResponse(description="Ошибка валидации запроса"),
+        500: OpenApiResponse(
+            description="Не удалось подписать ссылки",
+            response=upload_server_error_schema
+        )
+    },
+    examples=[
+        OpenApiExample(
+            name="Запрос",
+            value={"files": [{"name": "photo.jpg", "content_type": "image/jpeg", "lat": 55.75, "lon": 37.61}]},
+            request_only=True
+        ),
+        OpenApiExample(
+            name="Успешный ответ",
+            value={
+                "upload_token": "eyJ1c2VyIjoxLCJmaWxlcyI6W119:1u2v3w:signature",
+                "expires_in": 900,
+                "uploads": [
+                    {
+                        "file_index": 0,
+                        "filename": "photo.jpg",
+                        "key": "3f2b6c1e-8a4d-4f7e-9c1b-2d5e6f7a8b9c_photo.jpg",
+                        "url": "http://localhost:9000/bucket/3f2b6c1e-8a4d-4f7e-9c1b-2d5e6f7a8b9c_photo.jpg?X-Amz-...",
+                        "method": "PUT",
+                        "headers": {"Content-Type": "image/jpeg"}
+                    }
+                ]
+            },
+            response_only=True,
+            status_codes=["200"]
+        )
+    ],
+    summary="Прямая загрузка изображений в S3: получение ссылок",
+    description="Первый шаг загрузки без передачи файлов через сервер. Принимает список файлов "
+                "(имя, тип содержимого и те же данные, что и upload-images: адрес, координаты, угол, высота). "
+                "Сервер выбирает ключи объектов и возвращает presigned PUT-ссылки и токен. Клиент загружает "
+                "каждый файл PUT-запросом по своей ссылке с указанными заголовками, после чего вызывает "
+                "upload-images/finalize/ с полученным токеном.",
+)
+class DirectUploadPresignView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request, *args, **kwargs):
+        serializer = DirectUploadRequestSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        files = [
+            {
+                **item,
+                "angle": item.get("angle", DEFAULT_ANGLE),
+                "height": item.get("height", DEFAULT_HEIGHT),
+            }
+            for item in serializer.validated_data["files"]
+        ]
+        result = DirectUploadService(request.user).issue(files)
+        if result is None:
+            return Response(
+                {"error": "Presign failed", "details": "Failed to generate upload URLs"},
+                status=status.HTTP_500_INTERNAL_SERVER_ERROR
+            )
+        return Response(result, status=status.HTTP_200_OK)
+
+
+@extend_schema(
+    request=DirectUploadFinalizeSerializer,
+    responses={
+        200: OpenApiResponse(
+            description="Изображения зарегистрированы и отправлены на обработку",
+            response=direct_upload_finalize_response_schema
+        ),
+        400: OpenApiResponse(
+            description="Недействительный токен или файлы не загружены",
+            response=upload_validation_error_schema
+        ),
+        500: OpenApiResponse(
+            description="Внутренняя ошибка сервера",
+            response=upload_server_error_schema
+        )
+    },
+    examples=[
+        OpenApiExample(
+            name="Успешный запрос",
+            value={"uploaded": 1},
+            response_only=True,
+            status_codes=["200"]
+        ),
+        OpenApiExample(
+            name="Файл не загружен",
+            value={
+                "validation_errors": [
+                    {
+                        "file_index": 0,
+                        "filename": "photo.jpg",
+                        "error": "File was not uploaded"
+                    }
+                ]
+            },
+            response_only=True,
+            status_codes=["400"]
+        )
+    ],
+    summary="Прямая загрузка изображений в S3: подтверждение",
+    description="Второй шаг прямой загрузки. Проверяет токен, наличие и размер каждого объекта в S3 "
+                "и создаёт записи изображений так же, как upload-images. Если хотя бы один файл "
+                "не загружен, ничего не создаётся: файл можно догрузить и повторить подтверждение "
+                "тем же токеном, пока он действителен. Повторное подтверждение уже зарегистрированных "
+                "файлов возвращает тот же ответ и не создаёт записи заново.",
+)
+class DirectUploadFinalizeView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request, *args, **kwargs):
+        serializer = DirectUploadFinalizeSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        service = DirectUploadService(request.user)
+        manifest = service.load_manifest(serializer.validated_data["upload_token"])
+        if manifest is None:
+            return Response({"error": "Invalid or expired upload token"}, status=status.HTTP_400_BAD_REQUEST)
+
+        uploaded_files, validation_errors = service.verify_uploads(manifest)
+        if validation_errors:
+            return Response({"validation_errors": validation_errors}, status=status.HTTP_400_BAD_REQUEST)
+
+        uploaded_images, errors = service.finalize(manifest, uploaded_files)
+        if errors:
+            return Response({"error": "Upload failed", "details": errors}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+        return Response({"uploaded": len(uploaded_images)}, status=status.HTTP_200_OK)
+
+
 # --- UploadArchiveView ---
 # Схема успешного ответа
 upload_archive_success_response_schema = {
@@ -334,6 +489,180 @@ class UploadArchiveView(APIView):
             return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
+# --- ArchiveUploadSession*View ---
+upload_session_error_schema = {
+    "type": "object",
+    "properties": {
+        "error": {"type": "string"},
+        "offset": {"type": "integer", "nullable": True}
+    },
+    "required": ["error"]
+}
+
+
+def _upload_session_error_response(error):
+    return Response({"error": str(error), "offset": error.offset}, status=error.status_code)
+
+
+@extend_schema(
+    request=ArchiveUploadSessionCreateSerializer,
+    responses={
+        201: OpenApiResponse(description="Сессия загрузки создана", response=ArchiveUploadSessionSerializer),
+        400: OpenApiResponse(description="Ошибка валидации запроса"),
+        500: OpenApiResponse(description="Не удалось начать загрузку в S3", response=upload_archive_error_500_schema)
+    },
+    examples=[
+        OpenApiExample(
+            name="Запрос",
+            value={"filename": "photos.zip", "total_size": 5368709120},
+            request_only=True
+        ),
+    ],
+    summary="Возобновляемая загрузка архива: создание сессии",
+    description="Начинает загрузку архива частями. Сервер возвращает chunk_size: каждая часть, кроме "
+                "последней, должна быть ровно такого размера. Части отправляются по порядку запросами "
+                "PUT upload-archive/sessions/{id}/ с телом части и заголовком Upload-Offset. После обрыва "
+                "соединения текущее смещение можно узнать GET-запросом и продолжить с него. "
+                "Необязательное поле metadata — содержимое JSON-файла метаданных, как в upload-archive.",
+)
+class ArchiveUploadSessionCreateView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request, *args, **kwargs):
+        serializer = ArchiveUploadSessionCreateSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+
+        try:
+            session = ArchiveUploadService(request.user).create_session(
+                data["filename"], data["total_size"], data.get("metadata")
+            )
+        except UploadSessionError as e:
+            return _upload_session_error_response(e)
+        except Exception as e:
+            return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        return Response(ArchiveUploadSessionSerializer(session).data, status=status.HTTP_201_CREATED)
+
+
+class ArchiveUploadSessionView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    @extend_schema(
+        request=None,
+        responses={
+            200: OpenApiResponse(description="Состояние сессии загрузки", response=ArchiveUploadSessionSerializer),
+            404: OpenApiResponse(description="Сессия не найдена", response=upload_session_error_schema)
+        },
+        summary="Возобновляемая загрузка архива: текущее смещение",
+        description="Возвращает состояние сессии; offset — число уже принятых байт, с него продолжается загрузка.",
+    )
+    def get(self, request, pk, *args, **kwargs):
+        try:
+            session = ArchiveUploadService(request.user).get_session(pk)
+        except UploadSessionError as e:
+            return _upload_session_error_response(e)
+        return Response(ArchiveUploadSessionSerializer(session).data, status=status.HTTP_200_OK)
+
+    @extend_schema(
+        request={'application/octet-stream': {'type': 'string', 'format': 'binary'}},
+        parameters=[
+            OpenApiParameter(
+                name="Upload-Offset",
+                type=int,
+                location=OpenApiParameter.HEADER,
+                required=True,
+                description="Смещение части в архиве; должно совпадать с offset сессии"
+            ),
+        ],
+        responses={
+            200: OpenApiResponse(description="Часть принята", response=ArchiveUploadSessionSerializer),
+            400: OpenApiResponse(description="Неверный размер части", response=upload_session_error_schema),
+            404: OpenApiResponse(description="Сессия не найдена", response=upload_session_error_schema),
+            409: OpenApiResponse(
+                description="Смещение не совпадает или сессия уже завершена; offset — текущее смещение",
+                response=upload_session_error_schema
+            ),
+            502: OpenApiResponse(description="Ошибка S3, часть можно отправить повторно", response=upload_session_error_schema)
+        },
+        summary="Возобновляемая загрузка архива: отправка части",
+        description="Тело запроса — байты части архива. Каждая часть загружается в S3 как отдельная часть "
+                    "multipart-загрузки, поэтому запрос короткий и не занимает воркер на всю передачу архива.",
+    )
+    def put(self, request, pk, *args, **kwargs):
+        try:
+            offset = int(request.headers.get("Upload-Offset", ""))
+            content_length = int(request.META.get("CONTENT_LENGTH") or 0)
+        except ValueError:
+            return Response({"error": "Upload-Offset header is required", "offset": None},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        # Тело читается потоком: request.data не используется, парсеры DRF не вызываются
+        try:
+            session = ArchiveUploadService(request.user).upload_chunk(pk, offset, request.stream, content_length)
+        except UploadSessionError as e:
+            return _upload_session_error_response(e)
+        return Response(ArchiveUploadSessionSerializer(session).data, status=status.HTTP_200_OK)
+
+    @extend_schema(
+        request=None,
+        responses={
+            204: OpenApiResponse(description="Загрузка отменена"),
+            404: OpenApiResponse(description="Сессия не найдена", response=upload_session_error_schema),
+            409: OpenApiResponse(description="Сессия уже завершена или отменена", response=upload_session_error_schema)
+        },
+        summary="Возобновляемая загрузка архива: отмена",
+        description="Отменяет незавершённую загрузку и удаляет уже загруженные части из S3.",
+    )
+    def delete(self, request, pk, *args, **kwargs):
+        try:
+            ArchiveUploadService(request.user).abort_session(pk)
+        except UploadSessionError as e:
+            return _upload_session_error_response(e)
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+@extend_schema(
+    request=None,
+    responses={
+        202: OpenApiResponse(
+            description="Архив загружен, задача на обработку поставлена в очередь",
+            response=upload_archive_success_response_schema
+        ),
+        404: OpenApiResponse(description="Сессия не найдена", response=upload_session_error_schema),
+        409: OpenApiResponse(
+            description="Загружены не все части, сессия отменена или уже завершается другим запросом",
+            response=upload_session_error_schema
+        ),
+        502: OpenApiResponse(description="Ошибка S3, завершение можно повторить", response=upload_session_error_schema)
+    },
+    examples=[
+        OpenApiExample(
+            name="Успешный запрос",
+            value={"message": "Archive uploaded", "archive_id": 123},
+            response_only=True,
+            status_codes=["202"]
+        ),
+    ],
+    summary="Возобновляемая загрузка архива: завершение",
+    description="Собирает загруженные части в один объект S3, создаёт архив и ставит его в обработку, "
+                "как upload-archive. Повторный вызов для завершённой сессии возвращает тот же archive_id. "
+                "Если прежнее завершение прервалось, повторный вызов доводит его до конца. Сессии без "
+                "активности дольше ARCHIVE_UPLOAD_SESSION_MAX_AGE отменяются автоматически.",
+)
+class ArchiveUploadSessionCompleteView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request, pk, *args, **kwargs):
+        try:
+            archive = ArchiveUploadService(request.user).complete_session(pk)
+        except UploadSessionError as e:
+            return _upload_session_error_response(e)
+        return Response(
+            {"message": "Archive uploaded", "archive_id": archive.id if archive else None},
+            status=status.HTTP_202_ACCEPTED
+        )
+
+
 # --- GetUserImageLocationsView ---
 # Схема ответа для одного элемента results
 image_location_item_schema = {
@@ -471,7 +800,12 @@ class GetUserImageLocationsView(APIView):
             )
 
         # Базовый QuerySet, ограниченный пользователем
-        base_queryset = ImageLocation.objects.filter(user=user).select_related('image', 'user').order_by('-id')
+        base_queryset = (
+            ImageLocation.objects.filter(user=user)
+            .select_related('image', 'user')
+            .prefetch_related('detected_image_mappings__file')
+            .order_by('-id')
+        )
 
         # Инициализируем оба фильтра с одинаковым QuerySet
         # 1. Фильтр по дате
@@ -486,8 +820,13 @@ class GetUserImageLocationsView(APIView):
         paginator = CustomPagination()
         paginated_locations = paginator.paginate_queryset(final_queryset, request)
 
+        # Подписываем ссылки на все изображения страницы одним вызовом
+        presigned_urls = get_presign_service().presign_many(
+            key for loc in paginated_locations for key in loc.presign_keys()
+        )
+
         # Формируем список словарей через to_dict()
-        response_data = [loc.to_dict() for loc in paginated_locations]
+        response_data = [loc.to_dict(presigned_urls) for loc in paginated_locations]
 
         # Возвращаем ответ с пагинацией
         return paginator.get_paginated_response(response_data)
@@ -685,7 +1024,9 @@ class GetUserDetectedLocation(APIView):
         radius_filter_instance = RadiusFilter(request.query_params, queryset=base_queryset)
         final_queryset = radius_filter_instance.qs
 
-        response_data = [loc.to_dict() for loc in final_queryset]
+        locations = list(final_queryset)
+        presigned_urls = get_presign_service().presign_many(loc.file.filename for loc in locations)
+        response_data = [loc.to_dict(presigned_urls) for loc in locations]
 
         # оборачиваем под ключ "data"
         return Response({"data": response_data}, status=status.HTTP_200_OK)
@@ -758,4 +1099,61 @@ class RetryUserImageLocationView(APIView):
         service = ImageUploadService(request.user)
         service.retry_result(image_location)
 
-        return Response({"message": f"ImageLocation {pk} retried"}, status=status.HTTP_200_OK)
\ No newline at end of file
+        return Response({"message": f"ImageLocation {pk} retried"}, status=status.HTTP_200_OK)
+
+
+@extend_schema(
+    request=None,
+    responses={
+        200: OpenApiResponse(
+            description="Счётчики кеша геокодирования",
+            response={
+                "type": "object",
+                "properties": {
+                    "l1_hits": {"type": "integer", "example": 120},
+                    "l2_hits": {"type": "integer", "example": 30},
+                    "misses": {"type": "integer", "example": 10},
+                    "errors": {"type": "integer", "example": 0},
+                    "hit_ratio": {"type": "number", "format": "float", "example": 0.9375, "nullable": True},
+                }
+            }
+        ),
+    },
+    summary="Статистика кеша геокодирования",
+    description="Возвращает суммарные по всем процессам счётчики попаданий в локальный (l1) "
+                "и постоянный (l2) кеш геокодирования, промахов и ошибок геокодера. "
+                "Доступно только администраторам.",
+)
+class GeocodingStatsView(APIView):
+    permission_classes = [IsAdminUser]
+
+    def get(self, request, *args, **kwargs):
+        return Response(GeocodingService.get_stats(), status=status.HTTP_200_OK)
+
+
+@extend_schema(
+    request=None,
+    responses={
+        200: OpenApiResponse(
+            description="Заполнение окна задач в сервисе распознавания",
+            response={
+                "type": "object",
+                "properties": {
+                    "window": {"type": "integer", "example": 1000},
+                    "in_flight": {"type": "integer", "example": 640},
+                    "available": {"type": "integer", "example": 360, "nullable": True},
+                    "held": {"type": "integer", "example": 0},
+                }
+            }
+        ),
+    },
+    summary="Статистика отправки задач на распознавание",
+    description="Возвращает размер окна задач, одновременно находящихся в сервисе распознавания, "
+                "число задач в работе, свободные слоты (null, если окно не ограничено) и число "
+                "задач, ожидающих отправки. Доступно только администраторам.",
+)
+class PredictionStatsView(APIView):
+    permission_classes = [IsAdminUser]
+
+    def get(self, request, *args, **kwargs):
+        return Response(AdmissionController().get_stats(), status=status.HTTP_200_OK)
@@ -10,6 +10,28 @@ BASE_DIR = Path(__file__).resolve().parent.parent
 API_BASE_URL=os.environ.get("API_BASE_URL")
 EXTERNAL_SERVICE_URL=os.environ.get("EXTERNAL_SERVICE_URL")
 
+# Клиент сервиса распознавания: таймауты (сек), повторы при 5xx/ошибке соединения, размер пула
+PREDICTION_CONNECT_TIMEOUT = float(os.environ.get("PREDICTION_CONNECT_TIMEOUT", 3))
+PREDICTION_READ_TIMEOUT = float(os.environ.get("PREDICTION_READ_TIMEOUT", 30))
+PREDICTION_RETRIES = int(os.environ.get("PREDICTION_RETRIES", 3))
+PREDICTION_RETRY_BACKOFF = float(os.environ.get("PREDICTION_RETRY_BACKOFF", 0.5))
+PREDICTION_RETRY_BACKOFF_MAX = float(os.environ.get("PREDICTION_RETRY_BACKOFF_MAX", 8))
+PREDICTION_POOL_SIZE = int(os.environ.get("PREDICTION_POOL_SIZE", 10))
+# Отправка задач частями: размер части, число одновременных запросов,
+# повторы части после сбоя сервиса и базовая задержка повтора (сек)
+PREDICTION_CHUNK_SIZE = int(os.environ.get("PREDICTION_CHUNK_SIZE", 200))
+PREDICTION_DISPATCH_CONCURRENCY = int(os.environ.get("PREDICTION_DISPATCH_CONCURRENCY", 4))
+PREDICTION_DISPATCH_RETRIES = int(os.environ.get("PREDICTION_DISPATCH_RETRIES", 3))
+PREDICTION_DISPATCH_RETRY_BACKOFF = float(os.environ.get("PREDICTION_DISPATCH_RETRY_BACKOFF", 30))
+# Накопление задач от разных загрузок: размер пачки и максимальная задержка отправки (сек; 0 — без накопления)
+PREDICTION_BATCH_SIZE = int(os.environ.get("PREDICTION_BATCH_SIZE", 200))
+PREDICTION_BATCH_MAX_DELAY = float(os.environ.get("PREDICTION_BATCH_MAX_DELAY", 2))
+# Окно задач, одновременно находящихся в сервисе распознавания (0 — без ограничения),
+# срок ожидания callback'а (сек) и интервал повторной попытки отправки при заполненном окне (сек)
+PREDICTION_INFLIGHT_WINDOW = int(os.environ.get("PREDICTION_INFLIGHT_WINDOW", 1000))
+PREDICTION_INFLIGHT_TIMEOUT = int(os.environ.get("PREDICTION_INFLIGHT_TIMEOUT", 900))
+PREDICTION_ADMISSION_POLL_INTERVAL = float(os.environ.get("PREDICTION_ADMISSION_POLL_INTERVAL", 5))
+
 # Безопасность
 SECRET_KEY = os.environ.get("DJANGO_SECRET_KEY", "dev")
 DEBUG = os.environ.get("DJANGO_DEBUG", "0") == "1"
@@ -134,6 +156,20 @@ if USE_S3_MEDIA:
     AWS_S3_VERIFY = True
     MEDIA_URL = f"{os.environ.get('AWS_S3_ENDPOINT_URL')}/{AWS_STORAGE_BUCKET_NAME}/"
     AWS_S3_PUBLIC_ENDPOINT = os.getenv("AWS_S3_PUBLIC_ENDPOINT", AWS_S3_ENDPOINT_URL)
+    # Размер пула соединений общего клиента S3 (на процесс)
+    AWS_S3_MAX_POOL_CONNECTIONS = int(os.environ.get("AWS_S3_MAX_POOL_CONNECTIONS", 32))
+    # Параллельная загрузка в S3: число потоков, повторы и базовая задержка между ними (сек.)
+    AWS_S3_UPLOAD_CONCURRENCY = int(os.environ.get("AWS_S3_UPLOAD_CONCURRENCY", 16))
+    AWS_S3_UPLOAD_RETRIES = int(os.environ.get("AWS_S3_UPLOAD_RETRIES", 2))
+    AWS_S3_UPLOAD_RETRY_BACKOFF = float(os.environ.get("AWS_S3_UPLOAD_RETRY_BACKOFF", 0.5))
+    # Потоковая multipart-загрузка архивов: размер части (байт) и число параллельно загружаемых частей
+    AWS_S3_MULTIPART_PART_SIZE = int(os.environ.get("AWS_S3_MULTIPART_PART_SIZE", 8 * 1024 * 1024))
+    AWS_S3_MULTIPART_CONCURRENCY = int(os.environ.get("AWS_S3_MULTIPART_CONCURRENCY", 4))
+    # Размер блока при чтении объектов ranged GET-запросами (архивы в подзадачах)
+    AWS_S3_RANGE_READ_BLOCK_SIZE = int(os.environ.get("AWS_S3_RANGE_READ_BLOCK_SIZE", 4 * 1024 * 1024))
+    # Кеш presigned-ссылок: длина окна (сек.), в котором ссылка переиспользуется, и размер кеша
+    PRESIGNED_URL_CACHE_BUCKET = int(os.environ.get("PRESIGNED_URL_CACHE_BUCKET", 300))
+    PRESIGNED_URL_CACHE_SIZE = int(os.environ.get("PRESIGNED_URL_CACHE_SIZE", 10000))
 
 # DRF — убираем SessionAuthentication, чтобы Postman не требовал CSRF
 REST_FRAMEWORK = {
@@ -233,6 +269,8 @@ LOGGING = {
 REDIS_PASSWORD = os.getenv('REDIS_PASSWORD', '')
 REDIS_HOST = os.getenv('REDIS_HOST', 'redis')
 REDIS_PORT = os.getenv('REDIS_PORT', 6379)
+# База Redis для служебных данных приложения (кеши, счётчики); база 0 — брокер Celery
+REDIS_APP_DB = int(os.getenv('REDIS_APP_DB', 1))
 
 CELERY_TASK_ALWAYS_EAGER = False  # False для продакшена
 CELERY_TASK_EAGER_PROPAGATES = True
@@ -244,4 +282,77 @@ CELERY_RESULT_BACKEND = (
     f"redis://:{REDIS_PASSWORD}@{os.getenv('REDIS_HOST', 'redis')}:{os.getenv('REDIS_PORT', 6379)}/0"
 )
 CELERY_TASK_TRACK_STARTED = True
-CELERY_TASK_TIME_LIMIT = 30 * 60
\ No newline at end of file
+CELERY_TASK_TIME_LIMIT = 30 * 60
+# Результаты сервиса распознавания обрабатываются отдельными воркерами (очередь callbacks)
+CELERY_TASK_ROUTES = {
+    'image_api.tasks.apply_main_result_task': {'queue': 'callbacks'},
+    'image_api.tasks.apply_trash_result_task': {'queue': 'callbacks'},
+}
+# Периодические задачи (celery beat)
+CELERY_BEAT_SCHEDULE = {
+    'sweep-stale-image-locations': {
+        'task': 'image_api.tasks.sweep_stale_locations_task',
+        'schedule': float(os.getenv('PROCESSING_SWEEP_INTERVAL', 300)),
+    },
+    'expire-stale-archive-upload-sessions': {
+        'task': 'image_api.tasks.expire_archive_upload_sessions_task',
+        'schedule': float(os.getenv('ARCHIVE_UPLOAD_CLEANUP_INTERVAL', 3600)),
+    },
+}
+# Зависшие в processing записи: через сколько секунд считать запись зависшей,
+# сколько раз отправлять повторно, размер пачки и предел записей за один проход
+PROCESSING_STALE_AFTER = int(os.getenv('PROCESSING_STALE_AFTER', 1800))
+PROCESSING_MAX_REDISPATCHES = int(os.getenv('PROCESSING_MAX_REDISPATCHES', 3))
+PROCESSING_SWEEP_BATCH_SIZE = int(os.getenv('PROCESSING_SWEEP_BATCH_SIZE', 200))
+PROCESSING_SWEEP_MAX_ITEMS = int(os.getenv('PROCESSING_SWEEP_MAX_ITEMS', 5000))
+# Максимальное число результатов в одном запросе update-image-results/batch/
+CALLBACK_BATCH_MAX_ITEMS = int(os.getenv('CALLBACK_BATCH_MAX_ITEMS', 1000))
+# Прямая загрузка изображений в S3: срок жизни ссылок на загрузку и токена подтверждения (сек),
+# число файлов в одном запросе и максимальный размер файла (байт)
+DIRECT_UPLOAD_URL_EXPIRES = int(os.getenv('DIRECT_UPLOAD_URL_EXPIRES', 900))
+DIRECT_UPLOAD_TOKEN_MAX_AGE = int(os.getenv('DIRECT_UPLOAD_TOKEN_MAX_AGE', 3600))
+DIRECT_UPLOAD_MAX_FILES = int(os.getenv('DIRECT_UPLOAD_MAX_FILES', 500))
+DIRECT_UPLOAD_MAX_FILE_SIZE = int(os.getenv('DIRECT_UPLOAD_MAX_FILE_SIZE', 50 * 1024 * 1024))
+
+# Обработка архивов: сколько изображений извлекается, загружается и освобождается за один шаг
+ARCHIVE_PROCESSING_BATCH_SIZE = int(os.getenv('ARCHIVE_PROCESSING_BATCH_SIZE', 16))
+# Число записей архива, обрабатываемых одной подзадачей Celery
+ARCHIVE_CHUNK_SIZE = int(os.getenv('ARCHIVE_CHUNK_SIZE', 100))
+# Возобновляемая загрузка архивов: размер части (байт, не меньше 5 МБ — минимум S3 для multipart)
+ARCHIVE_UPLOAD_CHUNK_SIZE = int(os.getenv('ARCHIVE_UPLOAD_CHUNK_SIZE', 8 * 1024 * 1024))
+# Максимальный размер архива (байт); не больше 5 ТиБ — предела S3 на размер объекта
+ARCHIVE_UPLOAD_MAX_SIZE = min(int(os.getenv('ARCHIVE_UPLOAD_MAX_SIZE', 100 * 1024 ** 3)), 5 * 1024 ** 4)
+# Через сколько секунд незавершённое завершение загрузки (completing) можно повторить,
+# через сколько секунд бездействия сессия отменяется и сколько сессий отменяется за проход
+ARCHIVE_UPLOAD_COMPLETE_TIMEOUT = int(os.getenv('ARCHIVE_UPLOAD_COMPLETE_TIMEOUT', 600))
+ARCHIVE_UPLOAD_SESSION_MAX_AGE = int(os.getenv('ARCHIVE_UPLOAD_SESSION_MAX_AGE', 24 * 60 * 60))
+ARCHIVE_UPLOAD_CLEANUP_BATCH_SIZE = int(os.getenv('ARCHIVE_UPLOAD_CLEANUP_BATCH_SIZE', 500))
+
+# Геокодирование и его кеш
+# Геокодер: nominatim, offline (локальный справочник) или offline_fallback (справочник, затем Nominatim)
+GEOCODER_BACKEND = os.getenv('GEOCODER_BACKEND', 'nominatim')
+# CSV со справочником адресных точек (lat, lon, address) для offline-геокодера
+GEOCODER_OFFLINE_PATH = os.getenv('GEOCODER_OFFLINE_PATH', str(BASE_DIR / 'data' / 'gazetteer.csv'))
+# Размер ячейки пространственного индекса (градусы) и максимальное расстояние до ближайшего адреса (м)
+GEOCODER_OFFLINE_CELL_DEG = float(os.getenv('GEOCODER_OFFLINE_CELL_DEG', 0.005))
+GEOCODER_OFFLINE_MAX_DISTANCE_M = float(os.getenv('GEOCODER_OFFLINE_MAX_DISTANCE_M', 200))
+GEOCODING_USER_AGENT = os.getenv('GEOCODING_USER_AGENT', 'my_app')
+GEOCODING_TIMEOUT = float(os.getenv('GEOCODING_TIMEOUT', 10))
+GEOCODING_CACHE_TTL = int(os.getenv('GEOCODING_CACHE_TTL', 30 * 24 * 60 * 60))
+GEOCODING_NEGATIVE_TTL = int(os.getenv('GEOCODING_NEGATIVE_TTL', 24 * 60 * 60))
+GEOCODING_LRU_SIZE = int(os.getenv('GEOCODING_LRU_SIZE', 4096))
+# Точность округления координат для ключа обратного геокодирования (4 знака ≈ 11 м)
+GEOCODING_COORD_PRECISION = int(os.getenv('GEOCODING_COORD_PRECISION', 4))
+# Сколько ImageLocation фоновое геокодирование обрабатывает за один шаг
+GEOCODING_ENRICHMENT_BATCH_SIZE = int(os.getenv('GEOCODING_ENRICHMENT_BATCH_SIZE', 20))
+# Ограничение частоты запросов к Nominatim (запросов в секунду на все процессы) и допустимый всплеск
+GEOCODING_RATE_LIMIT = float(os.getenv('GEOCODING_RATE_LIMIT', 1))
+GEOCODING_RATE_BURST = int(os.getenv('GEOCODING_RATE_BURST', 1))
+# Сколько ждать свободного слота, прежде чем считать запрос неудачным (сек.)
+GEOCODING_RATE_WAIT_TIMEOUT = float(os.getenv('GEOCODING_RATE_WAIT_TIMEOUT', 30))
+# Воркер очереди геокодирования: запросов за один запуск и TTL его блокировки (сек.)
+GEOCODING_WORKER_MAX_ITEMS = int(os.getenv('GEOCODING_WORKER_MAX_ITEMS', 300))
+GEOCODING_WORKER_LOCK_TTL = int(os.getenv('GEOCODING_WORKER_LOCK_TTL', 120))
+# Повторы запросов, на которые геокодер не ответил: число попыток и начальная задержка (сек.)
+GEOCODING_MAX_RETRIES = int(os.getenv('GEOCODING_MAX_RETRIES', 5))
+GEOCODING_RETRY_BACKOFF = float(os.getenv('GEOCODING_RETRY_BACKOFF', 30))